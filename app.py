@@ -1,27 +1,267 @@
-from flask import Flask, render_template, request, jsonify, Response
+from flask import Flask, render_template, request, jsonify, Response, g, send_from_directory
 import sqlite3
 import os
 import json
 import time
-from datetime import datetime
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
 import re
 import uuid
-from io import BytesIO
+import socket
+import hashlib
+import base64
+import unicodedata
+import csv
+from itertools import groupby
+import random
+import tempfile
+import struct
+import zlib
+from io import BytesIO, StringIO
 from werkzeug.utils import secure_filename
-from threading import Lock
+from threading import Lock, Thread, Condition, Event, local
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import atexit
+import sys
+import asyncio
+from contextvars import ContextVar
+import cProfile
+from contextlib import contextmanager, asynccontextmanager
+from collections import namedtuple, deque
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import glob
 from dotenv import load_dotenv
 
+# 画像の前処理（DIFY_PREPROCESS_ENABLED）を使う場合のみ必要
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Difyの呼び出しをasyncioで行う場合（DIFY_DISPATCHER=asyncio）のみ必要
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# requests（スレッド）とhttpx（asyncio）の通信エラーを同じように扱う
+DIFY_TIMEOUT_ERRORS = (requests.exceptions.Timeout,) + ((httpx.TimeoutException,) if httpx else ())
+DIFY_CONNECTION_ERRORS = (requests.exceptions.RequestException,) + ((httpx.HTTPError,) if httpx else ())
+
 load_dotenv()
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 20 * 1024 * 1024  # 20MB max file size
 
+# ログ設定: LOG_LEVEL（DEBUGでDifyとのやり取りの内容も出力）、LOG_FORMAT（text / json）
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+if LOG_LEVEL not in ('DEBUG', 'INFO', 'WARNING', 'ERROR'):
+    LOG_LEVEL = 'INFO'
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+LOG_MAX_PAYLOAD_CHARS = max(0, int(os.getenv("LOG_MAX_PAYLOAD_CHARS", "2000")))
+
+# スレッドごと・asyncioのタスクごとに別の値になる
+log_context = ContextVar('log_context', default=(None, None))
+
+@contextmanager
+def log_correlation(session_id=None, file_index=None):
+    """Tag the log records of this thread (or asyncio task) with the session and file being worked on"""
+    token = log_context.set((session_id, file_index))
+    try:
+        yield
+    finally:
+        log_context.reset(token)
+
+class CorrelationFilter(logging.Filter):
+    """Add session_id, file_index and a combined correlation_id to each record"""
+    
+    def filter(self, record):
+        session_id, file_index = log_context.get()
+        record.session_id = session_id
+        record.file_index = file_index
+        if session_id is None:
+            record.correlation_id = '-'
+        else:
+            record.correlation_id = session_id if file_index is None else f'{session_id}/{file_index}'
+        return True
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line"""
+    
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'thread': record.threadName
+        }
+        if record.session_id is not None:
+            entry['session_id'] = record.session_id
+        if record.file_index is not None:
+            entry['file_index'] = record.file_index
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class LogPayload:
+    """A large value passed as a log argument; it is formatted and truncated only if the record is emitted"""
+    __slots__ = ('value', 'as_json')
+    
+    def __init__(self, value, as_json=False):
+        self.value = value
+        self.as_json = as_json
+    
+    def __str__(self):
+        if self.as_json:
+            text = json.dumps(self.value, ensure_ascii=False)
+        else:
+            text = self.value if isinstance(self.value, str) else str(self.value)
+        if len(text) <= LOG_MAX_PAYLOAD_CHARS:
+            return text
+        return f'{text[:LOG_MAX_PAYLOAD_CHARS]}... ({len(text) - LOG_MAX_PAYLOAD_CHARS} more characters)'
+
+def configure_logging():
+    """Send records through a queue so a background thread writes them to stdout"""
+    log = logging.getLogger('dify_flask')
+    log.setLevel(LOG_LEVEL)
+    log.propagate = False
+    
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == 'json':
+        stream_handler.setFormatter(JsonLogFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(correlation_id)s] %(message)s'))
+    
+    # 相関IDはログを出したスレッドで付ける必要があるので、フィルターはキューの手前に置く
+    queue_handler = QueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(CorrelationFilter())
+    log.addHandler(queue_handler)
+    
+    listener = QueueListener(queue_handler.queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return log
+
+logger = configure_logging()
+
+# SQLite接続設定（WALモードで読み取りと書き込みが互いにブロックしないようにする）
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL").upper()
+if SQLITE_SYNCHRONOUS not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+    SQLITE_SYNCHRONOUS = 'NORMAL'
+SQLITE_CACHE_SIZE_KB = max(0, int(os.getenv("SQLITE_CACHE_SIZE_KB", "16384")))
+
+db_local = local()
+
+def open_tuned_connection(**kwargs):
+    conn = sqlite3.connect('inventory_data.db', timeout=30, **kwargs)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute(f'PRAGMA synchronous={SQLITE_SYNCHRONOUS}')
+    # 負の値はKiB単位の指定になる
+    conn.execute(f'PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA foreign_keys=ON')
+    return conn
+
+def get_db_connection():
+    """Return this thread's SQLite connection, opening and tuning it on first use"""
+    conn = getattr(db_local, 'conn', None)
+    if conn is None:
+        conn = open_tuned_connection()
+        db_local.conn = conn
+    return conn
+
+def normalize_shipping_date(value):
+    """Convert YYYY-MM-DD or YY/MM/DD into the stored YY/MM/DD form"""
+    for fmt in ('%Y-%m-%d', '%y/%m/%d', '%Y/%m/%d'):
+        try:
+            return datetime.strptime(value, fmt).strftime('%y/%m/%d')
+        except ValueError:
+            continue
+    raise ValueError(f'Invalid shipping date: {value}')
+
+def normalize_key_part(value):
+    """Normalise one natural-key field (full-width forms, case and whitespace)"""
+    return re.sub(r'\s+', '', unicodedata.normalize('NFKC', str(value or ''))).upper()
+
+def basic_info_natural_key(page, shipping_date, order_number, delivery_number):
+    """Hash 受注番号 + 納入先番号 + 出荷日 + ページ into the key used for duplicate detection"""
+    shipping_date = normalize_key_part(shipping_date)
+    try:
+        shipping_date = normalize_shipping_date(shipping_date)
+    except ValueError:
+        pass
+    parts = [normalize_key_part(order_number), normalize_key_part(delivery_number),
+             shipping_date, normalize_key_part(page)]
+    return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+def parse_amount(value):
+    """Parse amounts like 1,000 / ¥1,000 / △500 into an int (float if fractional); None if not numeric"""
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return int(value) if float(value).is_integer() else value
+    text = re.sub(r'[\s,円¥]', '', unicodedata.normalize('NFKC', str(value)))
+    # 帳票のマイナス表記（△/▲）
+    if text[:1] in ('△', '▲'):
+        text = '-' + text[1:]
+    if not re.fullmatch(r'-?\d+(\.\d+)?', text):
+        return None
+    number = float(text) if '.' in text else int(text)
+    return int(number) if isinstance(number, float) and number.is_integer() else number
+
+# 月次集計テーブルと集計キーの列（仕入一覧の行を 出荷日の月 × キー で集計する）
+SUMMARY_TABLES = (
+    ('monthly_person_summary', '担当者'),
+    ('monthly_delivery_summary', '納入先番号'),
+)
+
+def shipping_month(shipping_date):
+    """Return YYYY-MM for a 出荷日 value, or '' when it cannot be parsed"""
+    try:
+        normalized = normalize_shipping_date(unicodedata.normalize('NFKC', str(shipping_date or '')).strip())
+    except ValueError:
+        return ''
+    return datetime.strptime(normalized, '%y/%m/%d').strftime('%Y-%m')
+
+def apply_summary_deltas(conn, rows, sign=1):
+    """Add (sign=1) or remove (sign=-1) rows of (出荷日, 担当者, 納入先番号, 税抜合計_円, 運賃) from the monthly summaries"""
+    rows = list(rows)
+    if not rows:
+        return
+    for table, column in SUMMARY_TABLES:
+        deltas = {}
+        for shipping_date, person, delivery_number, total_yen, freight in rows:
+            key = (shipping_month(shipping_date), person if column == '担当者' else delivery_number)
+            delta = deltas.setdefault(key, [0, 0, 0])
+            delta[0] += sign
+            delta[1] += sign * (total_yen or 0)
+            delta[2] += sign * (freight or 0)
+        conn.executemany(f'''
+            INSERT INTO {table} (month, {column}, row_count, total_yen, freight_yen)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (month, {column}) DO UPDATE SET
+                row_count = row_count + excluded.row_count,
+                total_yen = total_yen + excluded.total_yen,
+                freight_yen = freight_yen + excluded.freight_yen
+        ''', [key + tuple(delta) for key, delta in deltas.items()])
+        if sign < 0:
+            conn.execute(f'DELETE FROM {table} WHERE row_count <= 0')
+
 # データベースの初期化
 def init_database():
     conn = sqlite3.connect('inventory_data.db')
     cursor = conn.cursor()
     
+    # WALはデータベースファイルに記録されるので、以降の全接続（キュー用も含む）に効く
+    cursor.execute('PRAGMA journal_mode=WAL')
+    
     # 基本情報テーブルの作成
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS basic_info (
@@ -37,22 +277,1097 @@ def init_database():
         )
     ''')
     
+    # 重複検出用の自然キー（受注番号 + 納入先番号 + 出荷日 + ページ を正規化したハッシュ）
+    basic_info_columns = {row[1] for row in cursor.execute('PRAGMA table_info(basic_info)')}
+    if 'natural_key' not in basic_info_columns:
+        cursor.execute('ALTER TABLE basic_info ADD COLUMN natural_key TEXT')
+    # 重複を許可して保存した行もあるため、一意制約ではなく通常のインデックスにする
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_basic_info_natural_key ON basic_info (natural_key)')
+    missing_keys = cursor.execute('''
+        SELECT id, ページ, 出荷日, 受注番号, 納入先番号 FROM basic_info WHERE natural_key IS NULL
+    ''').fetchall()
+    cursor.executemany('UPDATE basic_info SET natural_key = ? WHERE id = ?', [
+        (basic_info_natural_key(page, shipping_date, order_number, delivery_number), row_id)
+        for row_id, page, shipping_date, order_number, delivery_number in missing_keys
+    ])
+    
+    # 税抜合計の数値（円）と運賃。文字列の税抜合計はそのまま残す
+    if '税抜合計_円' not in basic_info_columns:
+        cursor.execute('ALTER TABLE basic_info ADD COLUMN 税抜合計_円 INTEGER')
+        cursor.executemany('UPDATE basic_info SET 税抜合計_円 = ? WHERE id = ?', [
+            (parse_amount(total), row_id)
+            for row_id, total in cursor.execute('SELECT id, 税抜合計 FROM basic_info').fetchall()
+        ])
+    if '運賃' not in basic_info_columns:
+        cursor.execute('ALTER TABLE basic_info ADD COLUMN 運賃 INTEGER')
+    
+    # 明細行（部品番号・部品名・数量・売上単価・売上金額）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS line_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            basic_info_id INTEGER NOT NULL REFERENCES basic_info (id) ON DELETE CASCADE,
+            line_no INTEGER NOT NULL,
+            部品番号 TEXT,
+            部品名 TEXT,
+            数量 INTEGER,
+            売上単価 INTEGER,
+            売上金額 INTEGER,
+            UNIQUE (basic_info_id, line_no)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_line_items_part_number ON line_items (部品番号, 数量, 売上金額)')
+    
+    # 月次集計（保存・削除のたびに同じトランザクションで差分を反映する）
+    existing_tables = {row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    for table, column in SUMMARY_TABLES:
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                month TEXT NOT NULL,
+                {column} TEXT NOT NULL,
+                row_count INTEGER NOT NULL DEFAULT 0,
+                total_yen INTEGER NOT NULL DEFAULT 0,
+                freight_yen INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (month, {column})
+            )
+        ''')
+    # 集計テーブルを新しく作ったときだけ既存の行から一度集計する
+    if not all(table in existing_tables for table, _ in SUMMARY_TABLES):
+        for table, _ in SUMMARY_TABLES:
+            cursor.execute(f'DELETE FROM {table}')
+        apply_summary_deltas(conn, cursor.execute('SELECT 出荷日, 担当者, 納入先番号, 税抜合計_円, 運賃 FROM basic_info').fetchall())
+    
+    # 仕入一覧のキーセットページング（created_at, id）と絞り込み用のインデックス
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_basic_info_created_at ON basic_info (created_at, id)')
+    # 出荷日の範囲検索と期間ごとの合計を索引だけで処理できるよう税抜合計_円を含める
+    cursor.execute('DROP INDEX IF EXISTS idx_basic_info_shipping_date')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_basic_info_shipping_total ON basic_info (出荷日, 税抜合計_円)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_basic_info_person ON basic_info (担当者, created_at, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_basic_info_order_number ON basic_info (受注番号, created_at, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_basic_info_delivery_number ON basic_info (納入先番号, created_at, id)')
+    
+    # Dify分析結果のキャッシュ（ファイル内容のSHA-256 + ワークフローIDをキーに保存）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS dify_result_cache (
+            cache_key TEXT PRIMARY KEY,
+            file_hash TEXT NOT NULL,
+            workflow_id TEXT NOT NULL,
+            outputs TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_accessed_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_dify_result_cache_created_at ON dify_result_cache (created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_dify_result_cache_last_accessed_at ON dify_result_cache (last_accessed_at)')
+    
+    # 分析セッションとファイル単位のジョブ（複数プロセスで共有する永続キュー）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS processing_sessions (
+            session_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            total_files INTEGER NOT NULL,
+            processed_files INTEGER NOT NULL DEFAULT 0,
+            errors TEXT NOT NULL DEFAULT '[]',
+            bypass_cache INTEGER NOT NULL DEFAULT 0,
+            profile INTEGER NOT NULL DEFAULT 0,
+            version INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS processing_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            file_index INTEGER NOT NULL,
+            filename TEXT NOT NULL,
+            file_hash TEXT NOT NULL,
+            file_size INTEGER NOT NULL DEFAULT 0,
+            upload_file_id TEXT,
+            status TEXT NOT NULL,
+            duplicate_of INTEGER,
+            count_processed INTEGER NOT NULL DEFAULT 1,
+            claim_count INTEGER NOT NULL DEFAULT 0,
+            lease_owner TEXT,
+            lease_expires_at REAL,
+            queued_at REAL NOT NULL,
+            started_at REAL,
+            current_attempt INTEGER NOT NULL DEFAULT 0,
+            stage TEXT,
+            nodes_finished INTEGER NOT NULL DEFAULT 0,
+            last_event_at REAL,
+            workflow_run_id TEXT,
+            throttle_seconds REAL NOT NULL DEFAULT 0,
+            processed_size INTEGER,
+            result TEXT,
+            failed INTEGER,
+            result_extra TEXT,
+            result_seq INTEGER,
+            completed_at REAL,
+            elapsed_seconds REAL,
+            UNIQUE (session_id, file_index)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_processing_jobs_status ON processing_jobs (status, queued_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_processing_jobs_session_status ON processing_jobs (session_id, status)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_processing_jobs_session_seq ON processing_jobs (session_id, result_seq)')
+    # 既存のprocessing_jobsテーブルには後から追加した列を足す
+    job_columns = {row[1] for row in cursor.execute('PRAGMA table_info(processing_jobs)')}
+    if 'file_size' not in job_columns:
+        cursor.execute('ALTER TABLE processing_jobs ADD COLUMN file_size INTEGER NOT NULL DEFAULT 0')
+    if 'throttle_seconds' not in job_columns:
+        cursor.execute('ALTER TABLE processing_jobs ADD COLUMN throttle_seconds REAL NOT NULL DEFAULT 0')
+    if 'processed_size' not in job_columns:
+        cursor.execute('ALTER TABLE processing_jobs ADD COLUMN processed_size INTEGER')
+    session_columns = {row[1] for row in cursor.execute('PRAGMA table_info(processing_sessions)')}
+    if 'profile' not in session_columns:
+        cursor.execute('ALTER TABLE processing_sessions ADD COLUMN profile INTEGER NOT NULL DEFAULT 0')
+    
+    # セッション自動削除の累計（全プロセス共通）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS session_reaper_stats (
+            name TEXT PRIMARY KEY,
+            value REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    
     conn.commit()
     conn.close()
 
 # アプリケーション起動時にデータベースを初期化
 init_database()
 
-processing_sessions = {}
 session_lock = Lock()
+# このプロセス内でセッションの状態が変わったことをSSEストリームへ通知する（session_lockと共有）
+session_changed = Condition(session_lock)
+SSE_KEEPALIVE_SECONDS = 15
+# 他プロセスでの変更はDBのversionをこの間隔で確認して検知する
+SSE_POLL_SECONDS = 1
 
 DIFY_API_BASE_URL = os.getenv("DIFY_API_BASE_URL", "https://api.dify.ai")
 DIFY_API_KEY = os.getenv("DIFY_API_KEY")
 DIFY_WORKFLOW_ID = os.getenv("DIFY_WORKFLOW_ID")
 
+# 並列処理の設定: セッション内の同時実行数と、全セッション共通の同時実行上限
+DIFY_SESSION_WORKERS = max(1, int(os.getenv("DIFY_SESSION_WORKERS", "3")))
+DIFY_MAX_CONCURRENCY = max(1, int(os.getenv("DIFY_MAX_CONCURRENCY", "6")))
+
+# ジョブキューの設定: プロセスあたりのワーカースレッド数、リース期間（秒）、最大取得回数
+DIFY_QUEUE_WORKERS = max(0, int(os.getenv("DIFY_QUEUE_WORKERS", str(DIFY_MAX_CONCURRENCY))))
+DIFY_JOB_LEASE_SECONDS = max(5.0, float(os.getenv("DIFY_JOB_LEASE_SECONDS", "60")))
+DIFY_JOB_MAX_CLAIMS = max(1, int(os.getenv("DIFY_JOB_MAX_CLAIMS", "3")))
+DIFY_QUEUE_POLL_SECONDS = float(os.getenv("DIFY_QUEUE_POLL_SECONDS", "1"))
+# ジョブの実行方式: threads（ワーカースレッドごとに1件）または asyncio（1つのイベントループで
+# DIFY_QUEUE_WORKERS 件を同時に実行する）
+DIFY_DISPATCHER = os.getenv("DIFY_DISPATCHER", "threads").lower()
+# 明示的にasyncioを指定した場合は、スレッドで実行せずに起動を止める
+if DIFY_DISPATCHER == 'asyncio' and httpx is None:
+    raise RuntimeError('DIFY_DISPATCHER=asyncio requires httpx; install it with pip install -r requirements.txt')
+# このプロセスにキューへ積まれたジョブがあることをワーカーへ知らせる
+jobs_available = Condition(Lock())
+
+# 分析結果キャッシュの設定: 有効期限（秒）と最大保持件数
+DIFY_CACHE_ENABLED = os.getenv("DIFY_CACHE_ENABLED", "true").lower() not in ('0', 'false', 'no')
+DIFY_CACHE_TTL_SECONDS = int(os.getenv("DIFY_CACHE_TTL_SECONDS", str(7 * 24 * 60 * 60)))
+DIFY_CACHE_MAX_ENTRIES = max(1, int(os.getenv("DIFY_CACHE_MAX_ENTRIES", "5000")))
+
+# アップロードされたPNGの一時保存先（ファイル名は内容のSHA-256）。セッションには参照のみ保持する
+DIFY_SPOOL_DIR = os.getenv("DIFY_SPOOL_DIR", "upload_spool")
+SPOOL_CHUNK_SIZE = 64 * 1024
+
+# ZIP一括取込: リクエスト全体の上限（MB。通常の20MB制限の代わりに使う）と、展開後の1ファイルの上限（MB）
+DIFY_INGEST_MAX_MB = float(os.getenv("DIFY_INGEST_MAX_MB", "4096"))
+DIFY_INGEST_MAX_ENTRY_MB = float(os.getenv("DIFY_INGEST_MAX_ENTRY_MB", "20"))
+
+# アップロード前の画像前処理（グレースケール化・縮小・PNG再圧縮）。Pillowが必要
+DIFY_PREPROCESS_ENABLED = os.getenv("DIFY_PREPROCESS_ENABLED", "false").lower() in ('1', 'true', 'yes')
+DIFY_PREPROCESS_WORKERS = max(1, int(os.getenv("DIFY_PREPROCESS_WORKERS", str(max(1, (os.cpu_count() or 2) // 2)))))
+DIFY_PREPROCESS_MAX_EDGE = int(os.getenv("DIFY_PREPROCESS_MAX_EDGE", "2000"))
+DIFY_PREPROCESS_TARGET_DPI = int(os.getenv("DIFY_PREPROCESS_TARGET_DPI", "200"))
+DIFY_PREPROCESS_GRAYSCALE = os.getenv("DIFY_PREPROCESS_GRAYSCALE", "true").lower() not in ('0', 'false', 'no')
+DIFY_PREPROCESS_MAX_PIXELS = int(os.getenv("DIFY_PREPROCESS_MAX_PIXELS", "40000000"))
+# 前処理を指定したのに元の画像のまま送ることがないよう、Pillowがなければ起動を止める
+if DIFY_PREPROCESS_ENABLED and Image is None:
+    raise RuntimeError('DIFY_PREPROCESS_ENABLED requires Pillow; install it with pip install -r requirements.txt')
+
+# セッションの自動削除: 完了後の保持期間（秒）、保存量の上限（MB）、確認間隔（秒）
+DIFY_SESSION_TTL_SECONDS = float(os.getenv("DIFY_SESSION_TTL_SECONDS", str(24 * 60 * 60)))
+DIFY_SESSION_STORAGE_BUDGET_MB = float(os.getenv("DIFY_SESSION_STORAGE_BUDGET_MB", "512"))
+DIFY_SESSION_REAP_INTERVAL = max(1.0, float(os.getenv("DIFY_SESSION_REAP_INTERVAL", "60")))
+
+# Dify API接続の設定: コネクションプールのサイズとタイムアウト（秒）
+DIFY_POOL_SIZE = max(1, int(os.getenv("DIFY_POOL_SIZE", str(max(10, DIFY_MAX_CONCURRENCY)))))
+DIFY_CONNECT_TIMEOUT = float(os.getenv("DIFY_CONNECT_TIMEOUT", "30"))
+DIFY_UPLOAD_TIMEOUT = float(os.getenv("DIFY_UPLOAD_TIMEOUT", "30"))
+DIFY_READ_TIMEOUT = float(os.getenv("DIFY_READ_TIMEOUT", "300"))
+
+# ワークフローの応答モード: blocking（従来）または streaming（SSEでノード単位の進捗を受信）
+DIFY_RESPONSE_MODE = os.getenv("DIFY_RESPONSE_MODE", "blocking").lower()
+if DIFY_RESPONSE_MODE not in ('blocking', 'streaming'):
+    logger.warning("unknown DIFY_RESPONSE_MODE '%s', falling back to blocking", DIFY_RESPONSE_MODE)
+    DIFY_RESPONSE_MODE = 'blocking'
+# streamingモードでこの秒数イベント（pingを含む）が届かなければ停止とみなす
+DIFY_STREAM_IDLE_TIMEOUT = float(os.getenv("DIFY_STREAM_IDLE_TIMEOUT", "60"))
+# ping・text_chunk等の受信時刻（last_event_at）をDBへ書き込む最短間隔（秒）
+STREAM_HEARTBEAT_WRITE_SECONDS = 5
+
+# 失敗時の再試行: 最大試行回数と指数バックオフの基準・上限（秒）
+DIFY_RETRY_MAX_ATTEMPTS = max(1, int(os.getenv("DIFY_RETRY_MAX_ATTEMPTS", "3")))
+DIFY_RETRY_BASE_DELAY = float(os.getenv("DIFY_RETRY_BASE_DELAY", "1"))
+DIFY_RETRY_MAX_DELAY = float(os.getenv("DIFY_RETRY_MAX_DELAY", "30"))
+# サーキットブレーカー: 直近の集計期間（秒）・最小呼び出し数・エラー率の閾値・停止時間（秒）
+DIFY_BREAKER_WINDOW_SECONDS = float(os.getenv("DIFY_BREAKER_WINDOW_SECONDS", "60"))
+DIFY_BREAKER_MIN_CALLS = max(1, int(os.getenv("DIFY_BREAKER_MIN_CALLS", "5")))
+DIFY_BREAKER_ERROR_RATE = float(os.getenv("DIFY_BREAKER_ERROR_RATE", "0.5"))
+DIFY_BREAKER_OPEN_SECONDS = float(os.getenv("DIFY_BREAKER_OPEN_SECONDS", "30"))
+# 流量制限: 毎秒のリクエスト数の初期値・上限・下限（同時実行数の上限はDIFY_MAX_CONCURRENCY）
+DIFY_RATE_LIMIT_RPS = float(os.getenv("DIFY_RATE_LIMIT_RPS", "5"))
+DIFY_RATE_LIMIT_MAX_RPS = max(DIFY_RATE_LIMIT_RPS, float(os.getenv("DIFY_RATE_LIMIT_MAX_RPS", "20")))
+DIFY_RATE_LIMIT_MIN_RPS = max(0.01, float(os.getenv("DIFY_RATE_LIMIT_MIN_RPS", "0.2")))
+
+class DifyCallError(Exception):
+    """A failed Dify call, classified for the retry policy and the circuit breaker
+    
+    retryable: another attempt may succeed (timeouts, connection errors, 429/5xx, unusable output)
+    service_failure: the failure says Dify itself is unhealthy and counts towards the breaker
+    reupload: the upload_file_id was rejected and the file has to be uploaded again
+    status_code: the HTTP status Dify answered with, if it answered
+    reason: short label for metrics ('timeout', 'connection', ...); derived from the status when omitted
+    """
+    
+    def __init__(self, message, retryable=True, service_failure=True, retry_after=None, reupload=False,
+                 status_code=None, reason=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.reason = reason
+        self.retryable = retryable
+        self.service_failure = service_failure
+        self.retry_after = retry_after
+        self.reupload = reupload
+    
+    def metric_reason(self):
+        if self.reason:
+            return self.reason
+        if self.reupload:
+            return 'reupload'
+        if self.status_code == 200:
+            return 'invalid_output'
+        if self.status_code:
+            return f'http_{self.status_code}'
+        return 'error'
+
+# 再試行するHTTPステータス（その他の4xxは設定や入力の誤りなので即座に失敗とする）
+RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP-date), or None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def dify_http_error(message, response):
+    """Classify a non-success Dify response as a DifyCallError"""
+    status_code = response.status_code
+    retryable = status_code in RETRYABLE_STATUS_CODES or status_code >= 500
+    retry_after = None
+    if status_code in (429, 503):
+        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+    return DifyCallError(
+        f'{message}: {status_code}', retryable=retryable, service_failure=retryable,
+        retry_after=retry_after, status_code=status_code
+    )
+
+class RetryPolicy:
+    """Exponential backoff with full jitter; a Retry-After from Dify takes precedence"""
+    
+    def __init__(self, max_attempts=3, base_delay=1.0, max_delay=30.0, max_retry_after=300.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+    
+    def delay(self, attempt, retry_after=None):
+        """Seconds to wait after the given failed attempt (1-based)"""
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+class CircuitBreaker:
+    """Pause every Dify call in the process while the recent error rate is too high
+    
+    closed: calls run; once min_calls calls within window_seconds failed at
+    error_rate or more, the breaker opens.
+    open: calls wait for open_seconds (or a longer Retry-After).
+    half_open: a single probe call runs; its outcome closes or reopens the breaker.
+    """
+    
+    def __init__(self, window_seconds=60, min_calls=5, error_rate=0.5, open_seconds=30):
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.open_seconds = open_seconds
+        self.lock = Lock()
+        self.calls = deque()
+        self.state = 'closed'
+        self.open_until = 0.0
+        self.probe_in_flight = False
+        self.trips = 0
+    
+    def before_call(self):
+        """Return (seconds to wait before asking again, whether the call is the half-open probe)
+        
+        A call may start when the wait is 0. The probe must end in record() or release_probe().
+        """
+        with self.lock:
+            now = time.time()
+            if self.state == 'open':
+                if now < self.open_until:
+                    return self.open_until - now, False
+                self.state = 'half_open'
+                self.probe_in_flight = False
+            if self.state == 'half_open':
+                if self.probe_in_flight:
+                    return 1.0, False
+                self.probe_in_flight = True
+                return 0.0, True
+            return 0.0, False
+    
+    def release_probe(self):
+        """Let another call probe when the probe ended without an outcome, recording nothing"""
+        with self.lock:
+            if self.state == 'half_open':
+                self.probe_in_flight = False
+    
+    def record(self, success):
+        """Record the outcome of a call that before_call let through"""
+        with self.lock:
+            now = time.time()
+            if self.state == 'half_open':
+                if success:
+                    logger.info('Dify circuit breaker closed')
+                    self.state = 'closed'
+                    self.calls.clear()
+                    self.probe_in_flight = False
+                else:
+                    self._open(now, self.open_seconds)
+                return
+            if self.state == 'open':
+                return
+            
+            self.calls.append((now, success))
+            while self.calls and self.calls[0][0] < now - self.window_seconds:
+                self.calls.popleft()
+            failures = sum(1 for _, ok in self.calls if not ok)
+            if len(self.calls) >= self.min_calls and failures >= self.error_rate * len(self.calls):
+                self._open(now, self.open_seconds)
+    
+    def hold_open(self, seconds):
+        """Pause all calls for at least the given seconds, e.g. for a Retry-After"""
+        with self.lock:
+            self._open(time.time(), seconds)
+    
+    def is_open(self):
+        with self.lock:
+            return self.state == 'open' and time.time() < self.open_until
+    
+    def _open(self, now, seconds):
+        if self.state != 'open':
+            self.trips += 1
+            logger.warning('Dify circuit breaker opened for %.1fs', seconds)
+        self.state = 'open'
+        self.open_until = max(self.open_until, now + seconds)
+        self.calls.clear()
+        self.probe_in_flight = False
+    
+    def snapshot(self):
+        with self.lock:
+            return {
+                'state': self.state,
+                'open_remaining_seconds': round(max(0.0, self.open_until - time.time()), 1) if self.state == 'open' else 0,
+                'recent_calls': len(self.calls),
+                'recent_failures': sum(1 for _, ok in self.calls if not ok),
+                'trips': self.trips
+            }
+
+class AdaptiveRateLimiter:
+    """Token bucket (requests/second) plus a concurrency limit that adapt to Dify, AIMD-style
+    
+    Both limits grow additively while calls succeed and are cut multiplicatively
+    on 429 responses or when latency climbs well above its usual level.
+    reserve() only books a token and returns how long to wait, so synchronous
+    callers can sleep and asynchronous ones await the delay instead.
+    """
+    
+    def __init__(self, rate, max_rate, min_rate, max_concurrency, decrease_factor=0.5,
+                 latency_factor=2.0, latency_margin=1.0, decrease_cooldown=5.0):
+        self.rate = rate
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.concurrency = float(max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.decrease_factor = decrease_factor
+        self.latency_factor = latency_factor
+        # 数ミリ秒程度の揺らぎで絞らないよう、悪化とみなす最小の増加幅（秒）
+        self.latency_margin = latency_margin
+        self.decrease_cooldown = decrease_cooldown
+        
+        self.lock = Lock()
+        self.slot_freed = Condition(self.lock)
+        self.tokens = max(1.0, rate)
+        self.refilled_at = time.monotonic()
+        self.in_flight = 0
+        # 呼び出し種別ごとのレイテンシ（短期・長期の指数移動平均）
+        self.latency = {}
+        self.last_decrease_at = 0.0
+        self.decreases = 0
+        self.throttle_wait_seconds = 0.0
+    
+    @property
+    def concurrency_limit(self):
+        return max(1, int(self.concurrency))
+    
+    def reserve(self):
+        """Take a token and return the seconds the caller must wait before using it"""
+        with self.lock:
+            now = time.monotonic()
+            burst = max(1.0, self.rate)
+            self.tokens = min(burst, self.tokens + (now - self.refilled_at) * self.rate)
+            self.refilled_at = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.throttle_wait_seconds += delay
+            return delay
+    
+    def try_acquire_slot(self):
+        with self.lock:
+            if self.in_flight < self.concurrency_limit:
+                self.in_flight += 1
+                return True
+            return False
+    
+    def record_slot_wait(self, seconds):
+        """Count a wait for a slot taken with try_acquire_slot (the asyncio dispatcher polls instead of blocking)"""
+        with self.lock:
+            self.throttle_wait_seconds += seconds
+        return seconds
+    
+    def acquire_slot(self):
+        """Block until a concurrency slot is free and return the seconds waited"""
+        started = time.monotonic()
+        with self.lock:
+            while self.in_flight >= self.concurrency_limit:
+                self.slot_freed.wait(timeout=1.0)
+            self.in_flight += 1
+            waited = time.monotonic() - started
+            self.throttle_wait_seconds += waited
+            return waited
+    
+    def release(self, kind, latency=None, throttled=False):
+        """Free the slot and adapt the limits; latency is None when the call failed"""
+        with self.lock:
+            self.in_flight -= 1
+            if throttled:
+                self._decrease('429')
+            elif latency is not None:
+                fast, slow = self.latency.get(kind, (latency, latency))
+                fast = 0.5 * fast + 0.5 * latency
+                slow = 0.95 * slow + 0.05 * latency
+                self.latency[kind] = (fast, slow)
+                if fast > slow * self.latency_factor and fast - slow > self.latency_margin:
+                    self._decrease(f'{kind} latency {fast:.1f}s')
+                else:
+                    self._increase()
+            self.slot_freed.notify_all()
+    
+    def _increase(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 50)
+        self.concurrency = min(float(self.max_concurrency), self.concurrency + 1 / self.concurrency_limit)
+    
+    def _decrease(self, reason):
+        now = time.monotonic()
+        if now - self.last_decrease_at < self.decrease_cooldown:
+            return
+        self.last_decrease_at = now
+        self.decreases += 1
+        self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+        self.concurrency = max(1.0, self.concurrency * self.decrease_factor)
+        logger.warning('Dify rate limit lowered (%s): %.2f req/s, %s concurrent', reason, self.rate, self.concurrency_limit)
+    
+    def snapshot(self):
+        with self.lock:
+            return {
+                'requests_per_second': round(self.rate, 2),
+                'concurrency_limit': self.concurrency_limit,
+                'in_flight': self.in_flight,
+                'throttle_wait_seconds': round(self.throttle_wait_seconds, 1),
+                'decreases': self.decreases
+            }
+
+def format_metric_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+class Metric:
+    """A Prometheus metric with labels, kept in this process's memory and rendered by /metrics"""
+    metric_type = None
+    
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = Lock()
+        self.values = {}
+        metrics_registry.append(self)
+    
+    def key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+    
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.metric_type}']
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.extend(self.render_value(labels, value))
+        return lines
+    
+    def render_value(self, labels, value):
+        return [f'{self.name}{format_metric_labels(self.labelnames, labels)} {value:g}']
+
+class Counter(Metric):
+    metric_type = 'counter'
+    
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+    
+    def render_value(self, labels, value):
+        return [f'{self.name}_total{format_metric_labels(self.labelnames, labels)} {value:g}']
+
+class Gauge(Metric):
+    metric_type = 'gauge'
+    
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+    
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+    
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+    
+    def replace(self, values):
+        """Set every series at once from {label tuple: value}, dropping the others"""
+        with self.lock:
+            self.values = {tuple(str(v) for v in labels): value for labels, value in values.items()}
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+    
+    def __init__(self, name, documentation, labelnames=(), buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+    
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # バケットごとの件数、合計、件数
+                counts = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][i] += 1
+            counts[1] += value
+            counts[2] += 1
+    
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the with block; the yielded dict's labels can be changed inside it"""
+        observed = dict(labels)
+        started = time.monotonic()
+        try:
+            yield observed
+        finally:
+            self.observe(time.monotonic() - started, **observed)
+    
+    def render_value(self, labels, value):
+        bucket_counts, total, count = value
+        lines = [
+            f'{self.name}_bucket{format_metric_labels(self.labelnames, labels, [("le", f"{bound:g}")])} {n}'
+            for bound, n in zip(self.buckets, bucket_counts)
+        ]
+        lines.append(f'{self.name}_bucket{format_metric_labels(self.labelnames, labels, [("le", "+Inf")])} {count}')
+        lines.append(f'{self.name}_sum{format_metric_labels(self.labelnames, labels)} {total:g}')
+        lines.append(f'{self.name}_count{format_metric_labels(self.labelnames, labels)} {count}')
+        return lines
+
+metrics_registry = []
+
+class MultipartFileBody:
+    """multipart/form-data request body that reads the file part as it is sent
+    
+    requests builds the whole body in memory for files=; http.client instead
+    sends any object with read() in small blocks, and __len__ supplies the
+    Content-Length, so a file on disk is streamed without being loaded.
+    """
+    
+    def __init__(self, fields, file_field, file_obj, filename, mimetype):
+        boundary = uuid.uuid4().hex
+        preamble = ''.join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+            for name, value in fields.items()
+        )
+        preamble += (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+            f'Content-Type: {mimetype}\r\n\r\n'
+        )
+        epilogue = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+        preamble = preamble.encode('utf-8')
+        
+        file_obj.seek(0, os.SEEK_END)
+        file_size = file_obj.tell()
+        file_obj.seek(0)
+        
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        self.length = len(preamble) + file_size + len(epilogue)
+        self.parts = [BytesIO(preamble), file_obj, BytesIO(epilogue)]
+    
+    def __len__(self):
+        return self.length
+    
+    def read(self, size=-1):
+        chunks = []
+        while self.parts and size != 0:
+            chunk = self.parts[0].read(size)
+            if not chunk:
+                self.parts.pop(0)
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(chunks)
+
+class ZipStreamReader:
+    """Read a ZIP archive front to back from a non-seekable stream
+    
+    zipfile needs the central directory at the end of the file, so it cannot
+    start before the whole upload has arrived. This reader walks the local file
+    headers instead and hands out each entry as a file-like object while the
+    rest of the archive is still being received. Entries must be read in order.
+    Stored and deflated entries are supported, including data descriptors and
+    ZIP64 sizes; stored entries must carry their size in the local header.
+    Entries the caller does not read to the end are skipped without a size limit.
+    """
+    
+    LOCAL_HEADER = struct.Struct('<HHHHHIIIHH')
+    LOCAL_HEADER_SIGNATURE = 0x04034b50
+    DATA_DESCRIPTOR_SIGNATURE = 0x08074b50
+    END_SIGNATURES = (0x02014b50, 0x06054b50, 0x06064b50)
+    
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = b''
+    
+    def read_raw(self, size):
+        """Read up to size bytes of the archive, using pushed-back bytes first"""
+        if self.buffer:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+            return data
+        return self.stream.read(size)
+    
+    def read_exact(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.read_raw(size - len(data))
+            if not chunk:
+                raise ValueError('ZIPファイルが途中で終わっています')
+            data += chunk
+        return data
+    
+    def unread(self, data):
+        self.buffer = data + self.buffer
+    
+    def entries(self):
+        """Yield (filename, entry) for every file in the archive"""
+        while True:
+            signature = self.read_raw(4)
+            if not signature:
+                return
+            if len(signature) < 4:
+                signature += self.read_exact(4 - len(signature))
+            signature = struct.unpack('<I', signature)[0]
+            if signature in self.END_SIGNATURES:
+                return
+            if signature != self.LOCAL_HEADER_SIGNATURE:
+                raise ValueError('ZIPファイルの形式が正しくありません')
+            
+            (_, flags, method, _, _, crc, compressed_size, size,
+             name_length, extra_length) = self.LOCAL_HEADER.unpack(self.read_exact(self.LOCAL_HEADER.size))
+            raw_name = self.read_exact(name_length)
+            extra = self.read_exact(extra_length)
+            zip64 = False
+            if compressed_size == 0xFFFFFFFF or size == 0xFFFFFFFF:
+                size, compressed_size = self.zip64_sizes(extra, size, compressed_size)
+                zip64 = True
+            
+            if flags & 0x1:
+                raise ValueError('暗号化されたZIPファイルには対応していません')
+            has_descriptor = bool(flags & 0x8)
+            if method not in (0, 8) or (method == 0 and has_descriptor):
+                raise ValueError(f'対応していない圧縮形式のZIPファイルです (method={method})')
+            
+            # UTF-8フラグが無い場合、日本語Windowsで作られたZIPはShift_JIS（cp932）のことが多い
+            if flags & 0x800:
+                filename = raw_name.decode('utf-8', errors='replace')
+            else:
+                try:
+                    filename = raw_name.decode('cp932')
+                except UnicodeDecodeError:
+                    filename = raw_name.decode('cp437')
+            
+            entry = ZipEntryStream(self, method, None if has_descriptor else compressed_size,
+                                   None if has_descriptor else size)
+            yield filename, entry
+            entry.skip()
+            
+            if has_descriptor:
+                descriptor = self.read_exact(4)
+                if struct.unpack('<I', descriptor)[0] == self.DATA_DESCRIPTOR_SIGNATURE:
+                    descriptor = self.read_exact(4)
+                crc = struct.unpack('<I', descriptor)[0]
+                self.read_exact(16 if zip64 else 8)
+            # 圧縮データのまま読み飛ばしたエントリはCRCを確認できない
+            if entry.crc is not None and entry.crc != crc:
+                raise ValueError(f'{filename}: ZIPファイルが破損しています（CRC不一致）')
+    
+    @staticmethod
+    def zip64_sizes(extra, size, compressed_size):
+        offset = 0
+        while offset + 4 <= len(extra):
+            header_id, length = struct.unpack_from('<HH', extra, offset)
+            if header_id == 0x0001:
+                values = extra[offset + 4:offset + 4 + length]
+                position = 0
+                if size == 0xFFFFFFFF:
+                    size = struct.unpack_from('<Q', values, position)[0]
+                    position += 8
+                if compressed_size == 0xFFFFFFFF:
+                    compressed_size = struct.unpack_from('<Q', values, position)[0]
+                return size, compressed_size
+            offset += 4 + length
+        raise ValueError('ZIP64のサイズ情報が見つかりません')
+
+class ZipEntryTooLarge(ValueError):
+    """An entry grew past the max_size set on its ZipEntryStream; the rest of the archive is still readable"""
+
+class ZipEntryStream:
+    """File-like view of one ZIP entry's uncompressed bytes, read from a ZipStreamReader
+    
+    Set max_size before reading to raise ZipEntryTooLarge once the entry
+    exceeds it. declared_size is the size from the local header, or None when
+    the entry uses a data descriptor.
+    """
+    
+    def __init__(self, reader, method, compressed_size, declared_size=None):
+        self.reader = reader
+        self.remaining = compressed_size
+        self.declared_size = declared_size
+        self.max_size = None
+        self.decompressor = zlib.decompressobj(-15) if method == 8 else None
+        self.pending = b''
+        self.size = 0
+        self.crc = 0
+        self.finished = False
+    
+    def read_compressed(self):
+        size = SPOOL_CHUNK_SIZE if self.remaining is None else min(SPOOL_CHUNK_SIZE, self.remaining)
+        if size == 0:
+            return b''
+        data = self.reader.read_raw(size)
+        if not data:
+            raise ValueError('ZIPファイルが途中で終わっています')
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        return data
+    
+    def read(self, size=-1):
+        if self.max_size is not None and (self.declared_size or 0) > self.max_size:
+            raise ZipEntryTooLarge('ZIP内のファイルが大きすぎます')
+        while not self.pending and not self.finished:
+            if self.decompressor is None:
+                self.pending = self.read_compressed()
+                self.finished = not self.pending
+                continue
+            if self.decompressor.eof:
+                # 次のエントリのヘッダーまで読み込んでいた分は戻す
+                self.reader.unread(self.decompressor.unused_data)
+                self.finished = True
+                continue
+            data = self.read_compressed()
+            if not data:
+                raise ValueError('ZIPファイルが途中で終わっています')
+            self.pending = self.decompressor.decompress(data)
+        
+        if size is None or size < 0:
+            size = len(self.pending)
+        data, self.pending = self.pending[:size], self.pending[size:]
+        self.size += len(data)
+        # 上限を超えた後も読み飛ばして続けるため、CRCは先に更新しておく
+        self.crc = zlib.crc32(data, self.crc)
+        if self.max_size is not None and self.size > self.max_size:
+            raise ZipEntryTooLarge('ZIP内のファイルが大きすぎます')
+        return data
+    
+    def skip(self):
+        """Move the reader past the rest of the entry, whatever its size"""
+        self.max_size = None
+        if self.finished:
+            return
+        if self.remaining is not None:
+            # 圧縮サイズが分かっていれば展開せずに読み飛ばす
+            while self.read_compressed():
+                pass
+            self.pending = b''
+            self.finished = True
+            self.crc = None
+            return
+        while self.read(SPOOL_CHUNK_SIZE):
+            pass
+
+class DifyClient:
+    """Dify API client sharing one pooled keep-alive HTTP session across all calls"""
+    
+    def __init__(self, base_url, api_key, pool_size=10, connect_timeout=30, upload_timeout=30,
+                 read_timeout=300, stream_idle_timeout=60, user='dify-flask-app'):
+        self.base_url = base_url.rstrip('/')
+        self.user = user
+        self.connect_timeout = connect_timeout
+        self.upload_timeout = upload_timeout
+        self.read_timeout = read_timeout
+        self.stream_idle_timeout = stream_idle_timeout
+        
+        self.session = requests.Session()
+        # pool_block: 接続が埋まっている場合は使い捨て接続を作らず空きを待つ
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        if api_key:
+            self.session.headers['Authorization'] = f'Bearer {api_key}'
+    
+    def upload_file(self, file_obj, filename, mimetype='image/png'):
+        """POST the file to /v1/files/upload, streaming it from file_obj, and return the raw response"""
+        file_obj.seek(0)
+        body = MultipartFileBody({'user': self.user}, 'file', file_obj, filename, mimetype)
+        return self.session.post(
+            f"{self.base_url}/v1/files/upload",
+            data=body,
+            headers={'Content-Type': body.content_type},
+            timeout=(self.connect_timeout, self.upload_timeout)
+        )
+    
+    def workflow_payload(self, upload_file_id, response_mode='blocking'):
+        """Build the /v1/workflows/run payload for an uploaded image"""
+        return {
+            "inputs": {
+                "input_file": {
+                    "type": "image",
+                    "transfer_method": "local_file", 
+                    "upload_file_id": upload_file_id
+                }
+            },
+            "response_mode": response_mode,
+            "user": self.user
+        }
+    
+    def run_workflow(self, workflow_payload):
+        """POST the payload to /v1/workflows/run and return the raw response
+        
+        In streaming mode the body is left unread and the read timeout becomes
+        the maximum silence between two SSE events instead of the whole run.
+        """
+        stream = workflow_payload.get('response_mode') == 'streaming'
+        return self.session.post(
+            f"{self.base_url}/v1/workflows/run",
+            json=workflow_payload,
+            timeout=(self.connect_timeout, self.stream_idle_timeout if stream else self.read_timeout),
+            stream=stream
+        )
+    
+    def iter_events(self, response):
+        """Yield the decoded SSE events of a streaming workflow response"""
+        decoder = SseDecoder()
+        for raw_line in response.iter_lines():
+            event = decoder.feed(raw_line)
+            if event is not None:
+                yield event
+        event = decoder.finish()
+        if event is not None:
+            yield event
+
+class SseDecoder:
+    """Turn Server-Sent Events lines into decoded events, one line at a time"""
+    
+    def __init__(self):
+        self.event_name = None
+        self.data_lines = []
+    
+    def feed(self, line):
+        """Take one line; return the completed event when the line ends one, else None"""
+        line = line.decode('utf-8') if isinstance(line, bytes) else line
+        if not line:
+            return self.finish()
+        if line.startswith('data:'):
+            self.data_lines.append(line[5:].lstrip())
+        elif line.startswith('event:'):
+            self.event_name = line[6:].strip()
+        return None
+    
+    def finish(self):
+        event = None
+        if self.data_lines:
+            event = json.loads('\n'.join(self.data_lines))
+        elif self.event_name:
+            event = {'event': self.event_name}
+        self.event_name = None
+        self.data_lines = []
+        return event
+
+dify_client = DifyClient(
+    DIFY_API_BASE_URL,
+    DIFY_API_KEY,
+    pool_size=DIFY_POOL_SIZE,
+    connect_timeout=DIFY_CONNECT_TIMEOUT,
+    upload_timeout=DIFY_UPLOAD_TIMEOUT,
+    read_timeout=DIFY_READ_TIMEOUT,
+    stream_idle_timeout=DIFY_STREAM_IDLE_TIMEOUT
+)
+
+dify_retry_policy = RetryPolicy(
+    max_attempts=DIFY_RETRY_MAX_ATTEMPTS,
+    base_delay=DIFY_RETRY_BASE_DELAY,
+    max_delay=DIFY_RETRY_MAX_DELAY
+)
+# 429やレイテンシの悪化に合わせて自動で絞り、成功が続けば緩める
+dify_rate_limiter = AdaptiveRateLimiter(
+    rate=DIFY_RATE_LIMIT_RPS,
+    max_rate=DIFY_RATE_LIMIT_MAX_RPS,
+    min_rate=DIFY_RATE_LIMIT_MIN_RPS,
+    max_concurrency=DIFY_MAX_CONCURRENCY
+)
+# 全ワーカースレッドで共有し、Difyの障害時はまとめて待機させる
+dify_breaker = CircuitBreaker(
+    window_seconds=DIFY_BREAKER_WINDOW_SECONDS,
+    min_calls=DIFY_BREAKER_MIN_CALLS,
+    error_rate=DIFY_BREAKER_ERROR_RATE,
+    open_seconds=DIFY_BREAKER_OPEN_SECONDS
+)
+
+# /metrics で公開する処理段階ごとの計測値（プロセスごと）
+FAST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+dify_call_seconds = Histogram(
+    'dify_call_duration_seconds', 'Duration of one Dify HTTP call (upload or one workflow attempt)', ('kind', 'outcome')
+)
+dify_throttle_seconds = Histogram(
+    'dify_throttle_wait_seconds', 'Time spent waiting for the rate limiter before a Dify call', ('kind',)
+)
+dify_retries = Counter('dify_retries', 'Dify attempts that failed and were retried, by reason', ('reason',))
+json_extraction_seconds = Histogram(
+    'json_extraction_duration_seconds', 'Time to parse the workflow text into extracted_data', buckets=FAST_BUCKETS
+)
+queue_wait_seconds = Histogram('queue_wait_seconds', 'Time a job waited in the queue before a worker claimed it')
+job_seconds = Histogram(
+    'job_duration_seconds', 'Time from claiming a job to recording its result', ('outcome',)
+)
+jobs_in_flight = Gauge('jobs_in_flight', 'Jobs being processed by this process')
+queue_jobs = Gauge('queue_jobs', 'Jobs in the shared queue by status (read at scrape time)', ('status',))
+db_save_seconds = Histogram(
+    'analysis_save_duration_seconds', 'Database transaction time for saving analysis results', ('mode',),
+    buckets=FAST_BUCKETS
+)
+db_saved_rows = Counter('analysis_saved_rows', 'basic_info rows written by saves', ('action',))
+
+# プロファイリング: PROFILING_ENABLED=true の場合のみ、X-Profileヘッダーまたは?profile=で指定したリクエストと、
+# そのリクエストで開始したセッションのジョブをcProfileで計測する
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() in ('1', 'true', 'yes')
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN", "")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_MAX_FILES = max(1, int(os.getenv("PROFILE_MAX_FILES", "50")))
+profile_files_lock = Lock()
+
+def profiling_requested():
+    """Whether the current request asks to be profiled (and may, given PROFILING_TOKEN)"""
+    if not PROFILING_ENABLED:
+        return False
+    value = request.headers.get('X-Profile') or request.args.get('profile')
+    if not value:
+        return False
+    return value == PROFILING_TOKEN if PROFILING_TOKEN else value.lower() in ('1', 'true', 'yes')
+
+def start_profiler():
+    """Start a cProfile profiler for this thread, or return None if another profiler is active"""
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # Python 3.12以降は同時に1つのプロファイラしか有効にできない
+        logger.warning('Profiling skipped: %s', e)
+        return None
+    return profiler
+
+def save_profile(profiler, kind, label, wall_seconds, **details):
+    """Write the pstats file and a JSON sidecar, keeping only the newest PROFILE_MAX_FILES profiles"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    created_at = time.time()
+    slug = re.sub(r'[^A-Za-z0-9_.-]+', '_', label)[:60]
+    name = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(created_at))}-{kind}-{slug}-{uuid.uuid4().hex[:6]}"
+    profiler.dump_stats(os.path.join(PROFILE_DIR, f'{name}.prof'))
+    with open(os.path.join(PROFILE_DIR, f'{name}.json'), 'w', encoding='utf-8') as f:
+        json.dump({
+            'name': name, 'kind': kind, 'label': label, 'created_at': created_at,
+            'wall_seconds': round(wall_seconds, 4), **details
+        }, f, ensure_ascii=False)
+    
+    with profile_files_lock:
+        profiles = sorted(glob.glob(os.path.join(PROFILE_DIR, '*.prof')), key=os.path.getmtime, reverse=True)
+        for path in profiles[PROFILE_MAX_FILES:]:
+            for old in (path, path[:-len('.prof')] + '.json'):
+                try:
+                    os.remove(old)
+                except FileNotFoundError:
+                    pass
+    logger.info('Saved %s profile %s (%.3fs)', kind, name, wall_seconds)
+    return name
+
+@contextmanager
+def profiled(kind, label, **details):
+    """Profile the with block on this thread and save the result"""
+    profiler = start_profiler()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            try:
+                save_profile(profiler, kind, label, time.perf_counter() - started, **details)
+            except Exception as e:
+                logger.error('Failed to save profile: %s', e)
+
 if not DIFY_API_KEY or not DIFY_WORKFLOW_ID:
-    print("Warning: DIFY_API_KEY and DIFY_WORKFLOW_ID environment variables must be set")
-    print("Please copy .env.example to .env and update with your actual values")
+    logger.warning('DIFY_API_KEY and DIFY_WORKFLOW_ID environment variables must be set')
+    logger.warning('Please copy .env.example to .env and update with your actual values')
 
 @app.route('/')
 def index():
@@ -159,6 +1474,8 @@ def analyze_images_sequential():
             return jsonify({'error': 'ファイルが選択されていません'}), 400
         
         session_id = str(uuid.uuid4())
+        # force_reanalyze が指定された場合はキャッシュを使わずに再分析する
+        bypass_cache = request.form.get('force_reanalyze', '').lower() in ('1', 'true', 'yes')
         
         valid_files = []
         errors = []
@@ -173,8 +1490,12 @@ def analyze_images_sequential():
             
             filename = secure_filename(file.filename)
             file.seek(0)
-            file_data = file.read()
-            valid_files.append({'file_data': file_data, 'filename': filename})
+            file_hash, file_size = spool_upload(file.stream)
+            valid_files.append({
+                'filename': filename,
+                'file_hash': file_hash,
+                'file_size': file_size
+            })
         
         if len(valid_files) == 0:
             return jsonify({
@@ -182,25 +1503,7 @@ def analyze_images_sequential():
                 'errors': errors
             }), 400
         
-        with session_lock:
-            processing_sessions[session_id] = {
-                'total_files': len(valid_files),
-                'processed_files': 0,
-                'results': [],
-                'errors': errors,
-                'status': 'processing',
-                'created_at': time.time(),
-                'current_processing': None,
-                'original_files': valid_files
-            }
-        
-        import threading
-        thread = threading.Thread(
-            target=process_files_sequential, 
-            args=(valid_files, session_id)
-        )
-        thread.daemon = True
-        thread.start()
+        enqueue_session(session_id, valid_files, errors, bypass_cache, g.profile_request)
         
         return jsonify({
             'success': True,
@@ -212,463 +1515,2102 @@ def analyze_images_sequential():
     except Exception as e:
         return jsonify({'error': f'エラーが発生しました: {str(e)}'}), 500
 
+ZIP_MIMETYPES = ('application/zip', 'application/x-zip-compressed', 'application/octet-stream')
+
+@app.route('/api/dify/ingest', methods=['POST'])
+def ingest_archive():
+    """PNGの納品書をまとめたZIPを受信しながら、1ファイルずつ分析キューに追加する
+    
+    リクエスト本体はZIPファイルそのもの（chunked転送も可）。20MBの通常の上限の代わりに
+    DIFY_INGEST_MAX_MB を適用し、受信済みのファイルはアーカイブの残りを待たずに分析を始める。
+    """
+    if request.mimetype not in ZIP_MIMETYPES:
+        return jsonify({'error': 'ZIPファイルをリクエスト本体として送信してください（Content-Type: application/zip）'}), 415
+    request.max_content_length = int(DIFY_INGEST_MAX_MB * 1024 * 1024)
+    bypass_cache = request.args.get('force_reanalyze', '').lower() in ('1', 'true', 'yes')
+    
+    session_id = str(uuid.uuid4())
+    with queue_transaction() as conn:
+        create_session(conn, session_id, [], bypass_cache, g.profile_request)
+    
+    errors = []
+    total_files = 0
+    try:
+        reader = ZipStreamReader(request.stream)
+        for name, entry in reader.entries():
+            basename = name.replace('\\', '/').rsplit('/', 1)[-1]
+            # フォルダやmacOSのメタデータ（__MACOSX/, ._ファイル）は読み飛ばす
+            if not basename or basename.startswith('.') or name.startswith('__MACOSX/'):
+                continue
+            if not basename.lower().endswith('.png'):
+                errors.append(f'{basename}: PNGファイルのみ対応しています')
+                continue
+            
+            # 大きすぎるPNGはそのファイルだけ失敗とし、残りのエントリの取り込みは続ける
+            entry.max_size = int(DIFY_INGEST_MAX_ENTRY_MB * 1024 * 1024)
+            try:
+                file_hash, file_size = spool_upload(entry)
+            except ZipEntryTooLarge:
+                errors.append(f'{basename}: ファイルサイズが上限（{DIFY_INGEST_MAX_ENTRY_MB:g}MB）を超えています')
+                continue
+            valid_file = {
+                'filename': secure_filename(basename) or f'file_{total_files + 1}.png',
+                'file_hash': file_hash,
+                'file_size': file_size
+            }
+            cached_results = lookup_cached_results([file_hash], bypass_cache)
+            with queue_transaction() as conn:
+                append_session_jobs(conn, session_id, [valid_file], cached_results)
+            if file_hash not in cached_results:
+                schedule_preprocessing([file_hash])
+            total_files += 1
+            notify_session_changed()
+            notify_jobs_available()
+    except Exception as e:
+        logger.warning('Archive ingest stopped for session %s: %s', session_id, e)
+        errors.append(f'ZIPの受信を中断しました: {str(e)}')
+    finally:
+        with queue_transaction() as conn:
+            if total_files:
+                finish_session(conn, session_id, errors)
+            else:
+                delete_session(conn, session_id)
+        notify_session_changed()
+    
+    if not total_files:
+        return jsonify({
+            'error': '有効なPNGファイルがありません',
+            'errors': errors
+        }), 400
+    
+    logger.info('Received %s file(s) from archive for session %s', total_files, session_id)
+    return jsonify({
+        'success': True,
+        'session_id': session_id,
+        'total_files': total_files,
+        'errors': errors,
+        'message': 'ファイル処理を開始しました'
+    })
+
+# ワークフローのtextから請求データを取り出すパターン（```json フェンス）
+JSON_FENCE_PATTERN = re.compile(r'```json\s*\n(.*?)\n```', re.DOTALL)
+
+def extract_json_data(text):
+    """Parse the invoice JSON out of workflow text in a single pass
+    
+    Entries come from every fenced ```json block, or from a bare [{...}]
+    array when there is no fence. Returns the list of entries, or None when
+    nothing parses.
+    """
+    if not isinstance(text, str):
+        return None
+    
+    entries = None
+    for match in JSON_FENCE_PATTERN.finditer(text):
+        try:
+            parsed = json.loads(match.group(1))
+        except ValueError:
+            continue
+        entries = (entries or []) + (parsed if isinstance(parsed, list) else [parsed])
+    
+    if entries is None:
+        text_content = text.strip()
+        if text_content.startswith('[{') and text_content.endswith('}]'):
+            try:
+                entries = json.loads(text_content)
+            except ValueError:
+                pass
+    
+    return entries
+
+def attach_extracted_data(result_data):
+    """Store the entries parsed from result_data['text'] as result_data['extracted_data']
+    
+    This is the only place the workflow text is parsed; validation, saving
+    and the UI read extracted_data afterwards.
+    """
+    if isinstance(result_data, dict) and 'extracted_data' not in result_data:
+        with json_extraction_seconds.time():
+            extracted = extract_json_data(result_data.get('text'))
+        if extracted is not None:
+            result_data['extracted_data'] = extracted
+    return result_data
+
 def is_valid_json_response(result_data):
-    """Check if the result contains valid JSON data"""
+    """Check if the result contains valid JSON data (parsed by attach_extracted_data)"""
     if not result_data:
         return False
+    return isinstance(result_data.get('extracted_data'), (dict, list))
+
+def handle_workflow_event(event, progress, report):
+    """Record one streamed workflow event through report(**fields); return the run in the blocking shape once it ends
     
-    if 'extracted_data' in result_data:
-        extracted = result_data['extracted_data']
-        if isinstance(extracted, (dict, list)) and extracted:
-            return True
-    
-    if 'text' in result_data:
-        text_content = result_data['text']
-        if isinstance(text_content, str):
-            if '```json' in text_content:
-                json_match = re.search(r'```json\s*\n(.*?)\n```', text_content, re.DOTALL)
-                if json_match:
-                    try:
-                        json.loads(json_match.group(1))
-                        return True
-                    except:
-                        pass
-            
-            text_content = text_content.strip()
-            if text_content.startswith('[{') and text_content.endswith('}]'):
-                try:
-                    json.loads(text_content)
-                    return True
-                except:
-                    pass
+    Stage changes are reported at once. Other events (ping, text_chunk, non-LLM
+    nodes) only refresh last_event_at, at most every STREAM_HEARTBEAT_WRITE_SECONDS.
+    """
+    event_type = event.get('event')
+    data = event.get('data') or {}
+    now = time.time()
+    result = None
+    fields = {}
+    
+    if event_type == 'workflow_started':
+        fields = {'workflow_run_id': event.get('workflow_run_id'), 'stage': '開始', 'nodes_finished': 0}
+    elif event_type == 'node_started' and data.get('node_type') == 'llm':
+        logger.debug('Node started: %s', data.get('title'))
+        fields = {'stage': data.get('title')}
+    elif event_type == 'node_finished' and data.get('node_type') == 'llm':
+        logger.debug('Node finished: %s (%s)', data.get('title'), data.get('status'))
+        progress['nodes_finished'] += 1
+        fields = {'nodes_finished': progress['nodes_finished']}
+    elif event_type == 'workflow_finished':
+        fields = {'stage': '完了'}
+        result = {'data': data}
+    elif event_type == 'error':
+        logger.warning('Workflow stream error event: %s', LogPayload(event))
+        return {}
+    
+    if fields or now - progress.get('heartbeat_written_at', 0) >= STREAM_HEARTBEAT_WRITE_SECONDS:
+        progress['heartbeat_written_at'] = now
+        report(last_event_at=now, **fields)
+    return result
+
+def consume_workflow_stream(workflow_response, report=None):
+    """Read a streaming workflow run, reporting node progress, and return it in the blocking response shape"""
+    progress = {'nodes_finished': 0}
+    try:
+        for event in dify_client.iter_events(workflow_response):
+            workflow_result = handle_workflow_event(event, progress, report or ignore_progress)
+            if workflow_result is not None:
+                return workflow_result
+    except requests.exceptions.ConnectionError as e:
+        if e.args and isinstance(e.args[0], ReadTimeoutError):
+            raise requests.exceptions.Timeout(
+                f'{dify_client.stream_idle_timeout}秒間ワークフローのイベントがありません'
+            ) from e
+        raise
+    finally:
+        workflow_response.close()
     
-    return False
+    logger.warning('Workflow stream ended without workflow_finished event')
+    return {}
+
+def job_progress(session_id, file_index):
+    """Return a report(**fields) function that writes a running job's progress straight to the queue"""
+    def report(**fields):
+        update_in_flight(session_id, file_index, **fields)
+    return report
 
-def send_to_dify_with_progress(file_obj, filename, session_id, file_index, max_retries=3):
-    """Send file to Dify API with progress tracking and retry logic"""
+def ignore_progress(**fields):
+    """report(**fields) for Dify calls that belong to no queued job"""
+
+def upload_file_with_progress(file_obj, filename, report):
+    """Upload the file to Dify and remember the upload_file_id on the job
     
+    Returns the file ID; raises DifyCallError when the upload failed.
+    """
+    with upload_errors(filename):
+        logger.debug('Uploading file to Dify...')
+        file_id = uploaded_file_id(dify_client.upload_file(file_obj, filename))
+    report(upload_file_id=file_id)
+    return file_id
+
+@contextmanager
+def upload_errors(filename):
+    """Turn any failure of the upload in the with block into DifyCallError"""
     try:
-        print(f"DEBUG: Starting Dify API call for {filename}")
-        
-        upload_files = {
-            'file': (filename, file_obj, 'image/png')
-        }
-        upload_data = {
-            'user': 'dify-flask-app'
-        }
-        
-        print(f"DEBUG: Uploading file to Dify...")
-        upload_response = requests.post(
-            f"{DIFY_API_BASE_URL}/v1/files/upload",
-            headers={'Authorization': f'Bearer {DIFY_API_KEY}'},
-            files=upload_files,
-            data=upload_data,
-            timeout=30
-        )
-        
-        print(f"DEBUG: Upload response status: {upload_response.status_code}")
-        if upload_response.status_code != 201:
-            print(f"DEBUG: Upload response content: {upload_response.text}")
-            return {'error': f'Difyファイルアップロードエラー: {upload_response.status_code}'}
-        
-        upload_result = upload_response.json()
-        file_id = upload_result.get('id')
-        print(f"DEBUG: File uploaded with ID: {file_id}")
-        
-        if not file_id:
-            return {'error': 'ファイルアップロードからIDを取得できませんでした'}
-        
-    except requests.exceptions.Timeout:
-        print(f"DEBUG: Upload timeout error for {filename}")
-        return {'error': 'Dify APIアップロードのタイムアウトが発生しました'}
-    except requests.exceptions.RequestException as e:
-        print(f"DEBUG: Upload request error for {filename}: {str(e)}")
-        return {'error': f'Dify APIアップロード接続エラー: {str(e)}'}
+        yield
+    except DifyCallError:
+        raise
+    except DIFY_TIMEOUT_ERRORS:
+        logger.warning('Upload timeout error for %s', filename)
+        raise DifyCallError('Dify APIアップロードのタイムアウトが発生しました', reason='timeout')
+    except DIFY_CONNECTION_ERRORS as e:
+        logger.warning('Upload request error for %s: %s', filename, e)
+        raise DifyCallError(f'Dify APIアップロード接続エラー: {str(e)}', reason='connection')
     except Exception as e:
-        print(f"DEBUG: Upload general error for {filename}: {str(e)}")
-        return {'error': f'ファイルアップロード中にエラーが発生しました: {str(e)}'}
+        logger.error('Upload general error for %s: %s', filename, e)
+        raise DifyCallError(f'ファイルアップロード中にエラーが発生しました: {str(e)}')
+
+def uploaded_file_id(upload_response):
+    """Return the file ID from a /v1/files/upload response; raises DifyCallError when the upload failed"""
+    logger.debug('Upload response status: %s', upload_response.status_code)
+    if upload_response.status_code != 201:
+        logger.debug('Upload response content: %s', LogPayload(upload_response.text))
+        raise dify_http_error('Difyファイルアップロードエラー', upload_response)
     
-    for attempt in range(1, max_retries + 1):
+    file_id = upload_response.json().get('id')
+    logger.debug('File uploaded with ID: %s', file_id)
+    if not file_id:
+        raise DifyCallError('ファイルアップロードからIDを取得できませんでした', status_code=upload_response.status_code)
+    return file_id
+
+def is_upload_file_rejected(workflow_response):
+    """Check whether Dify refused the run because the uploaded file ID is unknown or expired"""
+    if workflow_response.status_code not in (400, 404):
+        return False
+    body = workflow_response.text.lower()
+    return 'file' in body and any(
+        marker in body for marker in ('not found', 'not exist', 'invalid upload file', 'expired')
+    )
+
+def wait_for_rate_limit(kind, report):
+    """Wait for a rate limiter slot and token, recording the wait on the job
+    
+    On return the caller holds a slot and must release it.
+    """
+    waited = 0.0
+    if not dify_rate_limiter.try_acquire_slot():
+        report(stage='同時実行数の上限で待機')
+        waited += dify_rate_limiter.acquire_slot()
+    
+    try:
+        delay = dify_rate_limiter.reserve()
+        if delay > 0:
+            if delay >= 1:
+                report(stage='流量制限で待機')
+            time.sleep(delay)
+            waited += delay
+        record_throttle_wait(kind, waited, report)
+    except BaseException:
+        dify_rate_limiter.release(None)
+        raise
+
+def record_throttle_wait(kind, waited, report):
+    dify_throttle_seconds.observe(waited, kind=kind)
+    if waited >= 0.05:
+        report(throttle_added=waited)
+
+def release_rate_limit(kind, started, status_code):
+    """Give back the rate limiter slot after a Dify call, adapting the limits to how it went"""
+    succeeded = status_code is not None and status_code < 400
+    dify_call_seconds.observe(
+        time.monotonic() - started, kind=kind, outcome='success' if succeeded else (status_code or 'error')
+    )
+    dify_rate_limiter.release(
+        kind, time.monotonic() - started if succeeded else None, throttled=status_code == 429
+    )
+
+@contextmanager
+def rate_limited(kind, report=None):
+    """Hold a rate limiter slot around one Dify call; set the yielded dict's status_code to the HTTP status"""
+    wait_for_rate_limit(kind, report or ignore_progress)
+    started = time.monotonic()
+    call = {'status_code': None}
+    try:
+        yield call
+    finally:
+        release_rate_limit(kind, started, call['status_code'])
+
+def wait_for_dify_breaker(report):
+    """Block while the circuit breaker is open, showing the pause on the in-flight file
+    
+    Returns True when the call that follows is the half-open probe.
+    """
+    waiting = False
+    while True:
+        delay, probe = dify_breaker.before_call()
+        if delay <= 0:
+            return probe
+        if not waiting:
+            logger.info('Dify circuit breaker open, waiting %.1fs', delay)
+            report(stage='Dify停止中のため待機')
+            waiting = True
+        time.sleep(min(delay, 1.0))
+
+@contextmanager
+def dify_call_outcome(call):
+    """Record how the Dify call in the with block went on the circuit breaker and in call['status_code']
+    
+    Timeouts and connection errors of requests or httpx are raised as DifyCallError.
+    """
+    try:
+        yield
+    except DifyCallError as e:
+        call['status_code'] = e.status_code
+        dify_breaker.record(not e.service_failure)
+        if e.retry_after is not None:
+            dify_breaker.hold_open(e.retry_after)
+        raise
+    except DIFY_TIMEOUT_ERRORS:
+        dify_breaker.record(False)
+        raise DifyCallError('Dify APIワークフローのタイムアウトが発生しました', reason='timeout')
+    except DIFY_CONNECTION_ERRORS as e:
+        dify_breaker.record(False)
+        raise DifyCallError(f'Dify APIワークフロー接続エラー: {str(e)}', reason='connection')
+    except Exception:
+        # Difyの状態とは無関係なエラー（試行中のプローブは解放する）
+        dify_breaker.record(True)
+        raise
+    call['status_code'] = 200
+    dify_breaker.record(True)
+
+def call_dify(kind, report, func, *args):
+    """Run one Dify call through the circuit breaker and rate limiter, recording how Dify responded"""
+    probe = wait_for_dify_breaker(report)
+    try:
+        with rate_limited(kind, report) as call, dify_call_outcome(call):
+            return func(*args)
+    finally:
+        if probe:
+            # 待機中の進捗の書き込みなどで結果を記録せずに終わっても、半開のまま止まらないようにする
+            dify_breaker.release_probe()
+
+def run_workflow_once(file_id, filename, report):
+    """Run the workflow for an uploaded file and return its outputs; raises DifyCallError"""
+    workflow_response = dify_client.run_workflow(workflow_payload(file_id))
+    
+    logger.debug('Workflow response status: %s', workflow_response.status_code)
+    if workflow_response.status_code != 200:
+        raise workflow_run_error(workflow_response, file_id)
+    
+    if DIFY_RESPONSE_MODE == 'streaming':
+        workflow_result = consume_workflow_stream(workflow_response, report)
+    else:
+        workflow_result = blocking_workflow_result(workflow_response)
+    return workflow_result_data(workflow_result, filename)
+
+def workflow_payload(file_id):
+    payload = dify_client.workflow_payload(file_id, DIFY_RESPONSE_MODE)
+    logger.debug('Executing workflow with payload: %s', LogPayload(payload, as_json=True))
+    return payload
+
+def blocking_workflow_result(workflow_response):
+    try:
+        return workflow_response.json()
+    except ValueError:
+        raise DifyCallError('Difyの応答がJSONではありません', status_code=200)
+
+def workflow_run_error(workflow_response, file_id):
+    """Classify a failed /v1/workflows/run response as a DifyCallError"""
+    logger.debug('Workflow response content: %s', LogPayload(workflow_response.text))
+    if is_upload_file_rejected(workflow_response):
+        return DifyCallError(
+            f'アップロード済みファイル{file_id}が拒否されました', service_failure=False, reupload=True,
+            status_code=workflow_response.status_code
+        )
+    return dify_http_error('Difyワークフロー実行エラー', workflow_response)
+
+def workflow_result_data(workflow_result, filename):
+    """Return the outputs of a finished run with extracted_data attached; raises DifyCallError if unusable"""
+    logger.debug('Workflow result: %s', LogPayload(workflow_result))
+    if not ('data' in workflow_result and workflow_result['data'].get('outputs')):
+        logger.warning('No outputs found in workflow result for %s', filename)
+        raise DifyCallError('Difyワークフローの実行に失敗しました', service_failure=False, status_code=200)
+    
+    result_data = attach_extracted_data(workflow_result['data']['outputs'])
+    logger.debug('Extracted result data: %s', LogPayload(result_data))
+    if not is_valid_json_response(result_data):
+        logger.warning('Invalid JSON response for %s', filename)
+        raise DifyCallError('有効なJSONデータが取得できませんでした', service_failure=False, status_code=200)
+    return result_data
+
+def send_to_dify_with_progress(file_obj, filename, report, file_id=None, retry_policy=None):
+    """Send file to Dify API with progress tracking and retry logic
+    
+    Retryable failures are retried after the retry policy's backoff, fatal
+    ones (4xx other than 408/429) fail the file at once, and every call waits
+    while the shared circuit breaker is open.
+    
+    file_id is the upload_file_id kept on the job from an earlier run, so
+    later attempts and retries reuse it; the file is uploaded again only
+    when Dify rejects the ID. send_to_dify_async is the same loop for the
+    asyncio dispatcher; the decisions live in the helpers both call.
+    """
+    retry_policy = retry_policy or dify_retry_policy
+    logger.debug('Starting Dify API call for %s', filename)
+    if file_id:
+        logger.debug('Reusing uploaded file ID: %s', file_id)
+    
+    for attempt in range(1, retry_policy.max_attempts + 1):
+        start_attempt(attempt, retry_policy, filename, report)
         try:
-            print(f"DEBUG: Workflow execution attempt {attempt}/{max_retries} for {filename}")
-            
-            with session_lock:
-                if session_id in processing_sessions:
-                    processing_sessions[session_id]['current_processing']['current_attempt'] = attempt
-            
-            workflow_payload = {
-                "inputs": {
-                    "input_file": {
-                        "type": "image",
-                        "transfer_method": "local_file", 
-                        "upload_file_id": file_id
-                    }
-                },
-                "response_mode": "blocking",
-                "user": "dify-flask-app"
-            }
-            
-            print(f"DEBUG: Executing workflow with payload: {json.dumps(workflow_payload, indent=2)}")
-            workflow_response = requests.post(
-                f"{DIFY_API_BASE_URL}/v1/workflows/run",
-                headers={
-                    'Authorization': f'Bearer {DIFY_API_KEY}',
-                    'Content-Type': 'application/json'
-                },
-                json=workflow_payload,
-                timeout=(30, 300)
-            )
-            
-            print(f"DEBUG: Workflow response status: {workflow_response.status_code}")
-            if workflow_response.status_code != 200:
-                print(f"DEBUG: Workflow response content: {workflow_response.text}")
-                if attempt == max_retries:
-                    return {'error': f'Difyワークフロー実行エラー: {workflow_response.status_code} (最大{max_retries}回試行後)'}
-                else:
-                    print(f"DEBUG: Retrying workflow execution for {filename} (attempt {attempt + 1})")
-                    time.sleep(2)  # Wait 2 seconds before retry
-                    continue
-            
-            workflow_result = workflow_response.json()
-            print(f"DEBUG: Workflow result: {workflow_result}")
-            
-            if 'data' in workflow_result and 'outputs' in workflow_result['data']:
-                result_data = workflow_result['data']['outputs']
-                print(f"DEBUG: Extracted result data: {result_data}")
-                
-                if is_valid_json_response(result_data):
-                    print(f"DEBUG: Valid JSON response received for {filename} on attempt {attempt}")
-                    return result_data
-                else:
-                    print(f"DEBUG: Invalid JSON response for {filename} on attempt {attempt}")
-                    if attempt == max_retries:
-                        return {'error': f'有効なJSONデータが取得できませんでした (最大{max_retries}回試行後)'}
-                    else:
-                        print(f"DEBUG: Retrying for valid JSON response for {filename} (attempt {attempt + 1})")
-                        time.sleep(2)  # Wait 2 seconds before retry
-                        continue
-            else:
-                print(f"DEBUG: No outputs found in workflow result for {filename} on attempt {attempt}")
-                if attempt == max_retries:
-                    return {'error': f'Difyワークフローの実行に失敗しました (最大{max_retries}回試行後)'}
-                else:
-                    print(f"DEBUG: Retrying workflow execution for {filename} (attempt {attempt + 1})")
-                    time.sleep(2)  # Wait 2 seconds before retry
-                    continue
-                    
-        except requests.exceptions.Timeout:
-            print(f"DEBUG: Workflow timeout error for {filename} on attempt {attempt}")
-            if attempt == max_retries:
-                return {'error': f'Dify APIワークフローのタイムアウトが発生しました (最大{max_retries}回試行後)'}
-            else:
-                print(f"DEBUG: Retrying after timeout for {filename} (attempt {attempt + 1})")
-                time.sleep(2)
-                continue
-        except requests.exceptions.RequestException as e:
-            print(f"DEBUG: Workflow request error for {filename} on attempt {attempt}: {str(e)}")
-            if attempt == max_retries:
-                return {'error': f'Dify APIワークフロー接続エラー: {str(e)} (最大{max_retries}回試行後)'}
-            else:
-                print(f"DEBUG: Retrying after request error for {filename} (attempt {attempt + 1})")
-                time.sleep(2)
-                continue
+            if not file_id:
+                file_id = call_dify('upload', report, upload_file_with_progress, file_obj, filename, report)
+            return call_dify('workflow', report, run_workflow_once, file_id, filename, report)
         except Exception as e:
-            print(f"DEBUG: Workflow general error for {filename} on attempt {attempt}: {str(e)}")
-            if attempt == max_retries:
-                return {'error': f'ワークフロー実行中にエラーが発生しました: {str(e)} (最大{max_retries}回試行後)'}
-            else:
-                print(f"DEBUG: Retrying after general error for {filename} (attempt {attempt + 1})")
-                time.sleep(2)
-                continue
+            failure = attempt_failure(e, attempt, filename)
+        
+        result, delay = plan_retry(failure, attempt, retry_policy, filename, file_id, report)
+        if result is not None:
+            return result
+        if failure.reupload:
+            file_id = None
+        time.sleep(delay)
+    
+    return {'error': f'予期しないエラーが発生しました (最大{retry_policy.max_attempts}回試行後)'}
+
+def start_attempt(attempt, retry_policy, filename, report):
+    logger.debug('Workflow execution attempt %s/%s for %s', attempt, retry_policy.max_attempts, filename)
+    report(current_attempt=attempt, stage=None, nodes_finished=0)
+
+def attempt_failure(error, attempt, filename):
+    """Return the DifyCallError describing why an attempt failed"""
+    if isinstance(error, DifyCallError):
+        return error
+    logger.error('Workflow general error for %s on attempt %s: %s', filename, attempt, error)
+    return DifyCallError(f'ワークフロー実行中にエラーが発生しました: {str(error)}', service_failure=False)
+
+def plan_retry(failure, attempt, retry_policy, filename, file_id, report):
+    """Decide what follows a failed attempt: (error result, None) to give up, or (None, seconds to wait)
     
-    return {'error': f'予期しないエラーが発生しました (最大{max_retries}回試行後)'}
+    A rejected upload_file_id is forgotten so the next attempt uploads again without waiting.
+    """
+    max_attempts = retry_policy.max_attempts
+    logger.warning('Attempt %s/%s for %s failed: %s', attempt, max_attempts, filename, failure)
+    if not failure.retryable:
+        return {'error': str(failure)}, None
+    if attempt == max_attempts:
+        return {'error': f'{failure} (最大{max_attempts}回試行後)'}, None
+    dify_retries.inc(reason=failure.metric_reason())
+    
+    if failure.reupload:
+        logger.warning('Uploaded file ID %s was rejected, uploading %s again', file_id, filename)
+        report(upload_file_id=None)
+        return None, 0
+    
+    delay = retry_policy.delay(attempt, failure.retry_after)
+    logger.info('Retrying %s in %.1fs (attempt %s)', filename, delay, attempt + 1)
+    report(stage=f'{delay:.0f}秒後に再試行')
+    return None, delay
 
 def send_to_dify(file_obj, filename):
     """Send file to Dify API using two-step process: upload then workflow execution"""
+    if dify_dispatcher is not None:
+        # asyncioのディスパッチャーに渡し、このスレッドは結果を待つだけにする（再試行はしない）
+        return dify_dispatcher.submit(
+            send_to_dify_async(
+                dify_dispatcher.client, file_obj, filename, ignore_progress, retry_policy=RetryPolicy(max_attempts=1)
+            )
+        ).result()
     try:
-        print(f"DEBUG: Starting Dify API call for {filename}")
-        
-        upload_files = {
-            'file': (filename, file_obj, 'image/png')
-        }
-        upload_data = {
-            'user': 'dify-flask-app'
-        }
+        logger.debug('Starting Dify API call for %s', filename)
         
-        print(f"DEBUG: Uploading file to Dify...")
-        upload_response = requests.post(
-            f"{DIFY_API_BASE_URL}/v1/files/upload",
-            headers={'Authorization': f'Bearer {DIFY_API_KEY}'},
-            files=upload_files,
-            data=upload_data,
-            timeout=30
-        )
+        logger.debug('Uploading file to Dify...')
+        with rate_limited('upload') as call:
+            upload_response = dify_client.upload_file(file_obj, filename)
+            call['status_code'] = upload_response.status_code
         
-        print(f"DEBUG: Upload response status: {upload_response.status_code}")
+        logger.debug('Upload response status: %s', upload_response.status_code)
         if upload_response.status_code != 201:
-            print(f"DEBUG: Upload response content: {upload_response.text}")
+            logger.debug('Upload response content: %s', LogPayload(upload_response.text))
             return {'error': f'Difyファイルアップロードエラー: {upload_response.status_code}'}
         
         upload_result = upload_response.json()
         file_id = upload_result.get('id')
-        print(f"DEBUG: File uploaded with ID: {file_id}")
+        logger.debug('File uploaded with ID: %s', file_id)
         
         if not file_id:
             return {'error': 'ファイルアップロードからIDを取得できませんでした'}
         
-        workflow_payload = {
-            "inputs": {
-                "input_file": {
-                    "type": "image",
-                    "transfer_method": "local_file", 
-                    "upload_file_id": file_id
-                }
-            },
-            "response_mode": "blocking",
-            "user": "dify-flask-app"
-        }
+        workflow_payload = dify_client.workflow_payload(file_id, DIFY_RESPONSE_MODE)
         
-        print(f"DEBUG: Executing workflow with payload: {json.dumps(workflow_payload, indent=2)}")
-        workflow_response = requests.post(
-            f"{DIFY_API_BASE_URL}/v1/workflows/run",
-            headers={
-                'Authorization': f'Bearer {DIFY_API_KEY}',
-                'Content-Type': 'application/json'
-            },
-            json=workflow_payload,
-            timeout=(30, 300)
-        )
-        
-        print(f"DEBUG: Workflow response status: {workflow_response.status_code}")
-        if workflow_response.status_code != 200:
-            print(f"DEBUG: Workflow response content: {workflow_response.text}")
-            return {'error': f'Difyワークフロー実行エラー: {workflow_response.status_code}'}
-        
-        workflow_result = workflow_response.json()
-        print(f"DEBUG: Workflow result: {workflow_result}")
+        logger.debug('Executing workflow with payload: %s', LogPayload(workflow_payload, as_json=True))
+        with rate_limited('workflow') as call:
+            workflow_response = dify_client.run_workflow(workflow_payload)
+            call['status_code'] = workflow_response.status_code
+            
+            logger.debug('Workflow response status: %s', workflow_response.status_code)
+            if workflow_response.status_code != 200:
+                logger.debug('Workflow response content: %s', LogPayload(workflow_response.text))
+                return {'error': f'Difyワークフロー実行エラー: {workflow_response.status_code}'}
+            
+            if DIFY_RESPONSE_MODE == 'streaming':
+                workflow_result = consume_workflow_stream(workflow_response)
+            else:
+                workflow_result = workflow_response.json()
+        logger.debug('Workflow result: %s', LogPayload(workflow_result))
         
-        if 'data' in workflow_result and 'outputs' in workflow_result['data']:
-            result_data = workflow_result['data']['outputs']
-            print(f"DEBUG: Extracted result data: {result_data}")
+        if 'data' in workflow_result and workflow_result['data'].get('outputs'):
+            result_data = attach_extracted_data(workflow_result['data']['outputs'])
+            logger.debug('Extracted result data: %s', LogPayload(result_data))
             return result_data
         else:
-            print(f"DEBUG: No outputs found in workflow result")
+            logger.warning('No outputs found in workflow result')
             return {'error': 'Difyワークフローの実行に失敗しました'}
             
     except requests.exceptions.Timeout:
-        print(f"DEBUG: Timeout error for {filename}")
+        logger.warning('Timeout error for %s', filename)
         return {'error': 'Dify APIのタイムアウトが発生しました'}
     except requests.exceptions.RequestException as e:
-        print(f"DEBUG: Request error for {filename}: {str(e)}")
+        logger.warning('Request error for %s: %s', filename, e)
         return {'error': f'Dify API接続エラー: {str(e)}'}
     except Exception as e:
-        print(f"DEBUG: General error for {filename}: {str(e)}")
+        logger.error('General error for %s: %s', filename, e)
         return {'error': f'データ取得中にエラーが発生しました: {str(e)}'}
 
-def process_files_sequential(valid_files, session_id):
-    """Process files one by one in background thread"""
-    print(f"DEBUG: Starting sequential processing for session {session_id}")
+def spool_path(file_hash):
+    """Path of the spooled upload with the given SHA-256"""
+    return os.path.join(DIFY_SPOOL_DIR, file_hash[:2], f'{file_hash}.png')
+
+def spool_upload(stream):
+    """Copy an uploaded file into the spool in chunks and return its SHA-256 and size
+    
+    The hash is also the result cache key, so identical files share one spool entry.
+    """
+    os.makedirs(DIFY_SPOOL_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    file_size = 0
+    fd, temp_path = tempfile.mkstemp(dir=DIFY_SPOOL_DIR, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as spool_file:
+            for chunk in iter(lambda: stream.read(SPOOL_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                spool_file.write(chunk)
+                file_size += len(chunk)
+        file_hash = digest.hexdigest()
+        path = spool_path(file_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return file_hash, file_size
+
+def remove_unreferenced_spool_files(conn, file_hashes):
+    """Delete spooled uploads that no job refers to any more; call inside a queue transaction
+    
+    Returns the number of bytes removed from disk.
+    """
+    removed_bytes = 0
+    for file_hash in file_hashes:
+        if conn.execute('SELECT 1 FROM processing_jobs WHERE file_hash = ? LIMIT 1', (file_hash,)).fetchone():
+            continue
+        # 元のファイルと、前処理済みのファイル（設定ごとに1つ）をまとめて削除する
+        for path in [spool_path(file_hash)] + glob.glob(preprocessed_path(file_hash, '*')):
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                removed_bytes += size
+            except FileNotFoundError:
+                pass
+    return removed_bytes
+
+def preprocessed_path(file_hash, settings_tag=None):
+    """Path of the pre-processed copy of a spooled upload for the current settings"""
+    return os.path.join(DIFY_SPOOL_DIR, file_hash[:2], f'{file_hash}.{settings_tag or PREPROCESS_SETTINGS_TAG}.prep.png')
+
+def preprocess_image(source_path, target_path, max_edge, target_dpi, grayscale, max_pixels):
+    """Shrink one scanned invoice for upload; runs in a pre-processing worker process
+    
+    Converts to grayscale, scales high-DPI scans down to target_dpi and the longer
+    edge down to max_edge, and re-encodes with optimised PNG compression. The
+    original is kept when re-encoding does not make the file smaller. Raises
+    ValueError for files that are not readable PNGs or have too many pixels.
+    """
+    original_bytes = os.path.getsize(source_path)
+    try:
+        with Image.open(source_path) as image:
+            if image.format != 'PNG':
+                raise ValueError('PNG形式の画像ではありません')
+            width, height = image.size
+            if width * height > max_pixels:
+                raise ValueError(f'画像が大きすぎます（{width}x{height}）')
+            image.load()
+            dpi = image.info.get('dpi')
+            
+            scale = 1.0
+            if dpi and target_dpi and dpi[0] > target_dpi:
+                scale = target_dpi / float(dpi[0])
+            if max_edge and max(width, height) * scale > max_edge:
+                scale = max_edge / float(max(width, height))
+            
+            if grayscale:
+                # 透過部分は白地として扱う
+                if image.mode in ('RGBA', 'LA', 'P'):
+                    image = image.convert('RGBA')
+                    background = Image.new('RGBA', image.size, (255, 255, 255, 255))
+                    image = Image.alpha_composite(background, image)
+                image = image.convert('L')
+            if scale < 1.0:
+                image = image.resize(
+                    (max(1, round(width * scale)), max(1, round(height * scale))), Image.Resampling.LANCZOS
+                )
+            
+            save_options = {'optimize': True}
+            if dpi:
+                save_options['dpi'] = (dpi[0] * scale, dpi[1] * scale)
+            buffer = BytesIO()
+            image.save(buffer, 'PNG', **save_options)
+    except ValueError:
+        raise
+    except (OSError, SyntaxError, Image.DecompressionBombError) as e:
+        raise ValueError(f'画像を読み込めません: {str(e)}')
+    
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(target_path), suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as target_file:
+            if buffer.tell() < original_bytes:
+                target_file.write(buffer.getvalue())
+            else:
+                with open(source_path, 'rb') as source_file:
+                    target_file.write(source_file.read())
+        os.replace(temp_path, target_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return original_bytes, os.path.getsize(target_path)
+
+def result_cache_key(file_hash):
+    return f"{DIFY_WORKFLOW_ID or ''}:{file_hash}"
+
+def get_cached_result(file_hash):
+    """Return the cached Dify outputs for the file hash, or None on a miss or expired entry"""
+    if not DIFY_CACHE_ENABLED:
+        return None
+    
+    now = time.time()
+    cache_key = result_cache_key(file_hash)
+    conn = sqlite3.connect('inventory_data.db', timeout=30)
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT outputs, created_at FROM dify_result_cache WHERE cache_key = ?', (cache_key,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        
+        if now - row[1] > DIFY_CACHE_TTL_SECONDS:
+            cursor.execute('DELETE FROM dify_result_cache WHERE cache_key = ?', (cache_key,))
+            conn.commit()
+            return None
+        
+        cursor.execute('UPDATE dify_result_cache SET last_accessed_at = ? WHERE cache_key = ?', (now, cache_key))
+        conn.commit()
+        # 抽出処理を追加する前に保存されたエントリにもextracted_dataを付ける
+        return attach_extracted_data(json.loads(row[0]))
+    finally:
+        conn.close()
+
+def store_cached_result(file_hash, outputs):
+    """Store successful Dify outputs and evict expired and least recently used entries"""
+    if not DIFY_CACHE_ENABLED:
+        return
+    
+    now = time.time()
+    conn = sqlite3.connect('inventory_data.db', timeout=30)
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT OR REPLACE INTO dify_result_cache
+                (cache_key, file_hash, workflow_id, outputs, created_at, last_accessed_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (
+            result_cache_key(file_hash),
+            file_hash,
+            DIFY_WORKFLOW_ID or '',
+            json.dumps(outputs, ensure_ascii=False),
+            now,
+            now
+        ))
+        cursor.execute('DELETE FROM dify_result_cache WHERE created_at < ?', (now - DIFY_CACHE_TTL_SECONDS,))
+        cursor.execute('''
+            DELETE FROM dify_result_cache WHERE cache_key IN (
+                SELECT cache_key FROM dify_result_cache
+                ORDER BY last_accessed_at DESC
+                LIMIT -1 OFFSET ?
+            )
+        ''', (DIFY_CACHE_MAX_ENTRIES,))
+        conn.commit()
+    finally:
+        conn.close()
+
+def connect_queue_db():
+    """Return this thread's connection to the job queue tables, opening it on first use
+    
+    The connection is in autocommit mode, so writes go through queue_transaction
+    and each read sees the latest committed state. Callers must not close it.
+    """
+    conn = getattr(db_local, 'queue_conn', None)
+    if conn is None:
+        conn = open_tuned_connection(isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        db_local.queue_conn = conn
+    return conn
+
+@contextmanager
+def queue_transaction():
+    """Run queue updates in one write transaction, taking the database lock up front"""
+    conn = connect_queue_db()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        yield conn
+        conn.execute('COMMIT')
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+
+@contextmanager
+def queue_snapshot():
+    """Run several queue reads in one read transaction so they see the same state"""
+    conn = connect_queue_db()
+    conn.execute('BEGIN')
+    try:
+        yield conn
+    finally:
+        conn.execute('ROLLBACK')
+
+def bump_session_version(conn, session_id):
+    """Increment the session version inside a queue transaction and return it"""
+    row = conn.execute(
+        'UPDATE processing_sessions SET version = version + 1, updated_at = ? WHERE session_id = ? RETURNING version',
+        (time.time(), session_id)
+    ).fetchone()
+    return row['version'] if row else None
+
+def notify_session_changed():
+    """Wake up this process's event streams after a committed session change"""
+    with session_lock:
+        session_changed.notify_all()
+
+def notify_jobs_available():
+    """Wake up this process's idle queue workers"""
+    with jobs_available:
+        jobs_available.notify_all()
+    if dify_dispatcher is not None:
+        dify_dispatcher.notify()
+
+def lookup_cached_results(file_hashes, bypass_cache):
+    """Return {file_hash: cached outputs} for the given hashes that have a cached result"""
+    cached_results = {}
+    if bypass_cache:
+        return cached_results
+    for file_hash in set(file_hashes):
+        try:
+            cached = get_cached_result(file_hash)
+        except Exception as e:
+            logger.warning('Result cache lookup failed: %s', e)
+            cached = None
+        if cached is not None:
+            cached_results[file_hash] = cached
+    return cached_results
+
+def create_session(conn, session_id, errors, bypass_cache, profile=False):
+    """Insert an empty session that is still receiving files; call inside a queue transaction
+    
+    With profile set, the session's jobs are run under the profiler.
+    """
+    now = time.time()
+    conn.execute('''
+        INSERT INTO processing_sessions
+            (session_id, status, total_files, processed_files, errors, bypass_cache, profile, version, created_at, updated_at)
+        VALUES (?, 'receiving', 0, 0, ?, ?, ?, 0, ?, ?)
+    ''', (session_id, json.dumps(errors, ensure_ascii=False), int(bypass_cache), int(profile), now, now))
+
+def append_session_jobs(conn, session_id, valid_files, cached_results):
+    """Add one job per file to a receiving session; call inside a queue transaction
+    
+    Cached results are recorded immediately, and identical files wait on a copy
+    that is still queued or running (duplicate_of) instead of getting their own
+    Dify run. Returns the number of jobs that need a Dify run.
+    """
+    session = conn.execute(
+        'SELECT total_files, version FROM processing_sessions WHERE session_id = ?', (session_id,)
+    ).fetchone()
+    primaries = {row['file_hash']: row['file_index'] for row in conn.execute('''
+        SELECT file_hash, MIN(file_index) AS file_index FROM processing_jobs
+        WHERE session_id = ? AND duplicate_of IS NULL AND status IN ('queued', 'running')
+          AND file_hash IN (SELECT value FROM json_each(?))
+        GROUP BY file_hash
+    ''', (session_id, json.dumps(sorted({f['file_hash'] for f in valid_files}))))}
+    
+    now = time.time()
+    jobs = []
+    queued = []
+    result_seq = session['version']
+    for offset, f in enumerate(valid_files):
+        file_index = session['total_files'] + offset
+        job = {
+            'session_id': session_id,
+            'file_index': file_index,
+            'filename': f['filename'],
+            'file_hash': f['file_hash'],
+            'file_size': f['file_size'],
+            'status': 'queued',
+            'duplicate_of': None,
+            'queued_at': now,
+            'result': None,
+            'failed': None,
+            'result_extra': None,
+            'result_seq': None,
+            'completed_at': None,
+            'elapsed_seconds': None
+        }
+        cached = cached_results.get(f['file_hash'])
+        if cached is not None:
+            result_seq += 1
+            job.update({
+                'status': 'done',
+                'result': json.dumps(cached, ensure_ascii=False),
+                'failed': 0,
+                'result_extra': json.dumps({'cache_hit': True}),
+                'result_seq': result_seq,
+                'completed_at': now,
+                'elapsed_seconds': 0.0
+            })
+        elif f['file_hash'] in primaries:
+            job.update({'status': 'waiting', 'duplicate_of': primaries[f['file_hash']]})
+        else:
+            primaries[f['file_hash']] = file_index
+            queued.append(f['file_hash'])
+        jobs.append(job)
+    
+    # 同時に実行されたクリーンアップで参照の無くなったスプールが削除されていないか確認する
+    if any(not os.path.exists(spool_path(h)) for h in queued):
+        raise RuntimeError('アップロードされたファイルの一時保存が見つかりません。もう一度アップロードしてください')
+    
+    cache_hits = result_seq - session['version']
+    if cache_hits:
+        logger.info('Cache hit for %s file(s) in session %s', cache_hits, session_id)
+    
+    conn.executemany('''
+        INSERT INTO processing_jobs
+            (session_id, file_index, filename, file_hash, file_size, status, duplicate_of, queued_at,
+             result, failed, result_extra, result_seq, completed_at, elapsed_seconds)
+        VALUES
+            (:session_id, :file_index, :filename, :file_hash, :file_size, :status, :duplicate_of, :queued_at,
+             :result, :failed, :result_extra, :result_seq, :completed_at, :elapsed_seconds)
+    ''', jobs)
+    conn.execute('''
+        UPDATE processing_sessions
+        SET total_files = total_files + ?, processed_files = processed_files + ?, version = ?, updated_at = ?
+        WHERE session_id = ?
+    ''', (len(jobs), cache_hits, result_seq + 1, now, session_id))
+    return len(queued)
+
+def finish_session(conn, session_id, errors=()):
+    """Mark a session as fully received; it completes at once when no job is left to run"""
+    session = conn.execute('SELECT errors FROM processing_sessions WHERE session_id = ?', (session_id,)).fetchone()
+    if session is None:
+        return
+    remaining = conn.execute(
+        "SELECT COUNT(*) FROM processing_jobs WHERE session_id = ? AND status IN ('queued', 'running', 'waiting')",
+        (session_id,)
+    ).fetchone()[0]
+    conn.execute(
+        'UPDATE processing_sessions SET status = ?, errors = ? WHERE session_id = ?',
+        ('processing' if remaining else 'completed',
+         json.dumps(json.loads(session['errors']) + list(errors), ensure_ascii=False), session_id)
+    )
+    bump_session_version(conn, session_id)
+
+def enqueue_session(session_id, valid_files, errors, bypass_cache, profile=False):
+    """Store a new session and one job per file in the queue"""
+    cached_results = lookup_cached_results([f['file_hash'] for f in valid_files], bypass_cache)
+    with queue_transaction() as conn:
+        create_session(conn, session_id, errors, bypass_cache, profile)
+        queued = append_session_jobs(conn, session_id, valid_files, cached_results)
+        finish_session(conn, session_id)
+    
+    logger.info('Queued %s job(s) for session %s', queued, session_id)
+    schedule_preprocessing(f['file_hash'] for f in valid_files if f['file_hash'] not in cached_results)
+    notify_jobs_available()
+
+def claim_next_job():
+    """Lease the oldest runnable job to this process, or return None
+    
+    A job is runnable when it is queued or its lease has expired. The claim
+    respects DIFY_SESSION_WORKERS per session and DIFY_MAX_CONCURRENCY across
+    every process sharing the database.
+    """
+    now = time.time()
+    with queue_transaction() as conn:
+        row = conn.execute('''
+            UPDATE processing_jobs
+            SET status = 'running', lease_owner = :owner, lease_expires_at = :lease_expires_at,
+                started_at = :now, claim_count = claim_count + 1, current_attempt = 0,
+                stage = NULL, nodes_finished = 0, last_event_at = NULL, workflow_run_id = NULL,
+                throttle_seconds = 0
+            WHERE id = (
+                SELECT j.id FROM processing_jobs j
+                WHERE (j.status = 'queued' OR (j.status = 'running' AND j.lease_expires_at < :now))
+                  AND (
+                      SELECT COUNT(*) FROM processing_jobs r
+                      WHERE r.session_id = j.session_id AND r.status = 'running' AND r.lease_expires_at >= :now
+                  ) < :session_workers
+                ORDER BY j.queued_at, j.id
+                LIMIT 1
+            )
+            AND (
+                SELECT COUNT(*) FROM processing_jobs
+                WHERE status = 'running' AND lease_expires_at >= :now
+            ) < :max_concurrency
+            RETURNING id, session_id, file_index, filename, file_hash, count_processed, claim_count, queued_at,
+                      upload_file_id
+        ''', {
+            'owner': worker_id,
+            'lease_expires_at': now + DIFY_JOB_LEASE_SECONDS,
+            'now': now,
+            'session_workers': DIFY_SESSION_WORKERS,
+            'max_concurrency': DIFY_MAX_CONCURRENCY
+        }).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        bump_session_version(conn, job['session_id'])
+    
+    queue_wait_seconds.observe(max(0.0, now - job['queued_at']))
+    notify_session_changed()
+    return job
+
+def renew_job_leases():
+    """Keep extending the leases of the jobs this process is running"""
+    while True:
+        time.sleep(DIFY_JOB_LEASE_SECONDS / 3)
+        try:
+            with queue_transaction() as conn:
+                conn.execute(
+                    "UPDATE processing_jobs SET lease_expires_at = ? WHERE lease_owner = ? AND status = 'running'",
+                    (time.time() + DIFY_JOB_LEASE_SECONDS, worker_id)
+                )
+        except Exception as e:
+            logger.error('Failed to renew job leases: %s', e)
+
+def update_in_flight(session_id, file_index, **fields):
+    """Update the progress columns of a running job"""
+    write_in_flight({(session_id, file_index): fields})
+
+def write_in_flight(updates):
+    """Update the progress columns of running jobs, {(session_id, file_index): fields}, in one transaction
+    
+    throttle_added is added to throttle_seconds instead of replacing it.
+    """
+    changed = False
+    with queue_transaction() as conn:
+        for (session_id, file_index), fields in updates.items():
+            if session_id is None or not fields:
+                continue
+            assignments = ', '.join(
+                'throttle_seconds = throttle_seconds + ?' if name == 'throttle_added' else f'{name} = ?'
+                for name in fields
+            )
+            updated = conn.execute(
+                f"UPDATE processing_jobs SET {assignments} WHERE session_id = ? AND file_index = ? AND status = 'running'",
+                (*fields.values(), session_id, file_index)
+            ).rowcount
+            # pingによる last_event_at のみの更新は通知しない
+            if updated and set(fields) - {'last_event_at', 'throttle_added'}:
+                bump_session_version(conn, session_id)
+                changed = True
+    if changed:
+        notify_session_changed()
+
+def complete_job(job, result):
+    """Record the result of a claimed job and copy it to the duplicates waiting on it
+    
+    Nothing is written when the lease was lost and the job was claimed again.
+    """
+    session_id = job['session_id']
+    now = time.time()
+    failed = 'error' in result
+    result_json = json.dumps(result, ensure_ascii=False)
+    
+    with queue_transaction() as conn:
+        session = conn.execute(
+            'SELECT status, version, processed_files, total_files, errors FROM processing_sessions WHERE session_id = ?',
+            (session_id,)
+        ).fetchone()
+        if session is None:
+            return
+        result_seq = session['version'] + 1
+        
+        finished = conn.execute('''
+            UPDATE processing_jobs
+            SET status = ?, result = ?, failed = ?, result_seq = ?, completed_at = ?,
+                elapsed_seconds = ROUND(? - started_at, 1), lease_owner = NULL, lease_expires_at = NULL
+            WHERE id = ? AND status = 'running' AND claim_count = ?
+            RETURNING filename, count_processed
+        ''', (
+            'failed' if failed else 'done', result_json, int(failed), result_seq, now, now,
+            job['id'], job['claim_count']
+        )).fetchall()
+        if not finished:
+            logger.warning('Lease lost for %s, discarding result', job['filename'])
+            return
+        
+        duplicates = conn.execute('''
+            UPDATE processing_jobs
+            SET status = ?, result = ?, failed = ?, result_extra = ?, result_seq = ?, completed_at = ?,
+                elapsed_seconds = 0
+            WHERE session_id = ? AND duplicate_of = ? AND status = 'waiting'
+            RETURNING filename, count_processed
+        ''', (
+            'failed' if failed else 'done', result_json, int(failed),
+            json.dumps({'duplicate_of': job['file_index']}), result_seq, now,
+            session_id, job['file_index']
+        )).fetchall()
+        
+        finished = finished + duplicates
+        errors = json.loads(session['errors'])
+        if failed:
+            errors.extend(f'{row["filename"]}: {result["error"]}' for row in finished)
+        processed_files = session['processed_files'] + sum(row['count_processed'] for row in finished)
+        
+        remaining = conn.execute(
+            "SELECT COUNT(*) FROM processing_jobs WHERE session_id = ? AND status IN ('queued', 'running', 'waiting')",
+            (session_id,)
+        ).fetchone()[0]
+        # アップロード受信中のセッションは、受信が終わるまで完了にしない
+        if session['status'] == 'receiving':
+            status = 'receiving'
+        else:
+            status = 'processing' if remaining else 'completed'
+        conn.execute('''
+            UPDATE processing_sessions
+            SET version = ?, updated_at = ?, processed_files = ?, errors = ?, status = ?
+            WHERE session_id = ?
+        ''', (
+            result_seq, now, processed_files, json.dumps(errors, ensure_ascii=False), status, session_id
+        ))
+    
+    logger.debug('Completed %s/%s files', processed_files, session['total_files'])
+    if status == 'completed':
+        logger.info('Session %s completed', session_id)
+    notify_session_changed()
+
+# 前処理の設定が変わったら別のファイルとして作り直す
+PREPROCESS_SETTINGS_TAG = hashlib.sha256(json.dumps([
+    DIFY_PREPROCESS_MAX_EDGE, DIFY_PREPROCESS_TARGET_DPI, DIFY_PREPROCESS_GRAYSCALE
+]).encode('utf-8')).hexdigest()[:8]
+
+preprocess_pool = None
+preprocess_lock = Lock()
+preprocess_futures = {}
+
+def submit_preprocessing(file_hash):
+    """Start pre-processing a spooled upload in the process pool, reusing a run already in progress"""
+    global preprocess_pool
+    with preprocess_lock:
+        future = preprocess_futures.get(file_hash)
+        if future is not None:
+            return future
+        if preprocess_pool is None:
+            # Flaskのスレッドを抱えたままforkしないよう、子プロセスはspawnで起動する
+            preprocess_pool = ProcessPoolExecutor(
+                max_workers=DIFY_PREPROCESS_WORKERS, mp_context=multiprocessing.get_context('spawn')
+            )
+        future = preprocess_pool.submit(
+            preprocess_image, spool_path(file_hash), preprocessed_path(file_hash),
+            DIFY_PREPROCESS_MAX_EDGE, DIFY_PREPROCESS_TARGET_DPI, DIFY_PREPROCESS_GRAYSCALE,
+            DIFY_PREPROCESS_MAX_PIXELS
+        )
+        preprocess_futures[file_hash] = future
+    future.add_done_callback(lambda _: preprocess_futures.pop(file_hash, None))
+    return future
+
+def schedule_preprocessing(file_hashes):
+    """Pre-process newly queued uploads in the background while they wait for a worker"""
+    if not DIFY_PREPROCESS_ENABLED:
+        return
+    for file_hash in set(file_hashes):
+        if not os.path.exists(preprocessed_path(file_hash)):
+            submit_preprocessing(file_hash)
+
+def prepare_upload(file_hash):
+    """Return the path to send to Dify and the processed size (None when pre-processing is off)"""
+    if not DIFY_PREPROCESS_ENABLED:
+        return spool_path(file_hash), None
+    path = preprocessed_path(file_hash)
+    if not os.path.exists(path):
+        submit_preprocessing(file_hash).result()
+    return path, os.path.getsize(path)
+
+def process_single_file(job):
+    """Run one claimed job, counting it in the in-flight gauge and the job duration histogram"""
+    with running_job(job) as labels:
+        if PROFILING_ENABLED and is_session_profiled(job['session_id']):
+            with profiled('job', job['filename'], session_id=job['session_id'], file_index=job['file_index']):
+                result = run_claimed_job(job)
+        else:
+            result = run_claimed_job(job)
+        labels['outcome'] = 'failed' if 'error' in result else 'succeeded'
+
+@contextmanager
+def running_job(job):
+    """Count a claimed job in the in-flight gauge and duration histogram and tag its log records
     
-    for i, file_info in enumerate(valid_files):
+    Yields the histogram labels; set 'outcome' once the job has a result.
+    """
+    jobs_in_flight.inc()
+    try:
+        with log_correlation(job['session_id'], job['file_index']), job_seconds.time(outcome='aborted') as labels:
+            yield labels
+    finally:
+        jobs_in_flight.dec()
+
+def is_session_profiled(session_id):
+    row = connect_queue_db().execute('SELECT profile FROM processing_sessions WHERE session_id = ?', (session_id,)).fetchone()
+    return bool(row and row['profile'])
+
+def run_claimed_job(job):
+    """Run one claimed job through Dify and record its result; returns the result"""
+    result = interrupted_job_result(job)
+    if result is None:
+        report = job_progress(job['session_id'], job['file_index'])
+        logger.info('Processing file %s: %s', job['file_index'] + 1, job['filename'])
+        try:
+            # 壊れた画像・大きすぎる画像は前処理でValueErrorとなり、Difyに送らずに失敗とする
+            upload_path, processed_size = prepare_upload(job['file_hash'])
+            if processed_size is not None:
+                report(stage='前処理完了', processed_size=processed_size)
+            with open(upload_path, 'rb') as file_obj:
+                result = send_to_dify_with_progress(file_obj, job['filename'], report, job['upload_file_id'])
+        except Exception as e:
+            result = job_error_result(job['filename'], e)
+    
+    finish_job(job, result)
+    return result
+
+def interrupted_job_result(job):
+    """Return the error result for a job whose runs were interrupted too often, or None if it may run"""
+    if job['claim_count'] <= DIFY_JOB_MAX_CLAIMS:
+        return None
+    logger.warning('Giving up on %s after %s interrupted runs', job['filename'], job['claim_count'] - 1)
+    return {'error': f'処理が{DIFY_JOB_MAX_CLAIMS}回中断されたため中止しました'}
+
+def job_error_result(filename, error):
+    """Return the result recorded for a job that failed outside the Dify calls"""
+    if isinstance(error, FileNotFoundError):
+        logger.warning('Spooled upload missing for %s', filename)
+        return {'error': 'アップロードされたファイルの一時保存が見つかりません'}
+    logger.error('Error processing %s: %s', filename, error)
+    return {'error': str(error)}
+
+def finish_job(job, result, progress=None):
+    """Cache a successful result and record the job's outcome
+    
+    progress holds fields reported but not yet written (asyncio dispatcher);
+    they are written first so the job's throttle time is not lost.
+    """
+    if progress:
+        write_in_flight({(job['session_id'], job['file_index']): progress})
+    if 'error' not in result:
+        try:
+            store_cached_result(job['file_hash'], result)
+        except Exception as e:
+            logger.warning('Failed to store cached result for %s: %s', job['filename'], e)
+    complete_job(job, result)
+
+
+def run_job_worker():
+    """Claim and process queued jobs for as long as the process runs"""
+    while True:
+        # Difyが停止中は新しいジョブを取得せずキューに残しておく
+        if dify_breaker.is_open():
+            time.sleep(DIFY_QUEUE_POLL_SECONDS)
+            continue
+        
         try:
-            filename = file_info['filename']
-            file_data = file_info['file_data']
+            job = claim_next_job()
+        except Exception as e:
+            logger.error('Failed to claim job: %s', e)
+            job = None
+        
+        if job is None:
+            with jobs_available:
+                jobs_available.wait(timeout=DIFY_QUEUE_POLL_SECONDS)
+            continue
+        
+        try:
+            process_single_file(job)
+        except Exception as e:
+            # 結果を記録できなかったジョブはリース切れ後に再取得される
+            logger.error('Job %s aborted: %s', job['id'], e)
+
+class AsyncDifyClient:
+    """httpx-based Dify client for the asyncio dispatcher, sharing one connection pool across all tasks"""
+    
+    def __init__(self, base_url, api_key, pool_size=10, connect_timeout=30, upload_timeout=30,
+                 read_timeout=300, stream_idle_timeout=60, user='dify-flask-app'):
+        self.base_url = base_url.rstrip('/')
+        self.user = user
+        self.connect_timeout = connect_timeout
+        self.upload_timeout = upload_timeout
+        self.read_timeout = read_timeout
+        self.stream_idle_timeout = stream_idle_timeout
+        # 接続が埋まっている場合は空きを待つ（pool=None で待ち時間の上限なし）
+        self.client = httpx.AsyncClient(
+            headers={'Authorization': f'Bearer {api_key}'} if api_key else {},
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        )
+    
+    async def upload_file(self, file_obj, filename, mimetype='image/png'):
+        """POST the file to /v1/files/upload; httpx reads it in chunks while sending"""
+        file_obj.seek(0)
+        return await self.client.post(
+            f"{self.base_url}/v1/files/upload",
+            data={'user': self.user},
+            files={'file': (filename, file_obj, mimetype)},
+            timeout=httpx.Timeout(self.upload_timeout, connect=self.connect_timeout, pool=None)
+        )
+    
+    async def run_workflow(self, workflow_payload):
+        """POST the payload to /v1/workflows/run; in streaming mode the body is left unread
+        
+        As with DifyClient, the read timeout is the maximum silence between two SSE
+        events when streaming, and the whole run otherwise.
+        """
+        stream = workflow_payload.get('response_mode') == 'streaming'
+        request = self.client.build_request(
+            'POST', f"{self.base_url}/v1/workflows/run", json=workflow_payload,
+            timeout=httpx.Timeout(
+                self.stream_idle_timeout if stream else self.read_timeout, connect=self.connect_timeout, pool=None
+            )
+        )
+        response = await self.client.send(request, stream=stream)
+        if stream and response.status_code != 200:
+            await response.aread()
+            await response.aclose()
+        return response
+    
+    async def aiter_events(self, response):
+        """Yield the decoded SSE events of a streaming workflow response"""
+        decoder = SseDecoder()
+        async for line in response.aiter_lines():
+            event = decoder.feed(line)
+            if event is not None:
+                yield event
+        event = decoder.finish()
+        if event is not None:
+            yield event
+
+class JobProgressBuffer:
+    """Hold the progress reported by the asyncio dispatcher's jobs until the next flush
+    
+    Streamed events and waits are reported many times a second across all
+    jobs; keeping them in memory lets the dispatcher write them in one
+    transaction per ASYNC_PROGRESS_FLUSH_SECONDS instead of one thread hop and
+    write each. A later value of a field replaces the earlier one, throttle_added adds up.
+    Only used from the event loop, so it needs no lock.
+    """
+    
+    def __init__(self):
+        self.pending = {}
+    
+    def reporter(self, session_id, file_index):
+        """Return the report(**fields) function for one job"""
+        def report(**fields):
+            self.add((session_id, file_index), fields)
+        return report
+    
+    def add(self, key, fields):
+        if key[0] is None:
+            return
+        pending = self.pending.setdefault(key, {})
+        throttle_added = pending.get('throttle_added', 0) + fields.get('throttle_added', 0)
+        pending.update(fields)
+        if throttle_added:
+            pending['throttle_added'] = throttle_added
+    
+    def pop(self, session_id, file_index):
+        """Take the fields not yet written for one job"""
+        return self.pending.pop((session_id, file_index), None)
+    
+    def take(self):
+        """Take everything not yet written as {(session_id, file_index): fields}"""
+        pending, self.pending = self.pending, {}
+        return pending
+
+# asyncioのディスパッチャーがジョブの進捗をまとめてDBへ書き込む間隔（秒）
+ASYNC_PROGRESS_FLUSH_SECONDS = 0.5
+
+# 以下は send_to_dify_with_progress とその呼び出し先のasyncio版。判断は同期版と共通の関数で行い、
+# 違いは通信と待機（await）だけにする
+
+async def upload_file_async(client, file_obj, filename, report):
+    with upload_errors(filename):
+        logger.debug('Uploading file to Dify...')
+        file_id = uploaded_file_id(await client.upload_file(file_obj, filename))
+    report(upload_file_id=file_id)
+    return file_id
+
+async def wait_for_rate_limit_async(kind, report):
+    waited = 0.0
+    if not dify_rate_limiter.try_acquire_slot():
+        report(stage='同時実行数の上限で待機')
+        started = time.monotonic()
+        while not dify_rate_limiter.try_acquire_slot():
+            await dify_dispatcher.wait_for_slot()
+        waited += dify_rate_limiter.record_slot_wait(time.monotonic() - started)
+    
+    try:
+        delay = dify_rate_limiter.reserve()
+        if delay > 0:
+            if delay >= 1:
+                report(stage='流量制限で待機')
+            await asyncio.sleep(delay)
+            waited += delay
+        record_throttle_wait(kind, waited, report)
+    except BaseException:
+        dify_rate_limiter.release(None)
+        dify_dispatcher.slot_released()
+        raise
+
+@asynccontextmanager
+async def rate_limited_async(kind, report):
+    await wait_for_rate_limit_async(kind, report)
+    started = time.monotonic()
+    call = {'status_code': None}
+    try:
+        yield call
+    finally:
+        release_rate_limit(kind, started, call['status_code'])
+        dify_dispatcher.slot_released()
+
+async def wait_for_dify_breaker_async(report):
+    waiting = False
+    while True:
+        delay, probe = dify_breaker.before_call()
+        if delay <= 0:
+            return probe
+        if not waiting:
+            logger.info('Dify circuit breaker open, waiting %.1fs', delay)
+            report(stage='Dify停止中のため待機')
+            waiting = True
+        await asyncio.sleep(min(delay, 1.0))
+
+async def call_dify_async(kind, report, func, *args):
+    probe = await wait_for_dify_breaker_async(report)
+    try:
+        async with rate_limited_async(kind, report) as call:
+            with dify_call_outcome(call):
+                return await func(*args)
+    finally:
+        if probe:
+            dify_breaker.release_probe()
+
+async def run_workflow_once_async(client, file_id, filename, report):
+    workflow_response = await client.run_workflow(workflow_payload(file_id))
+    
+    logger.debug('Workflow response status: %s', workflow_response.status_code)
+    if workflow_response.status_code != 200:
+        raise workflow_run_error(workflow_response, file_id)
+    
+    if DIFY_RESPONSE_MODE == 'streaming':
+        workflow_result = await consume_workflow_stream_async(client, workflow_response, report)
+    else:
+        workflow_result = blocking_workflow_result(workflow_response)
+    return workflow_result_data(workflow_result, filename)
+
+async def consume_workflow_stream_async(client, workflow_response, report):
+    # イベントはループ上で処理し、進捗はreportでバッファに溜めるだけにする
+    progress = {'nodes_finished': 0}
+    try:
+        async for event in client.aiter_events(workflow_response):
+            workflow_result = handle_workflow_event(event, progress, report)
+            if workflow_result is not None:
+                return workflow_result
+    finally:
+        await workflow_response.aclose()
+    
+    logger.warning('Workflow stream ended without workflow_finished event')
+    return {}
+
+async def send_to_dify_async(client, file_obj, filename, report, file_id=None, retry_policy=None):
+    """send_to_dify_with_progress for the asyncio dispatcher"""
+    retry_policy = retry_policy or dify_retry_policy
+    logger.debug('Starting Dify API call for %s', filename)
+    if file_id:
+        logger.debug('Reusing uploaded file ID: %s', file_id)
+    
+    for attempt in range(1, retry_policy.max_attempts + 1):
+        start_attempt(attempt, retry_policy, filename, report)
+        try:
+            if not file_id:
+                file_id = await call_dify_async('upload', report, upload_file_async, client, file_obj, filename, report)
+            return await call_dify_async('workflow', report, run_workflow_once_async, client, file_id, filename, report)
+        except Exception as e:
+            failure = attempt_failure(e, attempt, filename)
+        
+        result, delay = plan_retry(failure, attempt, retry_policy, filename, file_id, report)
+        if result is not None:
+            return result
+        if failure.reupload:
+            file_id = None
+        await asyncio.sleep(delay)
+    
+    return {'error': f'予期しないエラーが発生しました (最大{retry_policy.max_attempts}回試行後)'}
+
+class AsyncDifyDispatcher:
+    """Run this process's queued jobs as tasks on one asyncio event loop (DIFY_DISPATCHER=asyncio)
+    
+    A single thread owns every Dify upload and workflow run. Up to capacity
+    jobs are claimed from the SQLite queue and run concurrently as coroutines,
+    so a waiting job costs a task rather than an OS thread blocked in requests.
+    Progress is buffered and flushed periodically; only claims, the flush and
+    finishing a job go through asyncio.to_thread.
+    """
+    
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.loop = None
+        self.client = None
+        self.wakeup = None
+        self.started = Event()
+        self.slot_freed = None
+        self.progress = JobProgressBuffer()
+        self.in_flight = {}
+    
+    def start(self):
+        Thread(target=asyncio.run, args=(self.main(),), name='dify-dispatcher', daemon=True).start()
+        self.started.wait()
+    
+    def submit(self, coroutine):
+        """Run a coroutine on the dispatcher's loop from any thread and return a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+    
+    def notify(self):
+        """Wake the claim loop from any thread"""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+    
+    async def wait_for_slot(self):
+        """Wait until a task on the loop gives back a rate limiter slot (or briefly, for slots freed elsewhere)"""
+        try:
+            await asyncio.wait_for(self.slot_freed.wait(), 0.2)
+        except asyncio.TimeoutError:
+            pass
+    
+    def slot_released(self):
+        # 待っているタスクをすべて起こし、次の待機には新しいEventを使う
+        self.slot_freed.set()
+        self.slot_freed = asyncio.Event()
+    
+    def snapshot(self):
+        jobs = list(self.in_flight.values())
+        return {
+            'mode': 'asyncio',
+            'capacity': self.capacity,
+            'in_flight': len(jobs),
+            'jobs': sorted(jobs, key=lambda job: job['started_at'])
+        }
+    
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.slot_freed = asyncio.Event()
+        self.client = AsyncDifyClient(
+            DIFY_API_BASE_URL,
+            DIFY_API_KEY,
+            pool_size=DIFY_POOL_SIZE,
+            connect_timeout=DIFY_CONNECT_TIMEOUT,
+            upload_timeout=DIFY_UPLOAD_TIMEOUT,
+            read_timeout=DIFY_READ_TIMEOUT,
+            stream_idle_timeout=DIFY_STREAM_IDLE_TIMEOUT
+        )
+        slots = asyncio.Semaphore(self.capacity)
+        flusher = asyncio.create_task(self.flush_progress())
+        self.started.set()
+        
+        while True:
+            # Difyが停止中は新しいジョブを取得せずキューに残しておく
+            if dify_breaker.is_open():
+                await asyncio.sleep(DIFY_QUEUE_POLL_SECONDS)
+                continue
             
-            print(f"DEBUG: Processing file {i+1}/{len(valid_files)}: {filename}")
+            await slots.acquire()
+            # 取得の前にクリアし、取得中に届いた通知を取りこぼさない
+            self.wakeup.clear()
+            try:
+                job = await asyncio.to_thread(claim_next_job)
+            except Exception as e:
+                logger.error('Failed to claim job: %s', e)
+                job = None
             
-            with session_lock:
-                if session_id in processing_sessions:
-                    processing_sessions[session_id]['current_processing'] = {
-                        'file_index': i,
-                        'filename': filename,
-                        'started_at': time.time(),
-                        'current_attempt': 0
-                    }
-            
-            from io import BytesIO
-            file_obj = BytesIO(file_data)
-            
-            result = send_to_dify_with_progress(file_obj, filename, session_id, i)
-            
-            with session_lock:
-                if session_id in processing_sessions:
-                    session = processing_sessions[session_id]
-                    
-                    elapsed_time = time.time() - session['current_processing']['started_at']
-                    session['current_processing'] = None
-                    
-                    if 'error' in result:
-                        session['errors'].append(f'{filename}: {result["error"]}')
-                        session['results'].append({
-                            'filename': filename,
-                            'file_index': i,
-                            'result': result,
-                            'failed': True,
-                            'completed_at': time.time(),
-                            'elapsed_seconds': round(elapsed_time, 1)
-                        })
-                    else:
-                        session['results'].append({
-                            'filename': filename,
-                            'file_index': i,
-                            'result': result,
-                            'failed': False,
-                            'completed_at': time.time(),
-                            'elapsed_seconds': round(elapsed_time, 1)
-                        })
-                    
-                    session['processed_files'] += 1
-                    print(f"DEBUG: Completed {session['processed_files']}/{session['total_files']} files")
-                    
+            if job is None:
+                slots.release()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), DIFY_QUEUE_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            task = asyncio.create_task(self.run_job(job))
+            task.add_done_callback(lambda _: self.job_finished(slots))
+    
+    async def flush_progress(self):
+        """Write the buffered progress of all jobs in one transaction, every ASYNC_PROGRESS_FLUSH_SECONDS"""
+        while True:
+            await asyncio.sleep(ASYNC_PROGRESS_FLUSH_SECONDS)
+            updates = self.progress.take()
+            if not updates:
+                continue
+            try:
+                await asyncio.to_thread(write_in_flight, updates)
+            except Exception as e:
+                logger.error('Failed to write job progress: %s', e)
+    
+    def job_finished(self, slots):
+        # 終了したジョブの分だけセッションごと・全体の上限に空きができたので、すぐに次を取得する
+        slots.release()
+        self.wakeup.set()
+    
+    async def run_job(self, job):
+        self.in_flight[job['id']] = {
+            'session_id': job['session_id'],
+            'file_index': job['file_index'],
+            'filename': job['filename'],
+            'started_at': time.time()
+        }
+        try:
+            with running_job(job) as labels:
+                result = await self.run_claimed_job(job)
+                labels['outcome'] = 'failed' if 'error' in result else 'succeeded'
         except Exception as e:
-            print(f"DEBUG: Error processing {filename}: {str(e)}")
-            with session_lock:
-                if session_id in processing_sessions:
-                    elapsed_time = time.time() - processing_sessions[session_id]['current_processing']['started_at']
-                    processing_sessions[session_id]['current_processing'] = None
-                    processing_sessions[session_id]['errors'].append(f'{filename}: {str(e)}')
-                    processing_sessions[session_id]['results'].append({
-                        'filename': filename,
-                        'file_index': i,
-                        'result': {'error': str(e)},
-                        'failed': True,
-                        'completed_at': time.time(),
-                        'elapsed_seconds': round(elapsed_time, 1)
-                    })
-                    processing_sessions[session_id]['processed_files'] += 1
+            # 結果を記録できなかったジョブはリース切れ後に再取得される
+            logger.error('Job %s aborted: %s', job['id'], e)
+        finally:
+            self.progress.pop(job['session_id'], job['file_index'])
+            del self.in_flight[job['id']]
     
-    with session_lock:
-        if session_id in processing_sessions:
-            processing_sessions[session_id]['status'] = 'completed'
-            processing_sessions[session_id]['current_processing'] = None
-            print(f"DEBUG: Session {session_id} completed")
+    async def run_claimed_job(self, job):
+        """run_claimed_job on the event loop"""
+        result = interrupted_job_result(job)
+        if result is None:
+            report = self.progress.reporter(job['session_id'], job['file_index'])
+            logger.info('Processing file %s: %s', job['file_index'] + 1, job['filename'])
+            try:
+                # 前処理はプロセスプールで実行し、その間もループは他のジョブを進める
+                if DIFY_PREPROCESS_ENABLED and not os.path.exists(preprocessed_path(job['file_hash'])):
+                    await asyncio.wrap_future(submit_preprocessing(job['file_hash']))
+                upload_path, processed_size = prepare_upload(job['file_hash'])
+                if processed_size is not None:
+                    report(stage='前処理完了', processed_size=processed_size)
+                with open(upload_path, 'rb') as file_obj:
+                    result = await send_to_dify_async(self.client, file_obj, job['filename'], report, job['upload_file_id'])
+            except Exception as e:
+                result = job_error_result(job['filename'], e)
+        
+        progress = self.progress.pop(job['session_id'], job['file_index'])
+        await asyncio.to_thread(finish_job, job, result, progress)
+        return result
+
+dify_dispatcher = None
+
+# セッションごとの保存量: 分析結果・エラーのJSONとスプールしたPNG（セッション内の同一ファイルは1回だけ数える）
+SESSION_STORAGE_SQL = '''
+    SELECT s.session_id, s.status, s.updated_at,
+           LENGTH(CAST(s.errors AS BLOB))
+           + COALESCE(SUM(LENGTH(CAST(j.result AS BLOB))), 0)
+           + COALESCE(SUM(CASE WHEN j.hash_rank = 1 THEN j.file_size END), 0) AS stored_bytes
+    FROM processing_sessions s
+    LEFT JOIN (
+        SELECT session_id, result, file_size,
+               ROW_NUMBER() OVER (PARTITION BY session_id, file_hash ORDER BY file_index) AS hash_rank
+        FROM processing_jobs
+    ) j ON j.session_id = s.session_id
+'''
+
+def delete_session(conn, session_id):
+    """Delete a session with its jobs and unreferenced spool files; call inside a queue transaction
+    
+    Returns the bytes the session was storing, or None if it did not exist.
+    """
+    row = conn.execute(SESSION_STORAGE_SQL + ' WHERE s.session_id = ? GROUP BY s.session_id', (session_id,)).fetchone()
+    if row is None:
+        return None
+    
+    conn.execute('DELETE FROM processing_sessions WHERE session_id = ?', (session_id,))
+    file_hashes = {r['file_hash'] for r in conn.execute(
+        'DELETE FROM processing_jobs WHERE session_id = ? RETURNING file_hash', (session_id,)
+    ).fetchall()}
+    remove_unreferenced_spool_files(conn, file_hashes)
+    return row['stored_bytes']
+
+def increment_reaper_stats(conn, **increments):
+    conn.executemany('''
+        INSERT INTO session_reaper_stats (name, value) VALUES (?, ?)
+        ON CONFLICT (name) DO UPDATE SET value = value + excluded.value
+    ''', increments.items())
+
+def remove_stale_spool_parts(max_age=60 * 60):
+    """Delete partial spool files left behind by interrupted uploads"""
+    if not os.path.isdir(DIFY_SPOOL_DIR):
+        return
+    cutoff = time.time() - max_age
+    for entry in os.scandir(DIFY_SPOOL_DIR):
+        if entry.name.endswith('.part') and entry.stat().st_mtime < cutoff:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+def reap_sessions():
+    """Delete completed sessions past their TTL, then evict the oldest completed ones while over budget"""
+    now = time.time()
+    budget_bytes = DIFY_SESSION_STORAGE_BUDGET_MB * 1024 * 1024
+    expired = evicted = reclaimed_bytes = 0
+    
+    with queue_transaction() as conn:
+        sessions = conn.execute(SESSION_STORAGE_SQL + ' GROUP BY s.session_id ORDER BY s.updated_at').fetchall()
+        total_bytes = sum(row['stored_bytes'] for row in sessions)
+        
+        for row in sessions:
+            # 受信中のまま更新が途絶えたセッション（アップロード中にプロセスが停止した等）もTTLで削除する
+            if row['status'] not in ('completed', 'receiving'):
+                continue
+            if row['updated_at'] < now - DIFY_SESSION_TTL_SECONDS:
+                expired += 1
+            elif total_bytes > budget_bytes and row['status'] == 'completed':
+                evicted += 1
+            else:
+                continue
+            delete_session(conn, row['session_id'])
+            total_bytes -= row['stored_bytes']
+            reclaimed_bytes += row['stored_bytes']
+        
+        increment_reaper_stats(
+            conn, expired_sessions=expired, evicted_sessions=evicted, reclaimed_bytes=reclaimed_bytes
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO session_reaper_stats (name, value) VALUES ('last_reap_at', ?)", (now,)
+        )
+    
+    remove_stale_spool_parts()
+    
+    if expired or evicted:
+        logger.info('Reaped %s expired and %s evicted session(s), %s bytes', expired, evicted, reclaimed_bytes)
+        notify_session_changed()
+
+def run_session_reaper():
+    """Reap sessions every DIFY_SESSION_REAP_INTERVAL seconds for as long as the process runs"""
+    while True:
+        time.sleep(DIFY_SESSION_REAP_INTERVAL)
+        try:
+            reap_sessions()
+        except Exception as e:
+            logger.error('Session reaper failed: %s', e)
+
+worker_id = None
+job_workers_lock = Lock()
+
+def start_job_workers():
+    """Start this process's queue workers, lease keeper and session reaper once"""
+    global worker_id
+    with job_workers_lock:
+        if worker_id is not None:
+            return
+        worker_id = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+    
+    Thread(target=run_session_reaper, name='dify-session-reaper', daemon=True).start()
+    
+    if DIFY_QUEUE_WORKERS == 0:
+        logger.info('Queue workers disabled in %s', worker_id)
+        return
+    
+    Thread(target=renew_job_leases, name='dify-lease-keeper', daemon=True).start()
+    if DIFY_DISPATCHER == 'asyncio':
+        start_async_dispatcher()
+        logger.info('Started asyncio dispatcher for %s concurrent jobs in %s', DIFY_QUEUE_WORKERS, worker_id)
+        return
+    
+    for n in range(DIFY_QUEUE_WORKERS):
+        Thread(target=run_job_worker, name=f'dify-worker-{n}', daemon=True).start()
+    logger.info('Started %s queue workers in %s', DIFY_QUEUE_WORKERS, worker_id)
+
+def start_async_dispatcher():
+    global dify_dispatcher
+    dispatcher = AsyncDifyDispatcher(DIFY_QUEUE_WORKERS)
+    dispatcher.start()
+    dify_dispatcher = dispatcher
+
+@app.before_request
+def ensure_job_workers():
+    # gunicorn等でフォークした後の各ワーカープロセスで最初のリクエスト時に起動する
+    start_job_workers()
+
+@app.before_request
+def start_request_profile():
+    # 一覧・ダウンロードのリクエスト自体は計測しない
+    g.profile_request = profiling_requested() and request.endpoint not in ('list_profiles', 'download_profile')
+    if g.profile_request:
+        g.profiler = start_profiler()
+        g.profile_started = time.perf_counter()
+
+@app.after_request
+def record_profile_status(response):
+    if getattr(g, 'profiler', None) is not None:
+        g.profile_status = response.status_code
+    return response
+
+@app.teardown_request
+def finish_request_profile(exc):
+    profiler = getattr(g, 'profiler', None)
+    if profiler is None:
+        return
+    profiler.disable()
+    g.profiler = None
+    try:
+        save_profile(
+            profiler, 'request', request.endpoint or 'unknown', time.perf_counter() - g.profile_started,
+            method=request.method, path=request.path, status=getattr(g, 'profile_status', 500)
+        )
+    except Exception as e:
+        logger.error('Failed to save profile: %s', e)
+
+class SessionRecord(namedtuple('SessionRecord', [
+    'session_id', 'status', 'total_files', 'processed_files', 'errors',
+    'bypass_cache', 'version', 'created_at', 'updated_at'
+])):
+    """One processing_sessions row"""
+    __slots__ = ()
+    
+    @classmethod
+    def from_row(cls, row):
+        return cls(
+            row['session_id'], row['status'], row['total_files'], row['processed_files'],
+            json.loads(row['errors']), bool(row['bypass_cache']), row['version'],
+            row['created_at'], row['updated_at']
+        )
+    
+    @property
+    def completed(self):
+        return self.status == 'completed'
+    
+    @property
+    def progress_percentage(self):
+        # ZIPの受信中（receiving）はまだファイル数が0の場合がある
+        if not self.total_files:
+            return 0.0
+        return round((self.processed_files / self.total_files) * 100, 1)
+
+class JobResult(namedtuple('JobResult', [
+    'filename', 'file_index', 'result', 'failed', 'completed_at', 'elapsed_seconds', 'extra'
+])):
+    """The recorded result of one job"""
+    __slots__ = ()
+    
+    @classmethod
+    def from_row(cls, row):
+        extra = json.loads(row['result_extra'] or '{}')
+        if row['processed_size'] is not None:
+            extra.update({'original_bytes': row['file_size'], 'processed_bytes': row['processed_size']})
+        return cls(
+            row['filename'], row['file_index'], json.loads(row['result']), bool(row['failed']),
+            row['completed_at'], row['elapsed_seconds'], extra
+        )
+    
+    def to_dict(self):
+        return {
+            'filename': self.filename,
+            'file_index': self.file_index,
+            'result': self.result,
+            'failed': self.failed,
+            'completed_at': self.completed_at,
+            'elapsed_seconds': self.elapsed_seconds,
+            **self.extra
+        }
+
+# session: SessionRecord, new_results: JobResultのリスト
+SessionSnapshot = namedtuple('SessionSnapshot', [
+    'session', 'new_results', 'total_results_count', 'current_processing', 'throttle_wait_seconds'
+])
+
+def load_session_snapshot(session_id, last_result_count=0):
+    """Read a consistent view of a session from the queue, or None if it does not exist"""
+    with queue_snapshot() as conn:
+        session = conn.execute('SELECT * FROM processing_sessions WHERE session_id = ?', (session_id,)).fetchone()
+        if session is None:
+            return None
+        
+        total_results_count, throttle_wait_seconds = conn.execute(
+            'SELECT COUNT(result_seq), COALESCE(SUM(throttle_seconds), 0) FROM processing_jobs WHERE session_id = ?',
+            (session_id,)
+        ).fetchone()
+        result_rows = conn.execute('''
+            SELECT filename, file_index, result, failed, completed_at, elapsed_seconds, result_extra,
+                   file_size, processed_size
+            FROM processing_jobs
+            WHERE session_id = ? AND result_seq IS NOT NULL
+            ORDER BY result_seq, file_index
+            LIMIT -1 OFFSET ?
+        ''', (session_id, max(0, last_result_count))).fetchall()
+        running_rows = conn.execute('''
+            SELECT file_index, filename, current_attempt, started_at, stage, nodes_finished, last_event_at
+            FROM processing_jobs
+            WHERE session_id = ? AND status = 'running'
+            ORDER BY file_index
+        ''', (session_id,)).fetchall()
+    
+    return SessionSnapshot(
+        SessionRecord.from_row(session),
+        [JobResult.from_row(row) for row in result_rows],
+        total_results_count,
+        build_current_processing_info(running_rows),
+        round(throttle_wait_seconds, 1)
+    )
+
+def get_session_version(session_id):
+    """Return the current version of a session, or None if it does not exist"""
+    row = connect_queue_db().execute('SELECT version FROM processing_sessions WHERE session_id = ?', (session_id,)).fetchone()
+    return row['version'] if row else None
+
+def build_current_processing_info(running_rows):
+    """Describe the running jobs of a session"""
+    current_processing_info = []
+    for row in running_rows:
+        elapsed_time = time.time() - row['started_at']
+        last_event_at = row['last_event_at']
+        current_processing_info.append({
+            'file_index': row['file_index'],
+            'filename': row['filename'],
+            'current_attempt': row['current_attempt'],
+            'elapsed_seconds': round(elapsed_time, 1),
+            'stage': row['stage'],
+            'nodes_finished': row['nodes_finished'],
+            'idle_seconds': round(time.time() - last_event_at, 1) if last_event_at else None
+        })
+    return current_processing_info
 
 @app.route('/api/dify/session/<session_id>/status')
 def get_session_status(session_id):
     """Get current status and results for a processing session"""
     try:
-        if session_id not in processing_sessions:
+        last_check = request.args.get('last_result_count', 0, type=int)
+        snapshot = load_session_snapshot(session_id, last_check)
+        if snapshot is None:
             return jsonify({'error': 'Session not found'}), 404
         
-        with session_lock:
-            session = processing_sessions[session_id]
+        session = snapshot.session
+        return jsonify({
+            'session_id': session_id,
+            'status': session.status,
+            'processed_files': session.processed_files,
+            'total_files': session.total_files,
+            'progress_percentage': session.progress_percentage,
+            'new_results': [result.to_dict() for result in snapshot.new_results],
+            'total_results_count': snapshot.total_results_count,
+            'errors': session.errors,
+            'completed': session.completed,
+            'current_processing': snapshot.current_processing,
+            'throttle_wait_seconds': snapshot.throttle_wait_seconds,
+            'rate_limit': dify_rate_limiter.snapshot()
+        })
             
-            last_check = request.args.get('last_result_count', 0, type=int)
-            new_results = session['results'][last_check:]
+    except Exception as e:
+        return jsonify({'error': f'Status check error: {str(e)}'}), 500
+
+def format_sse_event(event, data, event_id=None):
+    """Format one Server-Sent Events message"""
+    message = f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+    if event_id is not None:
+        message = f'id: {event_id}\n' + message
+    return message
+
+@app.route('/api/dify/session/<session_id>/events')
+def stream_session_events(session_id):
+    """Push result, progress and completed events for a processing session (Server-Sent Events)"""
+    if get_session_version(session_id) is None:
+        return jsonify({'error': 'Session not found'}), 404
+    
+    last_result_count = request.args.get('last_result_count', 0, type=int)
+    
+    def generate():
+        sent_results = last_result_count
+        seen_version = None
+        idle_since = time.time()
+        yield 'retry: 3000\n\n'
+        
+        while True:
+            version = get_session_version(session_id)
+            if version is not None and version == seen_version:
+                # 同一プロセス内の変更は即座に、他プロセスの変更はSSE_POLL_SECONDS以内に検知する
+                with session_lock:
+                    session_changed.wait(timeout=SSE_POLL_SECONDS)
+                version = get_session_version(session_id)
             
-            current_processing = session.get('current_processing')
-            current_processing_info = None
+            if version is None:
+                yield format_sse_event('error', {'error': 'Session not found'})
+                return
             
-            if current_processing:
-                elapsed_time = time.time() - current_processing['started_at']
-                current_processing_info = {
-                    'file_index': current_processing['file_index'],
-                    'filename': current_processing['filename'],
-                    'current_attempt': current_processing['current_attempt'],
-                    'elapsed_seconds': round(elapsed_time, 1)
-                }
+            if version == seen_version:
+                if time.time() - idle_since >= SSE_KEEPALIVE_SECONDS:
+                    idle_since = time.time()
+                    yield ': keepalive\n\n'
+                continue
             
-            return jsonify({
-                'session_id': session_id,
-                'status': session['status'],
-                'processed_files': session['processed_files'],
-                'total_files': session['total_files'],
-                'progress_percentage': round((session['processed_files'] / session['total_files']) * 100, 1),
-                'new_results': new_results,
-                'total_results_count': len(session['results']),
-                'errors': session['errors'],
-                'completed': session['status'] == 'completed',
-                'current_processing': current_processing_info
-            })
+            snapshot = load_session_snapshot(session_id, sent_results)
+            if snapshot is None:
+                yield format_sse_event('error', {'error': 'Session not found'})
+                return
             
-    except Exception as e:
-        return jsonify({'error': f'Status check error: {str(e)}'}), 500
+            session = snapshot.session
+            seen_version = session.version
+            idle_since = time.time()
+            first_index = sent_results
+            sent_results = snapshot.total_results_count
+            progress = {
+                'status': session.status,
+                'processed_files': session.processed_files,
+                'total_files': session.total_files,
+                'progress_percentage': session.progress_percentage,
+                'total_results_count': sent_results,
+                'current_processing': snapshot.current_processing,
+                'throttle_wait_seconds': snapshot.throttle_wait_seconds,
+                'rate_limit': dify_rate_limiter.snapshot()
+            }
+            
+            for offset, result in enumerate(snapshot.new_results):
+                yield format_sse_event('result', result.to_dict(), event_id=first_index + offset + 1)
+            
+            if session.completed:
+                yield format_sse_event('completed', {**progress, 'errors': session.errors})
+                return
+            
+            yield format_sse_event('progress', progress)
+    
+    return Response(
+        generate(),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 @app.route('/api/dify/session/<session_id>/cleanup', methods=['DELETE'])
 def cleanup_session(session_id):
     """Clean up completed session data"""
     try:
-        with session_lock:
-            if session_id in processing_sessions:
-                del processing_sessions[session_id]
-                return jsonify({'success': True, 'message': 'Session cleaned up'})
-            else:
-                return jsonify({'error': 'Session not found'}), 404
+        with queue_transaction() as conn:
+            stored_bytes = delete_session(conn, session_id)
+            if stored_bytes is not None:
+                increment_reaper_stats(conn, cleaned_up_sessions=1, reclaimed_bytes=stored_bytes)
+        
+        if stored_bytes is None:
+            return jsonify({'error': 'Session not found'}), 404
+        
+        notify_session_changed()
+        return jsonify({'success': True, 'message': 'Session cleaned up'})
                 
     except Exception as e:
         return jsonify({'error': f'Cleanup error: {str(e)}'}), 500
 
+@app.route('/api/dify/sessions/stats')
+def get_session_stats():
+    """Report stored sessions, storage use against the budget and what the reaper has reclaimed"""
+    try:
+        with queue_snapshot() as conn:
+            sessions = conn.execute(SESSION_STORAGE_SQL + ' GROUP BY s.session_id').fetchall()
+            job_counts = conn.execute('SELECT status, COUNT(*) FROM processing_jobs GROUP BY status').fetchall()
+            reaper_stats = dict(conn.execute('SELECT name, value FROM session_reaper_stats').fetchall())
+            preprocess = conn.execute('''
+                SELECT COUNT(*), COALESCE(SUM(file_size), 0), COALESCE(SUM(processed_size), 0)
+                FROM processing_jobs WHERE processed_size IS NOT NULL
+            ''').fetchone()
+        
+        sessions_by_status = {}
+        for row in sessions:
+            sessions_by_status[row['status']] = sessions_by_status.get(row['status'], 0) + 1
+        
+        return jsonify({
+            'sessions': sessions_by_status,
+            'jobs': {status: count for status, count in job_counts},
+            'stored_bytes': sum(row['stored_bytes'] for row in sessions),
+            'storage_budget_bytes': int(DIFY_SESSION_STORAGE_BUDGET_MB * 1024 * 1024),
+            'session_ttl_seconds': DIFY_SESSION_TTL_SECONDS,
+            'expired_sessions': int(reaper_stats.get('expired_sessions', 0)),
+            'evicted_sessions': int(reaper_stats.get('evicted_sessions', 0)),
+            'cleaned_up_sessions': int(reaper_stats.get('cleaned_up_sessions', 0)),
+            'reclaimed_bytes': int(reaper_stats.get('reclaimed_bytes', 0)),
+            'last_reap_at': reaper_stats.get('last_reap_at'),
+            'circuit_breaker': dify_breaker.snapshot(),
+            'rate_limit': dify_rate_limiter.snapshot(),
+            'dispatcher': dify_dispatcher.snapshot() if dify_dispatcher is not None else {'mode': 'threads'},
+            'preprocess': {
+                'enabled': DIFY_PREPROCESS_ENABLED,
+                'files': preprocess[0],
+                'original_bytes': preprocess[1],
+                'processed_bytes': preprocess[2]
+            }
+        })
+        
+    except Exception as e:
+        return jsonify({'error': f'Stats error: {str(e)}'}), 500
+
+@app.route('/metrics')
+def get_metrics():
+    """Per-stage counters and histograms of this process in the Prometheus text format"""
+    try:
+        job_counts = connect_queue_db().execute('SELECT status, COUNT(*) FROM processing_jobs GROUP BY status').fetchall()
+        queue_jobs.replace({(status,): count for status, count in job_counts})
+    except Exception as e:
+        logger.warning('Failed to read queue depth for metrics: %s', e)
+    
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    return Response('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def profiles_admin_allowed():
+    if not PROFILING_ENABLED:
+        return False
+    if not PROFILING_TOKEN:
+        return True
+    return (request.headers.get('X-Profile') or request.args.get('profile')) == PROFILING_TOKEN
+
+@app.route('/api/admin/profiles')
+def list_profiles():
+    """List the newest saved profiles with their wall time (PROFILING_ENABLED only)"""
+    if not profiles_admin_allowed():
+        return jsonify({'error': 'Not found'}), 404
+    limit = min(max(request.args.get('limit', 50, type=int), 1), PROFILE_MAX_FILES)
+    profiles = []
+    for path in sorted(glob.glob(os.path.join(PROFILE_DIR, '*.json')), key=os.path.getmtime, reverse=True)[:limit]:
+        try:
+            with open(path, encoding='utf-8') as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return jsonify({'profiles': profiles, 'profile_dir': PROFILE_DIR, 'max_files': PROFILE_MAX_FILES})
+
+@app.route('/api/admin/profiles/<name>')
+def download_profile(name):
+    """Download one profile as a pstats file"""
+    if not profiles_admin_allowed():
+        return jsonify({'error': 'Not found'}), 404
+    return send_from_directory(os.path.abspath(PROFILE_DIR), f'{secure_filename(name)}.prof', as_attachment=True)
+
+REQUEUE_JOB_SQL = '''
+    UPDATE processing_jobs
+    SET status = :status, duplicate_of = :duplicate_of, count_processed = :count_processed,
+        claim_count = 0, queued_at = :queued_at, result = NULL, failed = NULL, result_extra = NULL,
+        result_seq = NULL, completed_at = NULL, elapsed_seconds = NULL
+    WHERE id = :id
+'''
+
 @app.route('/api/dify/session/<session_id>/retry/<int:file_index>', methods=['POST'])
 def retry_file(session_id, file_index):
     """Retry processing for a specific failed file"""
     try:
-        with session_lock:
-            if session_id not in processing_sessions:
+        with queue_transaction() as conn:
+            session = conn.execute('SELECT total_files FROM processing_sessions WHERE session_id = ?', (session_id,)).fetchone()
+            if session is None:
                 return jsonify({'error': 'Session not found'}), 404
             
-            session = processing_sessions[session_id]
-            
-            if file_index >= len(session.get('original_files', [])):
+            if file_index >= session['total_files']:
                 return jsonify({'error': 'File index out of range'}), 400
             
-            failed_result = None
-            for result in session['results']:
-                if result['file_index'] == file_index and result['failed']:
-                    failed_result = result
-                    break
-            
-            if not failed_result:
+            job = conn.execute(
+                "SELECT id, filename FROM processing_jobs WHERE session_id = ? AND file_index = ? AND status = 'failed'",
+                (session_id, file_index)
+            ).fetchone()
+            if job is None:
                 return jsonify({'error': 'File not found or not failed'}), 400
             
-            original_file = session['original_files'][file_index]
-            filename = original_file['filename']
-            file_data = original_file['file_data']
-            
-            session['results'] = [r for r in session['results'] if not (r['file_index'] == file_index and r['failed'])]
-            
-            session['current_processing'] = {
-                'file_index': file_index,
-                'filename': filename,
-                'started_at': time.time(),
-                'current_attempt': 0
-            }
+            filename = job['filename']
+            # 重複ファイルも単独のジョブとして再実行する（スプールは同じハッシュのファイルを共有）
+            conn.execute(REQUEUE_JOB_SQL, {
+                'id': job['id'], 'status': 'queued', 'duplicate_of': None,
+                'count_processed': 0, 'queued_at': time.time()
+            })
+            conn.execute(
+                "UPDATE processing_sessions SET status = CASE WHEN status = 'receiving' THEN status ELSE 'processing' END WHERE session_id = ?",
+                (session_id,)
+            )
+            bump_session_version(conn, session_id)
         
-        import threading
-        from io import BytesIO
-        
-        def retry_file_processing():
-            file_obj = BytesIO(file_data)
-            result = send_to_dify_with_progress(file_obj, filename, session_id, file_index)
-            
-            with session_lock:
-                if session_id in processing_sessions:
-                    session = processing_sessions[session_id]
-                    elapsed_time = time.time() - session['current_processing']['started_at']
-                    session['current_processing'] = None
-                    
-                    if 'error' in result:
-                        session['errors'].append(f'{filename}: {result["error"]}')
-                        session['results'].append({
-                            'filename': filename,
-                            'file_index': file_index,
-                            'result': result,
-                            'failed': True,
-                            'completed_at': time.time(),
-                            'elapsed_seconds': round(elapsed_time, 1)
-                        })
-                    else:
-                        session['results'].append({
-                            'filename': filename,
-                            'file_index': file_index,
-                            'result': result,
-                            'failed': False,
-                            'completed_at': time.time(),
-                            'elapsed_seconds': round(elapsed_time, 1)
-                        })
-        
-        thread = threading.Thread(target=retry_file_processing)
-        thread.daemon = True
-        thread.start()
+        notify_session_changed()
+        notify_jobs_available()
         
         return jsonify({
             'success': True,
@@ -682,91 +3624,49 @@ def retry_file(session_id, file_index):
 def retry_failed_files(session_id):
     """Retry processing for all failed files in a session"""
     try:
-        with session_lock:
-            if session_id not in processing_sessions:
+        with queue_transaction() as conn:
+            if conn.execute('SELECT 1 FROM processing_sessions WHERE session_id = ?', (session_id,)).fetchone() is None:
                 return jsonify({'error': 'Session not found'}), 404
             
-            session = processing_sessions[session_id]
-            
-            failed_files = []
-            for result in session['results']:
-                if result['failed']:
-                    failed_files.append({
-                        'file_index': result['file_index'],
-                        'filename': result['filename']
-                    })
+            failed_jobs = conn.execute(
+                "SELECT id, file_index, duplicate_of FROM processing_jobs WHERE session_id = ? AND status = 'failed' ORDER BY file_index",
+                (session_id,)
+            ).fetchall()
             
-            if not failed_files:
+            if not failed_jobs:
                 return jsonify({'error': 'No failed files to retry'}), 400
             
-            session['results'] = [r for r in session['results'] if not r['failed']]
+            # 重複ファイルは元ファイルも再実行される場合はその結果を待つ
+            retried = {job['file_index'] for job in failed_jobs}
+            now = time.time()
+            conn.executemany(REQUEUE_JOB_SQL, [
+                {
+                    'id': job['id'],
+                    'status': 'waiting' if job['duplicate_of'] in retried else 'queued',
+                    'duplicate_of': job['duplicate_of'] if job['duplicate_of'] in retried else None,
+                    'count_processed': 1,
+                    'queued_at': now
+                }
+                for job in failed_jobs
+            ])
             
-            session['status'] = 'processing'
-            session['processed_files'] = len([r for r in session['results'] if not r['failed']])
+            processed_files = conn.execute(
+                'SELECT COUNT(*) FROM processing_jobs WHERE session_id = ? AND result_seq IS NOT NULL AND failed = 0',
+                (session_id,)
+            ).fetchone()[0]
+            conn.execute(
+                "UPDATE processing_sessions SET status = CASE WHEN status = 'receiving' THEN status ELSE 'processing' END, "
+                "processed_files = ? WHERE session_id = ?",
+                (processed_files, session_id)
+            )
+            bump_session_version(conn, session_id)
         
-        import threading
-        from io import BytesIO
-        
-        def retry_failed_processing():
-            for failed_file in failed_files:
-                file_index = failed_file['file_index']
-                filename = failed_file['filename']
-                
-                with session_lock:
-                    if session_id in processing_sessions:
-                        session = processing_sessions[session_id]
-                        original_file = session['original_files'][file_index]
-                        file_data = original_file['file_data']
-                        
-                        session['current_processing'] = {
-                            'file_index': file_index,
-                            'filename': filename,
-                            'started_at': time.time(),
-                            'current_attempt': 0
-                        }
-                
-                file_obj = BytesIO(file_data)
-                result = send_to_dify_with_progress(file_obj, filename, session_id, file_index)
-                
-                with session_lock:
-                    if session_id in processing_sessions:
-                        session = processing_sessions[session_id]
-                        elapsed_time = time.time() - session['current_processing']['started_at']
-                        session['current_processing'] = None
-                        
-                        if 'error' in result:
-                            session['errors'].append(f'{filename}: {result["error"]}')
-                            session['results'].append({
-                                'filename': filename,
-                                'file_index': file_index,
-                                'result': result,
-                                'failed': True,
-                                'completed_at': time.time(),
-                                'elapsed_seconds': round(elapsed_time, 1)
-                            })
-                        else:
-                            session['results'].append({
-                                'filename': filename,
-                                'file_index': file_index,
-                                'result': result,
-                                'failed': False,
-                                'completed_at': time.time(),
-                                'elapsed_seconds': round(elapsed_time, 1)
-                            })
-                        
-                        session['processed_files'] += 1
-            
-            with session_lock:
-                if session_id in processing_sessions:
-                    processing_sessions[session_id]['status'] = 'completed'
-        
-        thread = threading.Thread(target=retry_failed_processing)
-        thread.daemon = True
-        thread.start()
+        notify_session_changed()
+        notify_jobs_available()
         
         return jsonify({
             'success': True,
-            'message': f'Retry started for {len(failed_files)} failed files'
+            'message': f'Retry started for {len(failed_jobs)} failed files'
         })
         
     except Exception as e:
@@ -775,36 +3675,291 @@ def retry_failed_files(session_id):
 # 分析結果を保存するためのグローバル変数
 analysis_results = []
 
+ANALYSIS_RESULTS_PAGE_SIZE = 100
+ANALYSIS_RESULTS_MAX_PAGE_SIZE = 1000
+
+# 完全一致で絞り込むクエリパラメータと列
+ANALYSIS_RESULT_FILTERS = (
+    ('responsible_person', '担当者'),
+    ('order_number', '受注番号'),
+    ('delivery_number', '納入先番号'),
+)
+
+def encode_results_cursor(created_at, row_id):
+    """Encode the last row's (created_at, id) as an opaque page cursor"""
+    raw = json.dumps([created_at, row_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_results_cursor(cursor):
+    """Decode a page cursor back into (created_at, id); ValueError if malformed"""
+    try:
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if not isinstance(created_at, str) or not isinstance(row_id, int):
+        raise ValueError('Invalid cursor')
+    return created_at, row_id
+
+def build_results_filter(args):
+    """Build the WHERE clause and parameters for the 仕入一覧 filters"""
+    conditions = []
+    params = []
+    date_from = args.get('shipping_date_from')
+    if date_from:
+        conditions.append('出荷日 >= ?')
+        params.append(normalize_shipping_date(date_from))
+    date_to = args.get('shipping_date_to')
+    if date_to:
+        conditions.append('出荷日 <= ?')
+        params.append(normalize_shipping_date(date_to))
+    for name, column in ANALYSIS_RESULT_FILTERS:
+        value = args.get(name)
+        if value:
+            conditions.append(f'{column} = ?')
+            params.append(value)
+    return conditions, params
+
 @app.route('/api/analysis/results', methods=['GET'])
 def get_analysis_results():
-    """分析結果の一覧を取得"""
+    """分析結果の一覧を取得（新しい順、created_at/idのキーセットページング）"""
     try:
-        conn = sqlite3.connect('inventory_data.db')
-        cursor = conn.cursor()
+        limit = request.args.get('limit', ANALYSIS_RESULTS_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, ANALYSIS_RESULTS_MAX_PAGE_SIZE))
+        try:
+            conditions, params = build_results_filter(request.args)
+            page_cursor = request.args.get('cursor')
+            page_conditions = list(conditions)
+            page_params = list(params)
+            if page_cursor:
+                page_conditions.append('(created_at, id) < (?, ?)')
+                page_params.extend(decode_results_cursor(page_cursor))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        cursor.execute('SELECT ページ, 出荷日, 受注番号, 納入先番号, 担当者, 税抜合計 FROM basic_info ORDER BY created_at DESC')
-        rows = cursor.fetchall()
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        page_where = f"WHERE {' AND '.join(page_conditions)}" if page_conditions else ''
         
-        results = []
-        for row in rows:
-            results.append({
-                'ページ': row[0],
-                '出荷日': row[1],
-                '受注番号': row[2],
-                '納入先番号': row[3],
-                '担当者': row[4],
-                '税抜合計': row[5]
-            })
+        conn = get_db_connection()
+        total_count = conn.execute(f'SELECT COUNT(*) FROM basic_info {where}', params).fetchone()[0]
+        # 1件多く取得して次ページの有無を判定する
+        rows = conn.execute(f'''
+            SELECT id, ページ, 出荷日, 受注番号, 納入先番号, 担当者, 税抜合計, created_at
+            FROM basic_info {page_where}
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+        ''', page_params + [limit + 1]).fetchall()
         
-        conn.close()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        results = [{
+            'id': row[0],
+            'ページ': row[1],
+            '出荷日': row[2],
+            '受注番号': row[3],
+            '納入先番号': row[4],
+            '担当者': row[5],
+            '税抜合計': row[6]
+        } for row in rows]
         
-        return jsonify({
+        response = jsonify({
             'success': True,
-            'results': results
+            'results': results,
+            'total_count': total_count,
+            'limit': limit,
+            'has_more': has_more,
+            'next_cursor': encode_results_cursor(rows[-1][7], rows[-1][0]) if has_more else None
         })
+        # 内容が変わっていなければ304を返す（ブラウザは毎回再検証する）
+        response.cache_control.no_cache = True
+        response.add_etag()
+        return response.make_conditional(request)
     except Exception as e:
         return jsonify({'error': f'データ取得エラー: {str(e)}'}), 500
 
+# basic_info の各列と、受け付けるキー（旧形式・英語キーを含む）の対応
+BASIC_INFO_FIELDS = (
+    ('ページ', ('ページ', 'page')),
+    ('出荷日', ('出荷日', 'shipping_date')),
+    ('受注番号', ('受注番号', '受注番号.', 'order_number')),
+    ('納入先番号', ('納入先番号', 'delivery_number')),
+    ('担当者', ('担当者', 'responsible_person')),
+    ('税抜合計', ('税抜合計', 'total_amount')),
+)
+
+# 明細行の列と、Difyの出力で使われるキー（いずれも配列）
+LINE_ITEM_FIELDS = ('部品番号', '部品名', '数量', '売上単価', '売上金額')
+LINE_ITEM_AMOUNT_FIELDS = ('数量', '売上単価', '売上金額')
+
+class BasicInfoRow(namedtuple('BasicInfoRow', [
+        'page', 'shipping_date', 'order_number', 'delivery_number', 'responsible_person', 'total_amount',
+        'natural_key', 'total_yen', 'freight', 'line_items'])):
+    """A normalised basic_info row with its numeric amounts and line items"""
+    
+    def insert_params(self):
+        return self[:9]
+    
+    def update_params(self):
+        return self[:6] + (self.total_yen, self.freight, self.natural_key)
+    
+    def summary_values(self):
+        return (self.shipping_date, self.responsible_person, self.delivery_number, self.total_yen, self.freight)
+
+INSERT_BASIC_INFO_SQL = '''
+    INSERT INTO basic_info (ページ, 出荷日, 受注番号, 納入先番号, 担当者, 税抜合計, natural_key, 税抜合計_円, 運賃)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+UPSERT_BASIC_INFO_SQL = '''
+    UPDATE basic_info
+    SET ページ = ?, 出荷日 = ?, 受注番号 = ?, 納入先番号 = ?, 担当者 = ?, 税抜合計 = ?,
+        税抜合計_円 = ?, 運賃 = ?, updated_at = CURRENT_TIMESTAMP
+    WHERE natural_key = ?
+'''
+
+INSERT_LINE_ITEM_SQL = '''
+    INSERT INTO line_items (basic_info_id, line_no, 部品番号, 部品名, 数量, 売上単価, 売上金額)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+
+# upsertで更新した行は明細を入れ替える（同じ自然キーの行すべてに付ける）
+INSERT_LINE_ITEM_BY_KEY_SQL = '''
+    INSERT INTO line_items (basic_info_id, line_no, 部品番号, 部品名, 数量, 売上単価, 売上金額)
+    SELECT id, ?, ?, ?, ?, ?, ? FROM basic_info WHERE natural_key = ?
+'''
+
+# 保存時の重複の扱い: allow=そのまま追加, skip=既存・バッチ内の重複を除外, upsert=既存行を更新
+DUPLICATE_MODES = ('allow', 'skip', 'upsert')
+
+def extract_line_items(entry):
+    """Zip the 部品番号/部品名/数量/売上単価/売上金額 arrays into (line_no, ...) tuples"""
+    columns = []
+    for name in LINE_ITEM_FIELDS:
+        value = entry.get(name)
+        if isinstance(value, list):
+            columns.append(value)
+        elif value not in (None, ''):
+            columns.append([value])
+        else:
+            columns.append([])
+    
+    line_items = []
+    for line_no in range(max(len(column) for column in columns)):
+        values = []
+        for name, column in zip(LINE_ITEM_FIELDS, columns):
+            value = column[line_no] if line_no < len(column) else None
+            if name in LINE_ITEM_AMOUNT_FIELDS:
+                value = parse_amount(value)
+            elif value is not None:
+                value = str(value).strip() or None
+            values.append(value)
+        if any(value is not None for value in values):
+            line_items.append((line_no + 1,) + tuple(values))
+    return line_items
+
+def normalize_basic_info_entry(entry):
+    """Map one entry onto a BasicInfoRow; None if a required field is empty"""
+    if not isinstance(entry, dict):
+        return None
+    values = []
+    for _, keys in BASIC_INFO_FIELDS:
+        value = next((entry[key] for key in keys if entry.get(key)), '')
+        if not value:
+            return None
+        values.append(value)
+    return BasicInfoRow(
+        *values,
+        natural_key=basic_info_natural_key(values[0], values[1], values[2], values[3]),
+        total_yen=parse_amount(values[5]),
+        freight=parse_amount(entry.get('運賃')),
+        line_items=extract_line_items(entry)
+    )
+
+def normalize_analysis_items(items):
+    """Flatten posted items (extracted_data, raw Dify text or flat rows) into basic_info rows"""
+    rows = []
+    skipped = 0
+    for item in items:
+        if not isinstance(item, dict):
+            skipped += 1
+            continue
+        
+        # Difyの出力（text）がそのまま送られた場合はここで一度だけ抽出する
+        if 'text' in item:
+            attach_extracted_data(item)
+        
+        # 新形式: item.extracted_data（配列/オブジェクト）、旧形式: 各フィールドがトップレベル
+        if 'extracted_data' in item:
+            extracted = item['extracted_data']
+            if isinstance(extracted, dict):
+                entries = [extracted]
+            elif isinstance(extracted, list):
+                entries = extracted
+            else:
+                skipped += 1
+                continue
+        else:
+            entries = [item]
+        
+        for entry in entries:
+            row = normalize_basic_info_entry(entry)
+            if row is None:
+                skipped += 1
+            else:
+                rows.append(row)
+    return rows, skipped
+
+def find_existing_rows(conn, natural_keys):
+    """Look up stored rows for a whole batch of natural keys in one indexed query"""
+    if not natural_keys:
+        return {}
+    rows = conn.execute('''
+        SELECT natural_key, id, ページ, 出荷日, 受注番号, 納入先番号, 担当者, 税抜合計
+        FROM basic_info
+        WHERE natural_key IN (SELECT value FROM json_each(?))
+        ORDER BY id
+    ''', (json.dumps(sorted(set(natural_keys))),)).fetchall()
+    existing = {}
+    for row in rows:
+        existing.setdefault(row[0], {
+            'id': row[1],
+            'ページ': row[2],
+            '出荷日': row[3],
+            '受注番号': row[4],
+            '納入先番号': row[5],
+            '担当者': row[6],
+            '税抜合計': row[7]
+        })
+    return existing
+
+def basic_info_row_to_dict(row):
+    """Turn a normalised basic_info row back into a 列名 -> 値 dict"""
+    return dict(zip(('ページ', '出荷日', '受注番号', '納入先番号', '担当者', '税抜合計'), row[:6]))
+
+@app.route('/api/analysis/results/duplicates', methods=['POST'])
+def check_duplicate_results():
+    """保存候補のうち、既に保存済み（自然キーが一致）の行を返す"""
+    try:
+        data = request.get_json()
+        if not data or 'results' not in data:
+            return jsonify({'error': 'Invalid data format'}), 400
+        
+        rows, skipped = normalize_analysis_items(data['results'])
+        existing = find_existing_rows(get_db_connection(), [row.natural_key for row in rows])
+        duplicates = [{
+            'index': index,
+            'entry': basic_info_row_to_dict(row),
+            'existing': existing[row.natural_key]
+        } for index, row in enumerate(rows) if row.natural_key in existing]
+        
+        return jsonify({
+            'success': True,
+            'checked_count': len(rows),
+            'skipped_count': skipped,
+            'duplicates': duplicates
+        })
+    except Exception as e:
+        return jsonify({'error': f'重複チェックエラー: {str(e)}'}), 500
+
 @app.route('/api/analysis/results', methods=['POST'])
 def save_analysis_results():
     """分析結果を保存"""
@@ -813,95 +3968,63 @@ def save_analysis_results():
         if not data or 'results' not in data:
             return jsonify({'error': 'Invalid data format'}), 400
         
-        # SQLiteデータベースに保存
-        conn = sqlite3.connect('inventory_data.db')
-        cursor = conn.cursor()
+        mode = data.get('mode', 'allow')
+        if mode not in DUPLICATE_MODES:
+            return jsonify({'error': f'Invalid mode: {mode}'}), 400
         
-        # 既存データを保持しつつ、新しいデータを追加
-        print(f"保存するデータ: {data['results']}")  # デバッグ用
+        # 先に全件を正規化し、1トランザクション・1回のexecutemanyで書き込む
+        rows, skipped = normalize_analysis_items(data['results'])
+        updates = []
+        duplicate_count = 0
         
-        for item in data['results']:
-            print(f"処理中のアイテム: {item}")  # デバッグ用
-
-            # 1) 新形式: item.extracted_data を優先的に処理（配列/オブジェクトのどちらにも対応）
-            if isinstance(item, dict) and 'extracted_data' in item:
-                extracted = item.get('extracted_data')
-                entries = []
-                if isinstance(extracted, list):
-                    entries = extracted
-                elif isinstance(extracted, dict):
-                    entries = [extracted]
+        conn = get_db_connection()
+        with db_save_seconds.time(mode=mode), conn:
+            # 重複確認から書き込みまでの間に他の保存が割り込まないよう、先にロックを取る
+            conn.execute('BEGIN IMMEDIATE')
+            if mode != 'allow':
+                existing = find_existing_rows(conn, [row.natural_key for row in rows])
+                # バッチ内で同じキーが複数ある場合、skipは最初の行、upsertは最後の行を使う
+                batch = {}
+                for row in rows:
+                    if mode == 'skip':
+                        batch.setdefault(row.natural_key, row)
+                    else:
+                        batch[row.natural_key] = row
+                duplicate_count = len(rows) - len(batch)
+                if mode == 'skip':
+                    duplicate_count += sum(1 for key in batch if key in existing)
+                    rows = [row for key, row in batch.items() if key not in existing]
                 else:
-                    print("extracted_data の形式が不正のためスキップします")
-                    continue
-
-                for entry in entries:
-                    page = entry.get('ページ') or entry.get('page') or ''
-                    shipping_date = entry.get('出荷日') or entry.get('shipping_date') or ''
-                    order_number = entry.get('受注番号') or entry.get('受注番号.') or entry.get('order_number') or ''
-                    delivery_number = entry.get('納入先番号') or entry.get('delivery_number') or ''
-                    responsible_person = entry.get('担当者') or entry.get('responsible_person') or ''
-                    total_amount = entry.get('税抜合計') or entry.get('total_amount') or ''
-
-                    print(f"[extracted_data] 抽出: ページ={page}, 出荷日={shipping_date}, 受注番号={order_number}, 納入先番号={delivery_number}, 担当者={responsible_person}, 税抜合計={total_amount}")
-
-                    if not page or not shipping_date or not order_number or not delivery_number or not responsible_person or not total_amount:
-                        print(f"[extracted_data] データが不完全です。スキップします: {entry}")
-                        continue
-
-                    # ここでは重複検出しても挿入は継続（UIで確認するため）。情報のみログ出力。
-                    try:
-                        cursor.execute('''
-                            INSERT INTO basic_info (ページ, 出荷日, 受注番号, 納入先番号, 担当者, 税抜合計)
-                            VALUES (?, ?, ?, ?, ?, ?)
-                        ''', (
-                            page,
-                            shipping_date,
-                            order_number,
-                            delivery_number,
-                            responsible_person,
-                            total_amount
-                        ))
-                    except Exception as ie:
-                        print(f"[extracted_data] 挿入エラー: {str(ie)} | データ: {entry}")
-                # 次の item へ
-                continue
-
-            # 2) 旧形式: 各フィールドがトップレベルにある場合
-            page = item.get('ページ') or item.get('page') or ''
-            shipping_date = item.get('出荷日') or item.get('shipping_date') or ''
-            order_number = item.get('受注番号') or item.get('受注番号.') or item.get('order_number') or ''
-            delivery_number = item.get('納入先番号') or item.get('delivery_number') or ''
-            responsible_person = item.get('担当者') or item.get('responsible_person') or ''
-            total_amount = item.get('税抜合計') or item.get('total_amount') or ''
-
-            print(f"抽出された値: ページ={page}, 出荷日={shipping_date}, 受注番号={order_number}, 納入先番号={delivery_number}, 担当者={responsible_person}, 税抜合計={total_amount}")
-            print(f"元のアイテムのキー: {list(item.keys())}")
-            print(f"受注番号の値: {item.get('受注番号')}, 受注番号.の値: {item.get('受注番号.')}")
-
-            # データの有効性チェック（必須フィールドが空でないことを確認）
-            if not page or not shipping_date or not order_number or not delivery_number or not responsible_person or not total_amount:
-                print(f"データが不完全です。スキップします: {item}")
-                continue
-
-            # 重複はフロント側で確認するため、ここでは挿入を止めない（ログのみ）
-            try:
-                cursor.execute('''
-                    INSERT INTO basic_info (ページ, 出荷日, 受注番号, 納入先番号, 担当者, 税抜合計)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', (
-                    page,
-                    shipping_date,
-                    order_number,
-                    delivery_number,
-                    responsible_person,
-                    total_amount
-                ))
-            except Exception as ie:
-                print(f"挿入エラー: {str(ie)} | データ: {item}")
+                    updates = [row for key, row in batch.items() if key in existing]
+                    rows = [row for key, row in batch.items() if key not in existing]
+                    # 更新される行（同じキーの行すべて）の集計を差し替える
+                    replaced = conn.execute('''
+                        SELECT natural_key, 出荷日, 担当者, 納入先番号, 税抜合計_円, 運賃 FROM basic_info
+                        WHERE natural_key IN (SELECT value FROM json_each(?))
+                    ''', (json.dumps([row.natural_key for row in updates]),)).fetchall()
+                    apply_summary_deltas(conn, [old[1:] for old in replaced], sign=-1)
+                    apply_summary_deltas(conn, [batch[old[0]].summary_values() for old in replaced])
+                    conn.executemany(UPSERT_BASIC_INFO_SQL, [row.update_params() for row in updates])
+                    conn.execute('''
+                        DELETE FROM line_items WHERE basic_info_id IN (
+                            SELECT id FROM basic_info WHERE natural_key IN (SELECT value FROM json_each(?))
+                        )
+                    ''', (json.dumps([row.natural_key for row in updates]),))
+                    conn.executemany(INSERT_LINE_ITEM_BY_KEY_SQL, [
+                        line_item + (row.natural_key,) for row in updates for line_item in row.line_items
+                    ])
+            
+            # 書き込みロックを持っているので、追加した行のidは直前の最大idより後ろに挿入順で並ぶ
+            last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM basic_info').fetchone()[0]
+            conn.executemany(INSERT_BASIC_INFO_SQL, [row.insert_params() for row in rows])
+            apply_summary_deltas(conn, [row.summary_values() for row in rows])
+            new_ids = [row_id for (row_id,) in conn.execute('SELECT id FROM basic_info WHERE id > ? ORDER BY id', (last_id,))]
+            conn.executemany(INSERT_LINE_ITEM_SQL, [
+                (basic_info_id,) + line_item for basic_info_id, row in zip(new_ids, rows) for line_item in row.line_items
+            ])
         
-        conn.commit()
-        conn.close()
+        db_saved_rows.inc(len(rows), action='inserted')
+        db_saved_rows.inc(len(updates), action='updated')
         
         # グローバル変数も更新
         global analysis_results
@@ -909,32 +4032,182 @@ def save_analysis_results():
         
         return jsonify({
             'success': True,
-            'message': f'{len(data["results"])}件の分析結果をSQLiteデータベースに保存しました'
+            'message': f'{len(data["results"])}件の分析結果をSQLiteデータベースに保存しました',
+            'mode': mode,
+            'saved_count': len(rows),
+            'updated_count': len(updates),
+            'duplicate_count': duplicate_count,
+            'skipped_count': skipped
         })
     except Exception as e:
         return jsonify({'error': f'保存エラー: {str(e)}'}), 500
 
-@app.route('/api/analysis/delete-all', methods=['DELETE'])
-def delete_all_analysis_results():
-    """全ての分析結果を削除（開発用）"""
+# エクスポートの列（basic_info）と、include_line_items 指定時に追加する明細の列
+EXPORT_COLUMNS = ('id', 'ページ', '出荷日', '受注番号', '納入先番号', '担当者', '税抜合計', '税抜合計_円', '運賃', 'created_at')
+EXPORT_LINE_ITEM_COLUMNS = ('line_no', '部品番号', '部品名', '数量', '売上単価', '売上金額')
+EXPORT_BATCH_ROWS = 1000
+
+def iter_export_rows(conn, conditions, params, include_line_items):
+    """Yield export rows newest first, fetching from the SQLite cursor in batches"""
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    columns = ', '.join(f'b.{column}' for column in EXPORT_COLUMNS)
+    if include_line_items:
+        columns += ', ' + ', '.join(f'l.{column}' for column in EXPORT_LINE_ITEM_COLUMNS)
+        query = f'''
+            SELECT {columns} FROM basic_info b
+            LEFT JOIN line_items l ON l.basic_info_id = b.id
+            {where}
+            ORDER BY b.created_at DESC, b.id DESC, l.line_no
+        '''
+    else:
+        query = f'SELECT {columns} FROM basic_info b {where} ORDER BY b.created_at DESC, b.id DESC'
+    cursor = conn.execute(query, params)
     try:
-        conn = sqlite3.connect('inventory_data.db')
-        cursor = conn.cursor()
-        
-        # 削除前のレコード数を取得
-        cursor.execute('SELECT COUNT(*) FROM basic_info')
-        count_before = cursor.fetchone()[0]
+        while True:
+            batch = cursor.fetchmany(EXPORT_BATCH_ROWS)
+            if not batch:
+                break
+            yield from batch
+    finally:
+        cursor.close()
+
+def generate_csv_export(rows, include_line_items):
+    """CSV (UTF-8 with BOM for Excel), one line per invoice or per line item"""
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    header = EXPORT_COLUMNS + (EXPORT_LINE_ITEM_COLUMNS if include_line_items else ())
+    writer.writerow(header)
+    yield ('\ufeff' + buffer.getvalue()).encode('utf-8')
+    buffer.seek(0)
+    buffer.truncate()
+    
+    count = 0
+    for row in rows:
+        writer.writerow(['' if value is None else value for value in row])
+        count += 1
+        if count % EXPORT_BATCH_ROWS == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+def generate_jsonl_export(rows, include_line_items):
+    """JSON Lines, one invoice per line; line items are nested as a list"""
+    size = len(EXPORT_COLUMNS)
+    chunk = []
+    grouped = groupby(rows, key=lambda row: row[0]) if include_line_items else ((row[0], [row]) for row in rows)
+    for _, invoice_rows in grouped:
+        invoice_rows = list(invoice_rows)
+        record = dict(zip(EXPORT_COLUMNS, invoice_rows[0][:size]))
+        if include_line_items:
+            record['line_items'] = [
+                dict(zip(EXPORT_LINE_ITEM_COLUMNS, row[size:])) for row in invoice_rows if row[size] is not None
+            ]
+        chunk.append(json.dumps(record, ensure_ascii=False))
+        if len(chunk) >= EXPORT_BATCH_ROWS:
+            yield ('\n'.join(chunk) + '\n').encode('utf-8')
+            chunk = []
+    if chunk:
+        yield ('\n'.join(chunk) + '\n').encode('utf-8')
+
+EXPORT_FORMATS = {
+    'csv': ('text/csv; charset=utf-8', generate_csv_export),
+    'jsonl': ('application/x-ndjson; charset=utf-8', generate_jsonl_export),
+}
+
+@app.route('/api/analysis/export')
+def export_analysis_results():
+    """保存済みデータをCSV/JSONLでストリーミング出力（絞り込み条件は一覧と同じ）"""
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f'Invalid format: {export_format}'}), 400
+    include_line_items = request.args.get('include_line_items', 'false').lower() in ('1', 'true', 'yes')
+    try:
+        conditions, params = build_results_filter(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    content_type, generate = EXPORT_FORMATS[export_format]
+    rows = iter_export_rows(get_db_connection(), conditions, params, include_line_items)
+    filename = f"analysis_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{export_format}"
+    return Response(generate(rows, include_line_items), content_type=content_type, headers={
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'Cache-Control': 'no-store'
+    })
+
+# 集計の単位（クエリパラメータ group_by）と集計テーブル
+REPORT_GROUPS = {
+    'person': SUMMARY_TABLES[0],
+    'delivery': SUMMARY_TABLES[1],
+}
+
+@app.route('/api/analysis/reports/monthly')
+def get_monthly_report():
+    """月別 × 担当者（group_by=person）または 月別 × 納入先番号（group_by=delivery）の集計を返す"""
+    try:
+        group_by = request.args.get('group_by', 'person')
+        if group_by not in REPORT_GROUPS:
+            return jsonify({'error': f'Invalid group_by: {group_by}'}), 400
+        table, column = REPORT_GROUPS[group_by]
         
-        # 全データを削除
-        cursor.execute('DELETE FROM basic_info')
+        conditions = []
+        params = []
+        for name, operator in (('month_from', '>='), ('month_to', '<=')):
+            value = request.args.get(name)
+            if value:
+                if not re.fullmatch(r'\d{4}-\d{2}', value):
+                    return jsonify({'error': f'Invalid {name}: {value} (YYYY-MM)'}), 400
+                conditions.append(f'month {operator} ?')
+                params.append(value)
+        key = request.args.get('key')
+        if key:
+            conditions.append(f'{column} = ?')
+            params.append(key)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
         
-        # Auto incrementのリセット
-        cursor.execute('DELETE FROM sqlite_sequence WHERE name="basic_info"')
+        rows = get_db_connection().execute(f'''
+            SELECT month, {column}, row_count, total_yen, freight_yen
+            FROM {table} {where}
+            ORDER BY month, {column}
+        ''', params).fetchall()
         
-        conn.commit()
-        conn.close()
+        response = jsonify({
+            'success': True,
+            'group_by': group_by,
+            'rows': [{
+                'month': row[0],
+                column: row[1],
+                'row_count': row[2],
+                'total_yen': row[3],
+                'freight_yen': row[4]
+            } for row in rows]
+        })
+        response.cache_control.no_cache = True
+        response.add_etag()
+        return response.make_conditional(request)
+    except Exception as e:
+        return jsonify({'error': f'集計エラー: {str(e)}'}), 500
+
+@app.route('/api/analysis/delete-all', methods=['DELETE'])
+def delete_all_analysis_results():
+    """全ての分析結果を削除（開発用）"""
+    try:
+        conn = get_db_connection()
+        with conn:
+            # 削除前のレコード数を取得
+            count_before = conn.execute('SELECT COUNT(*) FROM basic_info').fetchone()[0]
+            
+            # 全データを削除（明細を先に消して行ごとのカスケードを避ける）
+            conn.execute('DELETE FROM line_items')
+            conn.execute('DELETE FROM basic_info')
+            for table, _ in SUMMARY_TABLES:
+                conn.execute(f'DELETE FROM {table}')
+            
+            # Auto incrementのリセット
+            conn.execute("DELETE FROM sqlite_sequence WHERE name IN ('basic_info', 'line_items')")
         
-        print(f"開発用: {count_before}件のデータを削除しました")  # デバッグ用
+        logger.info('開発用: %s件のデータを削除しました', count_before)  # デバッグ用
         
         return jsonify({
             'success': True,
@@ -945,4 +4218,7 @@ def delete_all_analysis_results():
         return jsonify({'error': f'削除エラー: {str(e)}'}), 500
 
 if __name__ == '__main__':
+    # リローダーの監視プロセスではなく実際に配信するプロセスで、再起動前の未完了ジョブを再開する
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_job_workers()
     app.run(debug=True, host='0.0.0.0', port=5001)
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""分析パイプラインのスループット計測
+
+dify_stub_server.py とアプリを一時ディレクトリ（空のデータベース）で起動し、test_images/ と
+real_test_images/ のPNGを /api/dify/analyze-sequential に送って、1分あたりの処理件数、
+ファイルごとの所要時間（p50 / p95）、アプリのピークRSSを表示する。
+
+    python benchmark.py --repeat 5 --latency lognormal:1,0.3 --json benchmark_results.jsonl
+
+--json を指定すると結果を1行のJSONとして追記するので、リリースごとの比較に使える。
+アプリの環境変数（DIFY_MAX_CONCURRENCY など）はそのまま引き継がれる。
+"""
+
+import argparse
+import glob
+import io
+import json
+import math
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import requests
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_IMAGE_DIRS = ['test_images', 'real_test_images']
+
+# 一時ディレクトリでアプリを起動する（inventory_data.db と一時保存先はそこに作られる）
+APP_RUNNER = '''
+import sys
+sys.path.insert(0, sys.argv[1])
+import app
+app.start_job_workers()
+app.app.run(host='127.0.0.1', port=int(sys.argv[2]), threaded=True)
+'''
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_until_ready(url, process, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'{url} exited with code {process.returncode}')
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    raise RuntimeError(f'{url} did not start within {timeout} seconds')
+
+def load_images(image_dirs, repeat):
+    """PNGを読み込み、repeat回分を末尾のバイトで別のファイル（別のハッシュ）にして返す"""
+    paths = []
+    for image_dir in image_dirs:
+        paths.extend(sorted(glob.glob(os.path.join(ROOT, image_dir, '*.png'))))
+    if not paths:
+        raise SystemExit(f'No PNG files found in {", ".join(image_dirs)}')
+    
+    images = []
+    for n in range(repeat):
+        for path in paths:
+            with open(path, 'rb') as f:
+                content = f.read()
+            # PNGの終端より後ろのバイトは画像として無視される
+            if n:
+                content += f'benchmark-{n}'.encode('ascii')
+            images.append((f'{n}_{os.path.basename(path)}', content))
+    return images
+
+def make_batches(images, batch_size, max_batch_bytes):
+    batches = []
+    batch, batch_bytes = [], 0
+    for name, content in images:
+        if batch and (len(batch) >= batch_size or batch_bytes + len(content) > max_batch_bytes):
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append((name, content))
+        batch_bytes += len(content)
+    if batch:
+        batches.append(batch)
+    return batches
+
+def percentile(values, p):
+    """最近傍法によるパーセンタイル"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+def run_sessions(app_url, batches, poll_interval):
+    """バッチごとにセッションを開始し、全セッションの完了を待って結果を返す"""
+    started_at = time.time()
+    sessions = {}
+    for batch in batches:
+        files = [('files', (name, io.BytesIO(content), 'image/png')) for name, content in batch]
+        response = requests.post(
+            f'{app_url}/api/dify/analyze-sequential', files=files, data={'force_reanalyze': 'true'}, timeout=120
+        )
+        response.raise_for_status()
+        sessions[response.json()['session_id']] = {'submitted_at': time.time(), 'results': {}}
+    
+    pending = set(sessions)
+    while pending:
+        time.sleep(poll_interval)
+        for session_id in list(pending):
+            session = sessions[session_id]
+            status = requests.get(
+                f'{app_url}/api/dify/session/{session_id}/status',
+                params={'last_result_count': len(session['results'])}, timeout=30
+            ).json()
+            for result in status['new_results']:
+                session['results'][result['file_index']] = result
+            if status['completed']:
+                pending.discard(session_id)
+    finished_at = time.time()
+    
+    results = []
+    for session in sessions.values():
+        for result in session['results'].values():
+            result['latency_seconds'] = result['completed_at'] - session['submitted_at']
+            results.append(result)
+    return results, finished_at - started_at
+
+def peak_rss_mb(process):
+    """終了した子プロセスのうち最大のRSS（MB）。アプリを先に終了させてから呼ぶ"""
+    process.wait()
+    max_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # Linuxはキロバイト、macOSはバイト
+    return max_rss / (1024 * 1024) if sys.platform == 'darwin' else max_rss / 1024
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end throughput benchmark against the Dify stub server')
+    parser.add_argument('--images', nargs='+', default=DEFAULT_IMAGE_DIRS, help='directories with PNG files to replay')
+    parser.add_argument('--repeat', type=int, default=1, help='replay the images this many times as distinct files')
+    parser.add_argument('--batch-size', type=int, default=20, help='files per analyze-sequential request')
+    parser.add_argument('--max-batch-mb', type=float, default=18, help='request size limit per batch (the app allows 20 MB)')
+    parser.add_argument('--latency', default='lognormal:1,0.3', help='stub workflow latency distribution')
+    parser.add_argument('--upload-latency', default='fixed:0.05', help='stub upload latency distribution')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='stub probability of a 500 response')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='stub probability of a 429 response')
+    parser.add_argument('--stub-max-concurrency', type=int, default=0, help='stub answers 429 above this many runs')
+    parser.add_argument('--response-mode', choices=['blocking', 'streaming'], default='blocking')
+    parser.add_argument('--poll-interval', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=0, help='stub random seed')
+    parser.add_argument('--json', help='append the result as one JSON line to this file')
+    parser.add_argument('--keep-workdir', action='store_true', help='keep the temporary database and spool directory')
+    args = parser.parse_args()
+    
+    images = load_images(args.images, args.repeat)
+    batches = make_batches(images, args.batch_size, int(args.max_batch_mb * 1024 * 1024))
+    
+    workdir = tempfile.mkdtemp(prefix='dify-benchmark-')
+    stub_port, app_port = free_port(), free_port()
+    stub_url, app_url = f'http://127.0.0.1:{stub_port}', f'http://127.0.0.1:{app_port}'
+    logs = {name: open(os.path.join(workdir, f'{name}.log'), 'w') for name in ('stub', 'app')}
+    
+    stub = subprocess.Popen([
+        sys.executable, os.path.join(ROOT, 'dify_stub_server.py'), '--port', str(stub_port),
+        '--latency', args.latency, '--upload-latency', args.upload_latency,
+        '--error-rate', str(args.error_rate), '--rate-limit-rate', str(args.rate_limit_rate),
+        '--max-concurrency', str(args.stub_max_concurrency), '--seed', str(args.seed)
+    ], stdout=logs['stub'], stderr=subprocess.STDOUT)
+    env = dict(
+        os.environ, DIFY_API_BASE_URL=stub_url, DIFY_API_KEY='benchmark', DIFY_WORKFLOW_ID='benchmark',
+        DIFY_RESPONSE_MODE=args.response_mode, DIFY_CACHE_ENABLED='false'
+    )
+    app_process = subprocess.Popen(
+        [sys.executable, '-c', APP_RUNNER, ROOT, str(app_port)],
+        cwd=workdir, env=env, stdout=logs['app'], stderr=subprocess.STDOUT
+    )
+    
+    try:
+        wait_until_ready(f'{stub_url}/stats', stub)
+        wait_until_ready(f'{app_url}/api/dify/sessions/stats', app_process)
+        print(f"Replaying {len(images)} files in {len(batches)} session(s) "
+              f"(latency={args.latency}, error_rate={args.error_rate}, rate_limit_rate={args.rate_limit_rate})")
+        
+        results, wall_seconds = run_sessions(app_url, batches, args.poll_interval)
+        stub_stats = requests.get(f'{stub_url}/stats', timeout=5).json()
+    finally:
+        app_process.terminate()
+        rss_mb = peak_rss_mb(app_process)
+        stub.terminate()
+        stub.wait()
+        for log in logs.values():
+            log.close()
+        if args.keep_workdir:
+            print(f"Work directory: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    
+    latencies = [r['latency_seconds'] for r in results]
+    processing = [r['elapsed_seconds'] for r in results if r['elapsed_seconds'] is not None]
+    summary = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'files': len(results),
+        'failed': sum(1 for r in results if r['failed']),
+        'wall_seconds': round(wall_seconds, 2),
+        'files_per_minute': round(len(results) / wall_seconds * 60, 1) if wall_seconds else None,
+        'latency_p50_seconds': round(percentile(latencies, 50), 2),
+        'latency_p95_seconds': round(percentile(latencies, 95), 2),
+        'processing_p50_seconds': percentile(processing, 50),
+        'processing_p95_seconds': percentile(processing, 95),
+        'peak_rss_mb': round(rss_mb, 1),
+        'stub': {k: stub_stats[k] for k in ('uploads', 'runs', 'errors', 'rate_limited', 'max_concurrency')},
+        'settings': {
+            'repeat': args.repeat, 'batch_size': args.batch_size, 'latency': args.latency,
+            'error_rate': args.error_rate, 'rate_limit_rate': args.rate_limit_rate,
+            'response_mode': args.response_mode,
+            'max_concurrency': os.getenv('DIFY_MAX_CONCURRENCY'), 'session_workers': os.getenv('DIFY_SESSION_WORKERS')
+        }
+    }
+    
+    print(f"Files:            {summary['files']} ({summary['failed']} failed)")
+    print(f"Wall time:        {summary['wall_seconds']} s")
+    print(f"Throughput:       {summary['files_per_minute']} files/min")
+    print(f"Latency p50/p95:  {summary['latency_p50_seconds']} / {summary['latency_p95_seconds']} s (upload to result)")
+    print(f"Processing p50/p95: {summary['processing_p50_seconds']} / {summary['processing_p95_seconds']} s")
+    print(f"Peak RSS (app):   {summary['peak_rss_mb']} MB")
+    print(f"Stub:             {summary['stub']}")
+    
+    if args.json:
+        with open(args.json, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(summary, ensure_ascii=False) + '\n')
+
+if __name__ == '__main__':
+    main()
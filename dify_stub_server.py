@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Difyの代わりに応答するローカルのスタブサーバー
+
+/v1/files/upload と /v1/workflows/run（blocking / streaming）を実装し、YES部品ワークフローと
+同じ形式の出力を返す。Difyのクレジットを使わずにパイプラインの性能を測るためのもので、
+遅延の分布・エラー率・429の発生率を指定できる。
+
+    python dify_stub_server.py --port 8765 --latency lognormal:2,0.4 --error-rate 0.02 --rate-limit-rate 0.05
+
+アプリ側は DIFY_API_BASE_URL=http://127.0.0.1:8765 を指定して起動する（APIキー・ワークフローIDは任意の値でよい）。
+GET /stats で呼び出し回数などを確認でき、POST /stats/reset でリセットできる。
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import random
+import time
+import uuid
+from collections import OrderedDict
+from threading import Lock
+
+from flask import Flask, Response, jsonify, request
+
+app = Flask(__name__)
+
+# YES部品１枚_ver1.0.yml のLLMノード（ストリーミング時に node_started / node_finished を送る）
+WORKFLOW_NODES = [
+    ('1754874339572', 'ページ抽出'),
+    ('1754565192779', 'テキスト変換'),
+    ('1754562078857', '項目抽出'),
+]
+
+PERSONS = ['田中', '佐藤', '鈴木', '高橋', '伊藤']
+PARTS = [
+    ('123456-7890', 'パッキン', 1000),
+    ('234567-8901', 'Oリング', 350),
+    ('345678-9012', 'フィルター', 2480),
+    ('456789-0123', 'ベアリング', 5200),
+    ('567890-1234', 'ボルト', 120),
+]
+
+MAX_UPLOADS = 10000
+
+config = argparse.Namespace(
+    latency=('fixed', 1.0), upload_latency=('fixed', 0.05),
+    error_rate=0.0, rate_limit_rate=0.0, max_concurrency=0, retry_after=1, outputs=None, text_chunk_chars=4
+)
+uploads = OrderedDict()
+stats_lock = Lock()
+stats = {}
+
+def reset_stats():
+    with stats_lock:
+        stats.update({
+            'uploads': 0, 'runs': 0, 'succeeded': 0, 'errors': 0, 'rate_limited': 0,
+            'unknown_files': 0, 'concurrency': 0, 'max_concurrency': 0, 'started_at': time.time()
+        })
+
+reset_stats()
+
+def parse_distribution(value):
+    """'fixed:1.5'、'uniform:0.5,3'、'lognormal:2,0.4'（中央値の秒数, sigma）を解釈する"""
+    kind, _, params = value.partition(':')
+    try:
+        numbers = tuple(float(p) for p in params.split(',')) if params else ()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid distribution: {value}')
+    expected = {'fixed': 1, 'uniform': 2, 'lognormal': 2}
+    if kind not in expected or len(numbers) != expected[kind]:
+        raise argparse.ArgumentTypeError(
+            f'invalid distribution: {value} (fixed:SECONDS, uniform:MIN,MAX, lognormal:MEDIAN,SIGMA)'
+        )
+    return (kind,) + numbers
+
+def sample_seconds(distribution):
+    kind = distribution[0]
+    if kind == 'fixed':
+        return distribution[1]
+    if kind == 'uniform':
+        return random.uniform(distribution[1], distribution[2])
+    return random.lognormvariate(math.log(distribution[1]), distribution[2])
+
+def error_response(status_code, code, message, headers=None):
+    response = jsonify({'code': code, 'message': message, 'status': status_code})
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    return response
+
+def canned_text(file_hash):
+    """アップロードされたファイルごとに決まった内容の、YES部品形式の出力テキストを作る"""
+    if config.outputs:
+        return config.outputs[int(file_hash, 16) % len(config.outputs)]
+    
+    rng = random.Random(file_hash)
+    pages = []
+    for page in range(1, rng.randint(1, 2) + 1):
+        parts = rng.sample(PARTS, rng.randint(1, 3))
+        quantities = [rng.randint(1, 20) for _ in parts]
+        amounts = [price * quantity for (_, _, price), quantity in zip(parts, quantities)]
+        freight = rng.choice([0, 0, 800, 1200])
+        pages.append({
+            'ページ': str(page),
+            '出荷日': f'25/{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d}',
+            '受注番号': str(rng.randint(1000000, 1999999)),
+            '納入先番号': f'AB{rng.randint(100000, 999999)}',
+            '担当者': rng.choice(PERSONS),
+            '部品番号': [number for number, _, _ in parts],
+            '部品名': [name for _, name, _ in parts],
+            '運賃': f'{freight:,}',
+            '数量': [str(quantity) for quantity in quantities],
+            '売上単価': [f'{price:,}' for _, _, price in parts],
+            '売上金額': [f'{amount:,}' for amount in amounts],
+            '税抜合計': f'{sum(amounts) + freight:,}'
+        })
+    return '```json\n' + json.dumps(pages, ensure_ascii=False, indent=2) + '\n```'
+
+def check_auth():
+    if not request.headers.get('Authorization', '').startswith('Bearer '):
+        return error_response(401, 'unauthorized', 'Access token is invalid')
+    return None
+
+@app.route('/v1/files/upload', methods=['POST'])
+def upload_file():
+    """ファイルを受け取り、内容のハッシュだけを保存してIDを返す"""
+    denied = check_auth()
+    if denied:
+        return denied
+    file = request.files.get('file')
+    if file is None:
+        return error_response(400, 'no_file_uploaded', 'Please upload your file.')
+    
+    content = file.read()
+    time.sleep(sample_seconds(config.upload_latency))
+    
+    file_id = str(uuid.uuid4())
+    with stats_lock:
+        stats['uploads'] += 1
+        uploads[file_id] = hashlib.sha256(content).hexdigest()
+        while len(uploads) > MAX_UPLOADS:
+            uploads.popitem(last=False)
+    
+    return jsonify({
+        'id': file_id,
+        'name': file.filename,
+        'size': len(content),
+        'extension': file.filename.rsplit('.', 1)[-1] if '.' in file.filename else '',
+        'mime_type': file.mimetype,
+        'created_by': request.form.get('user'),
+        'created_at': int(time.time())
+    }), 201
+
+@app.route('/v1/workflows/run', methods=['POST'])
+def run_workflow():
+    """ワークフローの実行。指定された確率で500・429を返し、それ以外は遅延の後に出力を返す"""
+    denied = check_auth()
+    if denied:
+        return denied
+    payload = request.get_json(silent=True) or {}
+    try:
+        file_id = payload['inputs']['input_file']['upload_file_id']
+    except (KeyError, TypeError):
+        return error_response(400, 'invalid_param', 'input_file is required in input form')
+    
+    with stats_lock:
+        stats['runs'] += 1
+        file_hash = uploads.get(file_id)
+        if file_hash is None:
+            stats['unknown_files'] += 1
+            return error_response(400, 'invalid_param', f'Invalid upload file id {file_id}')
+        over_limit = config.max_concurrency and stats['concurrency'] >= config.max_concurrency
+        if over_limit or random.random() < config.rate_limit_rate:
+            stats['rate_limited'] += 1
+            return error_response(
+                429, 'too_many_requests', 'Too many requests', {'Retry-After': str(config.retry_after)}
+            )
+        if random.random() < config.error_rate:
+            stats['errors'] += 1
+            return error_response(500, 'internal_server_error', 'The server encountered an internal error')
+        stats['concurrency'] += 1
+        stats['max_concurrency'] = max(stats['max_concurrency'], stats['concurrency'])
+    
+    latency = sample_seconds(config.latency)
+    run_id = str(uuid.uuid4())
+    outputs = {'text': canned_text(file_hash)}
+    
+    if payload.get('response_mode') == 'streaming':
+        response = Response(stream_workflow(run_id, latency, outputs), content_type='text/event-stream')
+        # クライアントが途中で切断しても実行中の数を戻す（成功はworkflow_finishedを送れた場合だけ数える）
+        response.call_on_close(finish_run)
+        return response
+    
+    try:
+        time.sleep(latency)
+    finally:
+        finish_run()
+    record_succeeded()
+    return jsonify({
+        'workflow_run_id': run_id,
+        'task_id': str(uuid.uuid4()),
+        'data': {
+            'id': run_id,
+            'workflow_id': payload.get('workflow_id'),
+            'status': 'succeeded',
+            'outputs': outputs,
+            'error': None,
+            'elapsed_time': latency,
+            'total_tokens': 0,
+            'total_steps': len(WORKFLOW_NODES) + 2,
+            'created_at': int(time.time() - latency),
+            'finished_at': int(time.time())
+        }
+    })
+
+def stream_workflow(run_id, latency, outputs):
+    """Difyと同じ形式のServer-Sent Eventsを、遅延をノードごとに分けて送る
+    
+    Difyと同様にpingと、最後のLLMノードの出力をトークン単位に分けたtext_chunkも送る。
+    """
+    def event(name, data):
+        message = {'event': name, 'workflow_run_id': run_id, 'data': data}
+        return f'data: {json.dumps(message, ensure_ascii=False)}\n\n'
+    
+    yield event('workflow_started', {'id': run_id, 'created_at': int(time.time())})
+    yield 'event: ping\n\n'
+    node_latency = latency / len(WORKFLOW_NODES)
+    for number, (node_id, title) in enumerate(WORKFLOW_NODES, 1):
+        yield event('node_started', {'node_id': node_id, 'node_type': 'llm', 'title': title})
+        if number < len(WORKFLOW_NODES) or config.text_chunk_chars <= 0:
+            time.sleep(node_latency)
+        else:
+            text = outputs['text']
+            chunks = [text[i:i + config.text_chunk_chars] for i in range(0, len(text), config.text_chunk_chars)]
+            for chunk in chunks:
+                time.sleep(node_latency / len(chunks))
+                yield event('text_chunk', {'text': chunk, 'from_variable_selector': [node_id, 'text']})
+        yield event('node_finished', {
+            'node_id': node_id, 'node_type': 'llm', 'title': title, 'status': 'succeeded'
+        })
+    yield event('workflow_finished', {
+        'id': run_id, 'status': 'succeeded', 'outputs': outputs, 'error': None, 'elapsed_time': latency
+    })
+    # 切断された場合はyieldで終了し、ここまで来ない
+    record_succeeded()
+
+def finish_run():
+    with stats_lock:
+        stats['concurrency'] -= 1
+
+def record_succeeded():
+    with stats_lock:
+        stats['succeeded'] += 1
+
+@app.route('/stats')
+def get_stats():
+    with stats_lock:
+        return jsonify(dict(stats))
+
+@app.route('/stats/reset', methods=['POST'])
+def post_stats_reset():
+    reset_stats()
+    return jsonify({'success': True})
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the Dify API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=parse_distribution, default=config.latency,
+                        help='workflow run latency: fixed:S, uniform:MIN,MAX or lognormal:MEDIAN,SIGMA (default fixed:1)')
+    parser.add_argument('--upload-latency', type=parse_distribution, default=config.upload_latency,
+                        help='file upload latency (default fixed:0.05)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability of a 500 response')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='probability of a 429 response')
+    parser.add_argument('--max-concurrency', type=int, default=0,
+                        help='answer 429 while this many runs are in progress (0 = unlimited)')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds sent with 429')
+    parser.add_argument('--text-chunk-chars', type=int, default=config.text_chunk_chars,
+                        help='characters per streamed text_chunk event (about one token; 0 = none)')
+    parser.add_argument('--outputs', help='JSON file with a list of output texts to return instead of generated ones')
+    parser.add_argument('--seed', type=int, help='random seed for latencies and failures')
+    args = parser.parse_args()
+    
+    if args.seed is not None:
+        random.seed(args.seed)
+    if args.outputs:
+        with open(args.outputs, encoding='utf-8') as f:
+            args.outputs = json.load(f)
+    vars(config).update({k: v for k, v in vars(args).items() if hasattr(config, k)})
+    
+    print(f"Dify stub listening on http://{args.host}:{args.port} "
+          f"(latency={args.latency}, error_rate={args.error_rate}, rate_limit_rate={args.rate_limit_rate})")
+    app.run(host=args.host, port=args.port, threaded=True)
+
+if __name__ == '__main__':
+    main()
@@ -221,49 +221,95 @@ onDOMReady(() => {
         let lastResultCount = 0;
         let allResults = [];
         
-        const pollInterval = setInterval(async () => {
-            try {
-                const response = await fetch(`/api/dify/session/${sessionId}/status?last_result_count=${lastResultCount}`);
-                const data = await response.json();
+        function applyStatus(data) {
+            // 並列処理中のファイルはすべて current_processing に含まれる
+            if (Array.isArray(data.current_processing)) {
+                data.current_processing.forEach(processingInfo => updateCurrentProcessingStatus(processingInfo));
+            }
+            
+            if (data.new_results && data.new_results.length > 0) {
+                allResults = allResults.concat(data.new_results);
+                displaySequentialResults(allResults);
+                lastResultCount = data.total_results_count || allResults.length;
+            }
+            
+            if (data.completed) {
+                setButtonLoading(analyzeBtn, false);
                 
-                if (!response.ok) {
-                    throw new Error(data.error || 'Status check failed');
-                }
+                checkRetryButtonVisibility(allResults, true);
                 
-                if (data.current_processing) {
-                    updateCurrentProcessingStatus(data.current_processing);
+                if (data.errors && data.errors.length > 0) {
+                    console.warn('Processing errors:', data.errors);
                 }
                 
-                if (data.new_results && data.new_results.length > 0) {
-                    allResults = allResults.concat(data.new_results);
-                    displaySequentialResults(allResults);
-                    lastResultCount = data.total_results_count;
+                if (!allResults.some(result => result.failed)) {
+                    fetch(`/api/dify/session/${sessionId}/cleanup`, { method: 'DELETE' })
+                        .catch(err => console.warn('Cleanup failed:', err));
                 }
-                
-                if (data.completed) {
-                    clearInterval(pollInterval);
-                    setButtonLoading(analyzeBtn, false);
-                    
-                    checkRetryButtonVisibility(allResults, true);
+            }
+        }
+        
+        function startStatusPolling() {
+            const pollInterval = setInterval(async () => {
+                try {
+                    const response = await fetch(`/api/dify/session/${sessionId}/status?last_result_count=${lastResultCount}`);
+                    const data = await response.json();
                     
-                    if (data.errors && data.errors.length > 0) {
-                        console.warn('Processing errors:', data.errors);
+                    if (!response.ok) {
+                        throw new Error(data.error || 'Status check failed');
                     }
                     
-                    if (!allResults.some(result => result.failed)) {
-                        fetch(`/api/dify/session/${sessionId}/cleanup`, { method: 'DELETE' })
-                            .catch(err => console.warn('Cleanup failed:', err));
+                    if (data.completed) {
+                        clearInterval(pollInterval);
                     }
+                    applyStatus(data);
+                    
+                } catch (error) {
+                    clearInterval(pollInterval);
+                    const errorMessage = 'ステータス確認中にエラーが発生しました';
+                    displayError(errorMessage);
+                    console.error('Polling error:', error);
+                    setButtonLoading(analyzeBtn, false);
                 }
-                
-            } catch (error) {
-                clearInterval(pollInterval);
-                const errorMessage = 'ステータス確認中にエラーが発生しました';
-                displayError(errorMessage);
-                console.error('Polling error:', error);
-                setButtonLoading(analyzeBtn, false);
+            }, 2000);
+        }
+        
+        // SSEで進捗を受信し、使えない場合・切断時はポーリングに切り替える
+        if (!window.EventSource) {
+            startStatusPolling();
+            return;
+        }
+        
+        const source = new EventSource(`/api/dify/session/${sessionId}/events?last_result_count=${lastResultCount}`);
+        let pendingResults = [];
+        let finished = false;
+        
+        source.addEventListener('result', (event) => {
+            pendingResults.push(JSON.parse(event.data));
+        });
+        
+        source.addEventListener('progress', (event) => {
+            applyStatus({ ...JSON.parse(event.data), new_results: pendingResults, completed: false });
+            pendingResults = [];
+        });
+        
+        source.addEventListener('completed', (event) => {
+            finished = true;
+            source.close();
+            applyStatus({ ...JSON.parse(event.data), new_results: pendingResults, completed: true });
+            pendingResults = [];
+        });
+        
+        source.onerror = () => {
+            if (finished) return;
+            finished = true;
+            source.close();
+            if (pendingResults.length > 0) {
+                applyStatus({ new_results: pendingResults, completed: false });
+                pendingResults = [];
             }
-        }, 2000);
+            startStatusPolling();
+        };
     }
     
     function displaySequentialResults(results) {
@@ -369,7 +415,10 @@ onDOMReady(() => {
             const statusElement = fileItem.querySelector('.file-status');
             if (statusElement) {
                 const attemptText = `${processingInfo.current_attempt}回目分析中`;
-                statusElement.innerHTML = `🔄 ${attemptText}`;
+                // streamingモードでは実行中のワークフローノード名も表示
+                const stageText = processingInfo.stage ? ` - ${processingInfo.stage}` : '';
+                // ステージにはDifyのノード名が入るため、HTMLとして解釈しない
+                statusElement.textContent = `🔄 ${attemptText}${stageText}`;
                 statusElement.style.color = '#007bff';
                 fileItem.classList.add('processing');
                 fileItem.classList.remove('completed', 'failed');
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""サーキットブレーカー（半開時のプローブ）のテスト
+
+一時ディレクトリに空のデータベースを作ってアプリを読み込む（Difyへは送信しない）。
+
+    python -m pytest test_circuit_breaker.py
+"""
+
+import os
+import sqlite3
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+def load_app():
+    """Import app.py with its database in a temporary directory"""
+    if 'app' not in sys.modules:
+        os.environ.update(
+            DIFY_QUEUE_WORKERS='0', DIFY_CACHE_ENABLED='false',
+            DIFY_API_BASE_URL='http://127.0.0.1:9', DIFY_API_KEY='test', DIFY_WORKFLOW_ID='test', LOG_LEVEL='WARNING'
+        )
+        os.chdir(tempfile.mkdtemp(prefix='dify-breaker-test-'))
+        sys.path.insert(0, ROOT)
+    import app
+    return app
+
+def half_open_breaker(app):
+    breaker = app.CircuitBreaker()
+    breaker.hold_open(0)
+    return breaker
+
+def test_probe_is_released_when_report_fails():
+    """プローブが結果を記録する前に進捗の書き込みで失敗しても、次の呼び出しが通る"""
+    app = load_app()
+    breaker = half_open_breaker(app)
+    limiter = app.dify_rate_limiter
+    
+    def locked(**fields):
+        raise sqlite3.OperationalError('database is locked')
+    
+    app.dify_breaker, saved_breaker = breaker, app.dify_breaker
+    limiter.try_acquire_slot, saved_try_acquire = (lambda: False), limiter.try_acquire_slot
+    try:
+        try:
+            app.call_dify('upload', locked, lambda: 'file-id')
+        except sqlite3.OperationalError:
+            pass
+        else:
+            raise AssertionError('report error was swallowed')
+    finally:
+        app.dify_breaker = saved_breaker
+        limiter.try_acquire_slot = saved_try_acquire
+    
+    assert breaker.state == 'half_open'
+    assert breaker.before_call() == (0.0, True)
+
+def test_probe_outcome_closes_breaker():
+    """プローブが成功すればブレーカーは閉じる"""
+    app = load_app()
+    breaker = half_open_breaker(app)
+    app.dify_breaker, saved_breaker = breaker, app.dify_breaker
+    try:
+        assert app.call_dify('upload', app.ignore_progress, lambda: 'file-id') == 'file-id'
+    finally:
+        app.dify_breaker = saved_breaker
+    
+    assert breaker.state == 'closed'
+    assert breaker.before_call() == (0.0, False)
+
+if __name__ == "__main__":
+    test_probe_is_released_when_report_fails()
+    test_probe_outcome_closes_breaker()
+    print("OK")
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""ZIP一括取込（/api/dify/ingest）のテスト
+
+一時ディレクトリに空のデータベースを作ってアプリを読み込み、キューへの追加までを確認する
+（DIFY_QUEUE_WORKERS=0 なのでDifyへは送信しない）。
+
+    python -m pytest test_ingest_archive.py
+"""
+
+import io
+import os
+import sys
+import tempfile
+import zipfile
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+MAX_ENTRY_BYTES = 10 * 1024
+
+def load_app():
+    """Import app.py with its database and spool in a temporary directory"""
+    if 'app' not in sys.modules:
+        os.environ.update(
+            DIFY_QUEUE_WORKERS='0', DIFY_CACHE_ENABLED='false',
+            DIFY_API_BASE_URL='http://127.0.0.1:9', DIFY_API_KEY='test', DIFY_WORKFLOW_ID='test', LOG_LEVEL='WARNING'
+        )
+        os.chdir(tempfile.mkdtemp(prefix='dify-ingest-test-'))
+        sys.path.insert(0, ROOT)
+    import app
+    # 他のテストが先に読み込んでいても上限を小さくする（取込ごとに参照される）
+    app.DIFY_INGEST_MAX_ENTRY_MB = MAX_ENTRY_BYTES / 1024 / 1024
+    return app
+
+def png_bytes(label, size=200):
+    # 取込時は中身を検査しないので、PNGの署名と区別用のバイト列だけでよい
+    return b'\x89PNG\r\n\x1a\n' + label.encode('ascii') * (size // len(label))
+
+class Unseekable(io.RawIOBase):
+    """Write-only stream without seek/tell, so zipfile writes data descriptors as it would to a pipe"""
+    
+    def __init__(self, buffer):
+        self.buffer = buffer
+    
+    def writable(self):
+        return True
+    
+    def write(self, data):
+        return self.buffer.write(data)
+
+def make_archive(entries, compression=zipfile.ZIP_DEFLATED, streamed=False):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(Unseekable(buffer) if streamed else buffer, 'w') as archive:
+        for name, content in entries:
+            info = zipfile.ZipInfo(name)
+            info.compress_type = compression
+            with archive.open(info, 'w') as entry:
+                entry.write(content)
+    return buffer.getvalue()
+
+def ingest(archive):
+    app = load_app()
+    response = app.app.test_client().post(
+        '/api/dify/ingest', data=archive, headers={'Content-Type': 'application/zip'}
+    )
+    return response.status_code, response.get_json()
+
+def queued_filenames(session_id):
+    app = load_app()
+    rows = app.connect_queue_db().execute(
+        'SELECT filename FROM processing_jobs WHERE session_id = ? ORDER BY file_index', (session_id,)
+    ).fetchall()
+    return [row['filename'] for row in rows]
+
+def test_large_non_png_entry_is_skipped():
+    """大きなPDFの後ろにあるPNGも取り込まれる（PDFはサイズに関係なく読み飛ばす）"""
+    manual = os.urandom(MAX_ENTRY_BYTES * 3)
+    for compression in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        for streamed in (False, True):
+            if streamed and compression == zipfile.ZIP_STORED:
+                continue
+            archive = make_archive(
+                [('a.png', png_bytes('a')), ('manual.pdf', manual), ('c.png', png_bytes('c'))], compression, streamed
+            )
+            status, body = ingest(archive)
+            assert status == 200, body
+            assert body['total_files'] == 2
+            assert body['errors'] == ['manual.pdf: PNGファイルのみ対応しています']
+            assert queued_filenames(body['session_id']) == ['a.png', 'c.png']
+
+def test_oversized_png_fails_only_that_file():
+    """上限を超えるPNGはそのファイルだけエラーとなり、後ろのPNGは取り込まれる"""
+    for streamed in (False, True):
+        archive = make_archive([
+            ('a.png', png_bytes('a')),
+            ('huge.png', b'\x89PNG\r\n\x1a\n' + os.urandom(MAX_ENTRY_BYTES * 2)),
+            ('c.png', png_bytes('c'))
+        ], streamed=streamed)
+        status, body = ingest(archive)
+        assert status == 200, body
+        assert body['total_files'] == 2
+        assert len(body['errors']) == 1 and body['errors'][0].startswith('huge.png: ')
+        assert queued_filenames(body['session_id']) == ['a.png', 'c.png']
+
+def test_corrupt_archive_still_stops():
+    """ZIPが途中で切れている場合は、それまでのファイルだけで受信を中断する"""
+    archive = make_archive([('a.png', png_bytes('a')), ('b.png', png_bytes('b', 5000))], zipfile.ZIP_STORED)
+    status, body = ingest(archive[:len(archive) // 2])
+    assert status == 200, body
+    assert body['total_files'] == 1
+    assert body['errors'][-1].startswith('ZIPの受信を中断しました')
+
+def test_receiving_session_status():
+    """受信中でまだファイルがないセッションの状態も取得できる"""
+    app = load_app()
+    session_id = 'receiving-test'
+    with app.queue_transaction() as conn:
+        app.create_session(conn, session_id, [], False)
+    response = app.app.test_client().get(f'/api/dify/session/{session_id}/status')
+    assert response.status_code == 200
+    assert response.get_json()['progress_percentage'] == 0.0
+
+if __name__ == "__main__":
+    test_large_non_png_entry_is_skipped()
+    test_oversized_png_fails_only_that_file()
+    test_corrupt_archive_still_stops()
+    test_receiving_session_status()
+    print("OK")